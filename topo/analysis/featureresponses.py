@@ -11,12 +11,13 @@ __version__='$Revision$'
 
 import time
 import copy
+import traceback
 
 from math import fmod,floor,pi
 from colorsys import hsv_to_rgb
 
 import numpy
-from numpy import zeros, array, empty, object_, size, vectorize, fromfunction
+from numpy import zeros, array, empty, object_, size
 from numpy.oldnumeric import Float
 
 import param
@@ -25,14 +26,14 @@ from param.parameterized import ParameterizedFunction, ParamOverrides
 import topo
 import topo.base.sheetcoords
 from topo.base.arrayutil import wrap
-from topo.base.cf import CFSheet
-from topo.base.functionfamily import PatternDrivenAnalysis 
+from topo.base.cf import CFSheet, CFProjection
+from topo.base.functionfamily import PatternDrivenAnalysis, DotProduct
+from topo.base.projection import ProjectionSheet
 from topo.base.sheet import Sheet, activity_type
 from topo.base.sheetcoords import SheetCoordinateSystem
 from topo.base.sheetview import SheetView
 from topo.command.basic import pattern_present,restore_input_generators, save_input_generators
 from topo.command.basic import wipe_out_activity, clear_event_queue
-from topo.misc.distribution import Distribution
 from topo.misc.util import cross_product, frange
 from topo import pattern
 from topo.pattern.basic import SineGrating, Gaussian, RawRectangle, Disk, OrientationContrast
@@ -40,82 +41,109 @@ from topo.plotting.plotgroup import plotgroups
 from topo.sheet import GeneratorSheet
 
 
-# CB: having a class called DistributionMatrix with an attribute
-# distribution_matrix to hold the distribution matrix seems silly.
-# Either rename distribution_matrix or make DistributionMatrix into
-# a matrix.
 class DistributionMatrix(param.Parameterized):
     """
-    Maintains a matrix of Distributions (each of which is a dictionary
-    of (feature value: activity) pairs).
-    
-    The matrix contains one Distribution for each unit in a
-    rectangular matrix (given by the matrix_shape constructor
-    argument).  The contents of each Distribution can be updated for a
-    given bin value all at once by providing a matrix of new values to
-    update().
+    Maintains a distribution of (feature value: activity) pairs for
+    each unit in a rectangular matrix (given by the matrix_shape
+    constructor argument).
+
+    Each unit's distribution has the same semantics as a
+    topo.misc.distribution.Distribution, but for speed the values for
+    all units are stored together, as one array per bin, so that the
+    contents of every distribution can be updated for a given bin
+    value all at once by providing a matrix of new values to update().
 
     The results can then be accessed as a matrix of weighted averages
     (which can be used as a preference map) and/or a selectivity
     map (which measures the peakedness of each distribution).
     """
     def __init__(self,matrix_shape,axis_range=(0.0,1.0), cyclic=False,keep_peak=True):
-        """Initialize the internal data structure: a matrix of Distribution objects."""
+        """Initialize the internal data structure: an empty list of bins."""
+        self.matrix_shape=tuple(matrix_shape)
         self.axis_range=axis_range
-        new_distribution = vectorize(lambda x: Distribution(axis_range,cyclic,keep_peak),
-                                     doc="Return a Distribution instance for each element of x.")
-        self.distribution_matrix = new_distribution(empty(matrix_shape))
+        self.cyclic=cyclic
+        self.keep_peak=keep_peak
+        # Bin values, in the order first updated, and a matrix of
+        # values for each one
+        self.bins=[]
+        self._values=[]
+        self._bin_index={}
 
-  
 
     def update(self, new_values, bin):
         """Add a new matrix of histogram values for a given bin value."""
-        ### JABHACKALERT!  The Distribution class should override +=,
-        ### rather than + as used here, because this operation
-        ### actually modifies the distribution_matrix, but that has
-        ### not yet been done.  Alternatively, it could use a different
-        ### function name altogether (e.g. update(x,y)).
-        self.distribution_matrix + fromfunction(vectorize(lambda i,j: {bin:new_values[i,j]}),
-                                                new_values.shape)  
-            
+        if bin not in self._bin_index:
+            if not self.cyclic and not (self.axis_range[0] <= bin <= self.axis_range[1]):
+                raise ValueError("Bin outside bounds.")
+            self._bin_index[bin]=len(self.bins)
+            self.bins.append(bin)
+            self._values.append(zeros(self.matrix_shape,Float))
+
+        values = self._values[self._bin_index[bin]]
+        if self.keep_peak:
+            numpy.maximum(values,new_values,values)
+        else:
+            values += new_values
 
-    def weighted_average(self):
-        """Return the weighted average of each Distribution as a matrix."""
 
-        weighted_average_matrix=zeros(self.distribution_matrix.shape,Float)
-              
-        for i in range(len(weighted_average_matrix)):
-            for j in range(len(weighted_average_matrix[i])):
-                weighted_average_matrix[i,j]=self.distribution_matrix[i,j].weighted_average()
-#                weighted_average_matrix[i,j]=self.distribution_matrix[i,j].estimated_maximum()               
-                           
+    def get_value(self, bin):
+        """Return the matrix of values for the given bin (or None if there is no such bin)."""
+        if bin in self._bin_index:
+            return self._values[self._bin_index[bin]]
 
-        return weighted_average_matrix
-        
-        
-    def max_value_bin(self):
-        """Return the bin with the max value of each Distribution as a matrix."""
 
-        max_value_bin_matrix=zeros(self.distribution_matrix.shape,Float)
-            
-        for i in range(len(max_value_bin_matrix)):
-            for j in range(len(max_value_bin_matrix[i])):           
-                max_value_bin_matrix[i,j]=self.distribution_matrix[i,j].max_value_bin()                             
+    def _safe_divide(self,numerator,denominator):
+        # Elementwise numerator/denominator, but zero where the
+        # denominator is zero (as for Distribution._safe_divide()).
+        undefined = denominator==0
+        return numpy.where(undefined,0.0,numerator/numpy.where(undefined,1.0,denominator))
+
+
+    def _vector_sum(self):
+        # Return the magnitude and direction (in bins) of the vector
+        # sum of each unit's distribution (see Distribution.vector_sum()).
+        axis_size = self.axis_range[1]-self.axis_range[0]
+        theta = (2*pi)*array(self.bins,Float)/axis_size
+        values = array(self._values)
+        x = numpy.tensordot(numpy.cos(theta),values,1)
+        y = numpy.tensordot(numpy.sin(theta),values,1)
+        direction = numpy.arctan2(y,x)*axis_size/(2*pi)
+        # wrap the direction because arctan2 returns principal values
+        # (as arrayutil.wrap(), which only handles scalars)
+        lower = self.axis_range[0]
+        direction = lower + numpy.fmod(direction-lower+2*axis_size*(1-numpy.floor(direction/(2*axis_size))),axis_size)
+        return numpy.sqrt(x*x+y*y), direction
 
-        return max_value_bin_matrix
+
+    def weighted_average(self):
+        """Return the weighted average of each unit's distribution as a matrix."""
+        if self.cyclic:
+            return self._vector_sum()[1]
+        else:
+            weighted_sum = numpy.tensordot(array(self.bins,Float),array(self._values),1)
+            return self._safe_divide(weighted_sum,numpy.add.reduce(self._values))
+        
         
+    def max_value_bin(self):
+        """Return the bin with the max value of each unit's distribution as a matrix."""
+        return array(self.bins,Float)[numpy.argmax(self._values,axis=0)]
         
 
     def selectivity(self):
-        """Return the selectivity of each Distribution as a matrix."""
-
-        selectivity_matrix=zeros(self.distribution_matrix.shape,Float) 
-
-        for i in range(len(selectivity_matrix)):
-            for j in range(len(selectivity_matrix[i])):
-                selectivity_matrix[i,j]=self.distribution_matrix[i,j].selectivity()
+        """
+        Return the selectivity of each unit's distribution as a matrix
+        (see Distribution.selectivity()).
+        """
+        total = numpy.add.reduce(self._values)
+        if self.cyclic:
+            return self._safe_divide(self._vector_sum()[0],total)
 
-        return selectivity_matrix
+        # A single bin is considered fully selective
+        if len(self.bins) <= 1:
+            return numpy.ones(self.matrix_shape,Float)
+        proportion = self._safe_divide(numpy.maximum.reduce(self._values),total)
+        offset = 1.0/len(self.bins)
+        return numpy.maximum((proportion-offset)/(1.0-offset),0.0)
 
 
 
@@ -188,6 +216,44 @@ class FeatureResponses(PatternDrivenAnalysis):
         intrinsic noise), then this parameter can be increased
         so that results will be an average over the specified
         number of repetitions.""")
+
+    processes = param.Integer(default=1,bounds=(1,None),doc="""
+        Number of processes to use for presenting the patterns.
+
+        If greater than 1, worker processes are forked from the
+        current one when measure_responses() is called, each
+        presenting a share of the feature combinations to its own
+        (copy-on-write) copy of the simulation and sending back the
+        responses, which are then collated in this process in the
+        same order as they would have been otherwise.  The results
+        are therefore the same as for a single process, as long as
+        each presentation is independent of the ones before it
+        (e.g. the network has no intrinsic noise drawn from a shared
+        random number stream).  Any other effects of the
+        presentation hooks are confined to the worker processes.
+        Not used when the GUI display is updated for each pattern,
+        and not for use with MPI.""")
+
+    batch_size = param.Integer(default=0,bounds=(0,None),doc="""
+        If nonzero, compute the responses to this many patterns at a
+        time directly from the weights, when possible, instead of
+        presenting each pattern to the network in turn.
+
+        This is possible when the response of every sheet measured is
+        a linear function of the input patterns: the sheets must be
+        fed only by dot-product CFProjections without output_fns,
+        from GeneratorSheets or other such sheets, and must not apply
+        output_fns (e.g. because the pattern_presenter is a
+        PatternPresenter with apply_output_fns=False).  The patterns drawn on the GeneratorSheets for a batch
+        are then stacked into a matrix, and the responses of each
+        sheet to all of them are computed at once by multiplying that
+        matrix by the weights of each projection (as a sparse matrix
+        if scipy is available).  The results are the same as those
+        from presenting the patterns (up to rounding), as long as the
+        pattern_presenter's duration is long enough for the input to
+        reach every sheet measured; the pre- and post-presentation
+        hooks are not run.  If the responses are not linear, the
+        patterns are presented as usual.""")
     
     _fullmatrix = {}
 
@@ -250,21 +316,42 @@ class FeatureResponses(PatternDrivenAnalysis):
         else:
             self.verbose("Presenting %d test patterns (%s)." % (len(self.permutations),values_description))
 
-        timer.call_fixed_num_times(self.permutations)
+        self._linear_plan = None
+        if self.batch_size>0 and not self.refresh_act_wins:
+            self._linear_plan = self._find_linear_plan()
+
+        if self._linear_plan is not None:
+            self._next_permutation = 0
+            timer.func = self._present_linear
+            timer.call_fixed_num_times(self.permutations)
+            self._linear_plan = None
+        elif self.processes>1 and not self.refresh_act_wins:
+            self._start_workers()
+            timer.func = self._collect_permutation
+            try:
+                timer.call_fixed_num_times(self.permutations)
+            finally:
+                self._stop_workers()
+        else:
+            timer.call_fixed_num_times(self.permutations)
         
         # Run hooks after the analysis session
         for f in self.post_analysis_session_hooks: f()
 
     def present_permutation(self,permutation):
         """Present a pattern with the specified set of feature values."""
+        complete_settings = self._present(permutation)
+        self._update(complete_settings)
+
+    def _present(self,permutation):
+        # Present the pattern(s) for the given permutation, leaving the
+        # average response of each sheet in self._activities, and
+        # return the complete set of feature values.
         for sheet in self.sheets_to_measure():
             self._activities[sheet]*=0
 
-        # Calculate complete set of settings
         permuted_settings = zip(self.feature_names, permutation)
-        complete_settings = permuted_settings + \
-            [(f.name,f.compute_fn(permuted_settings)) for f in self.features_to_compute]
-
+        complete_settings = self._complete_settings(permutation)
 
         for i in xrange(0,self.repetitions):
             topo.sim.state_push()
@@ -286,8 +373,14 @@ class FeatureResponses(PatternDrivenAnalysis):
 
         for sheet in self.sheets_to_measure():
             self._activities[sheet]=self._activities[sheet] / self.repetitions
-        
-        self._update(complete_settings)
+
+        return complete_settings
+
+    def _complete_settings(self,permutation):
+        # Calculate complete set of settings
+        permuted_settings = zip(self.feature_names, permutation)
+        return permuted_settings + \
+            [(f.name,f.compute_fn(permuted_settings)) for f in self.features_to_compute]
          
     def _update(self,current_values):
         # Update each DistributionMatrix with (activity,bin)
@@ -296,6 +389,214 @@ class FeatureResponses(PatternDrivenAnalysis):
                 self._featureresponses[sheet][feature].update(self._activities[sheet], value)
             FeatureResponses._fullmatrix[sheet].update(self._activities[sheet],current_values)
 
+    def _find_linear_plan(self):
+        # Return a list of the sheets to measure and the sheets they
+        # depend on, each after its sources, with a list of
+        # (projection,weights) pairs for each one, if their responses
+        # are linear (see batch_size); otherwise, warn and return None.
+        presenter = self.pattern_presenter
+        if not isinstance(presenter,PatternPresenter):
+            self.warning("Presenting patterns one at a time: pattern_presenter is not a PatternPresenter.")
+            return None
+
+        order = []
+        def add(sheet,path):
+            # Add sheet to order after its sources, returning the
+            # reason if its response is not linear
+            if sheet in order:
+                return None
+            if isinstance(sheet,GeneratorSheet):
+                if type(sheet).generate.im_func is not GeneratorSheet.generate.im_func:
+                    return "%s does not generate patterns like a GeneratorSheet"%sheet.name
+                return None
+            if sheet in path:
+                return "%s receives recurrent input"%sheet.name
+            if not isinstance(sheet,ProjectionSheet) or \
+                   type(sheet).activate.im_func is not ProjectionSheet.activate.im_func:
+                return "%s is not a plain ProjectionSheet"%sheet.name
+            if _applies_output_fns(sheet,presenter) and len(sheet.output_fns)>0:
+                return "%s applies output_fns"%sheet.name
+            for proj in sheet.in_connections:
+                if not isinstance(proj,CFProjection) or \
+                       type(proj).activate.im_func is not CFProjection.activate.im_func or \
+                       not isinstance(getattr(proj.response_fn,'single_cf_fn',None),DotProduct):
+                    return "%s is not a dot-product CFProjection"%proj.name
+                if len(proj.output_fns)>0 or proj.activity_group[1] is not numpy.add:
+                    return "%s is not combined linearly"%proj.name
+                reason = add(proj.src,path+[sheet])
+                if reason is not None:
+                    return reason
+            order.append(sheet)
+            return None
+
+        for sheet in self.sheets_to_measure():
+            reason = add(sheet,[])
+            if reason is not None:
+                self.warning("Presenting patterns one at a time: responses are not linear (%s)."%reason)
+                return None
+
+        return [(sheet,[(proj,_weights_matrix(proj)) for proj in sheet.in_connections])
+                for sheet in order]
+
+    def _present_linear(self,permutation):
+        # Called for each of self.permutations in turn; computes the
+        # responses for a batch of them on the first call for that
+        # batch.
+        i = self._next_permutation
+        if i%self.batch_size==0:
+            permutations = self.permutations[i:i+self.batch_size]
+            inputs,responses = self._linear_responses(permutations)
+            self._update_batch([self._complete_settings(p) for p in permutations],
+                               inputs,responses)
+        self._next_permutation += 1
+
+    def _linear_responses(self,permutations):
+        # Return the patterns drawn on every GeneratorSheet for each of
+        # the given permutations, and the response of each sheet in
+        # the linear plan to them, as dictionaries of arrays with one
+        # matrix per permutation.
+        presenter = self.pattern_presenter
+        n = len(permutations)
+        inputs = {}
+        for sheet in topo.sim.objects(GeneratorSheet).values():
+            inputs[sheet] = zeros((n,)+sheet.activity.shape,activity_type)
+
+        for i,permutation in enumerate(permutations):
+            generators = presenter.generators(dict(zip(self.feature_names,permutation)),
+                                              self.param_dict)
+            for sheet,patterns in inputs.items():
+                g = generators[sheet.name]
+                g.set_matrix_dimensions(sheet.bounds,sheet.xdensity,sheet.ydensity)
+                patterns[i] = g()
+                if _applies_output_fns(sheet,presenter):
+                    for of in sheet.output_fns:
+                        of(patterns[i])
+
+        responses = dict(inputs)
+        for sheet,projections in self._linear_plan:
+            response = zeros((sheet.activity.size,n),activity_type)
+            for proj,weights in projections:
+                response += proj.strength*weights.dot(responses[proj.src].reshape(n,-1).T)
+            # Masked-out units are not active
+            response *= (sheet.mask.data!=0).reshape(-1,1)
+            responses[sheet] = response.T.reshape((n,)+sheet.activity.shape)
+        return inputs,responses
+
+    def _update_batch(self,complete_settings,inputs,responses):
+        # Update the results with the responses to a batch of
+        # patterns, given the complete settings for each one.
+        for i,settings in enumerate(complete_settings):
+            for sheet in self.sheets_to_measure():
+                self._activities[sheet] = responses[sheet][i]
+            self._update(settings)
+
+    def _start_workers(self):
+        # Fork self.processes workers, each presenting every
+        # self.processes'th permutation (so that the responses arrive
+        # roughly in order).
+        import multiprocessing
+        self._queue = multiprocessing.Queue()
+        self._responses = {}
+        self._next_permutation = 0
+        self._workers = []
+        indexed_permutations = list(enumerate(self.permutations))
+        for i in range(self.processes):
+            worker = multiprocessing.Process(target=_present_permutations,
+                args=(self,indexed_permutations[i::self.processes],self._queue))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _collect_permutation(self,permutation):
+        # Update the responses with those a worker recorded for the
+        # given permutation, which must be the next in
+        # self.permutations.
+        i = self._next_permutation
+        while i not in self._responses:
+            kind,j,data = self._queue.get()
+            if kind=='error':
+                raise RuntimeError("Error while presenting patterns:\n"+data)
+            self._responses[j] = data
+        complete_settings,activities = self._responses.pop(i)
+        self._next_permutation += 1
+
+        for sheet in self.sheets_to_measure():
+            self._activities[sheet] = activities[sheet.name]
+        self._update(complete_settings)
+
+    def _stop_workers(self):
+        # Stop any workers still running (e.g. if the measurement was
+        # interrupted) and discard their responses.
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        del self._queue,self._responses,self._workers
+
+
+def _applies_output_fns(sheet,pattern_presenter):
+    """Return True if sheet's output_fns are applied when pattern_presenter presents a pattern."""
+    # (pattern_present() turns them off for sheets being measured)
+    return sheet.apply_output_fns and \
+           (pattern_presenter.apply_output_fns or not getattr(sheet,'measure_maps',False))
+
+
+def _weights_matrix(projection):
+    """
+    Return the weights of all the CFs of a CFProjection as one matrix,
+    with a row for each unit and a column for each unit of the source
+    sheet: a scipy.sparse CSR matrix if scipy is available, otherwise
+    a dense array.
+    """
+    store = getattr(projection,'weight_store',None)
+    input_shape = projection.src.activity.shape
+    try:
+        from scipy.sparse import csr_matrix
+    except ImportError:
+        csr_matrix = None
+
+    if csr_matrix is not None and store is not None:
+        return store.csr_matrix(input_shape)
+
+    icols = input_shape[1]
+    cfs = projection.flatcfs
+    columns = []
+    for cf in cfs:
+        if cf is None:
+            columns.append(numpy.array([],dtype=int))
+        else:
+            r1,r2,c1,c2 = cf.input_sheet_slice
+            columns.append((numpy.arange(r1,r2)[:,None]*icols + numpy.arange(c1,c2)).ravel())
+    weights = [cf.weights.ravel() for cf in cfs if cf is not None]
+    weights = numpy.concatenate(weights) if weights else numpy.zeros(0)
+    
+    if csr_matrix is not None:
+        indptr = numpy.concatenate([[0],numpy.cumsum([len(c) for c in columns])])
+        return csr_matrix((weights,numpy.concatenate(columns),indptr),
+                          shape=(len(cfs),input_shape[0]*input_shape[1]))
+    else:
+        matrix = zeros((len(cfs),input_shape[0]*input_shape[1]),weights.dtype)
+        rows = numpy.arange(len(cfs)).repeat([len(c) for c in columns])
+        matrix[rows,numpy.concatenate(columns)] = weights
+        return matrix
+
+
+def _present_permutations(feature_responses,indexed_permutations,queue):
+    """
+    Present each of the given (index,permutation) pairs using
+    feature_responses, putting the index, the complete feature values,
+    and the average responses of each sheet (by name) on the queue.
+    Runs in a separate (forked) process.
+    """
+    try:
+        for i,permutation in indexed_permutations:
+            complete_settings = feature_responses._present(permutation)
+            activities = dict([(sheet.name,activity.copy()) for sheet,activity
+                               in feature_responses._activities.items()])
+            queue.put(('responses',i,(complete_settings,activities)))
+    except:
+        queue.put(('error',None,traceback.format_exc()))
+
 
 
 class ReverseCorrelation(FeatureResponses):
@@ -306,6 +607,9 @@ class ReverseCorrelation(FeatureResponses):
 
     input_sheet = param.Parameter(default=None)
 
+    processes = param.Integer(default=1,bounds=(1,1),precedence=-1,doc="""
+        Reverse correlation is always measured in a single process.""")
+
     # JABALERT: Should _featureresponses be renamed here?; It's a different
     # data structure using different indexing (r,c instead of feature).
     def initialize_featureresponses(self,features): # CB: doesn't need features!
@@ -388,6 +692,18 @@ class ReverseCorrelation(FeatureResponses):
                 for jj in range(cols):
                     self._featureresponses[sheet][ii,jj]+=sheet.activity[ii,jj]*self.input_sheet.activity
 
+    def _update_batch(self,complete_settings,inputs,responses):
+        # Sum the input patterns weighted by each unit's responses, for
+        # all units at once
+        n = len(complete_settings)
+        patterns = inputs[self.input_sheet].reshape(n,-1)
+        for sheet in self.sheets_to_measure():
+            rows,cols = sheet.activity.shape
+            rfs = numpy.dot(responses[sheet].reshape(n,-1).T,patterns)
+            for ii in range(rows): 
+                for jj in range(cols):
+                    self._featureresponses[sheet][ii,jj]+=rfs[ii*cols+jj].reshape(self.input_sheet.shape)
+
 
 
                           
@@ -463,9 +779,10 @@ class FeatureMaps(FeatureResponses):
             # CB: (see also ALERT by SheetView's norm_factor.)
             #JL: Should be able to get rid of norm factor and incorporate with value_multiplier
             #should also add similar method for selectivity_offset and selectivity_multiplier
-                cyclic = self._featureresponses[sheet][feature].distribution_matrix[0,0].cyclic
+                cyclic = self._featureresponses[sheet][feature].cyclic
                 if cyclic:
-                    norm_factor = self._featureresponses[sheet][feature].distribution_matrix[0,0].axis_range
+                    axis_range = self._featureresponses[sheet][feature].axis_range
+                    norm_factor = axis_range[1]-axis_range[0]
                 else:
                     norm_factor = 1.0
 
@@ -520,8 +837,8 @@ class FeatureCurves(FeatureResponses):
         List of callable objects to be run at the end of collect_feature_responses function.
         The functions should accept three parameters: FullMatrix, curve label, sheet""")
 
-    def __init__(self,features,sheet,x_axis):
-        super(FeatureCurves, self).__init__(features)
+    def __init__(self,features,sheet,x_axis,**params):
+        super(FeatureCurves, self).__init__(features,**params)
         self.sheet=sheet
         self.x_axis=x_axis
         if hasattr(sheet, "curve_dict")==False:
@@ -537,11 +854,9 @@ class FeatureCurves(FeatureResponses):
         bounding_box = self.sheet.bounds
         self.measure_responses(pattern_presenter,param_dict,features,display)
         self.sheet.curve_dict[self.x_axis][curve_label]={}
-        for key in self._featureresponses[self.sheet][self.x_axis].distribution_matrix[0,0]._data.iterkeys():
-            y_axis_values = zeros(self.sheet.shape,activity_type)
-            for i in range(rows):
-                for j in range(cols):
-                    y_axis_values[i,j] = self._featureresponses[self.sheet][self.x_axis].distribution_matrix[i,j].get_value(key)
+        distribution_matrix = self._featureresponses[self.sheet][self.x_axis]
+        for key in distribution_matrix.bins:
+            y_axis_values = array(distribution_matrix.get_value(key),activity_type)
             Response = SheetView((y_axis_values,bounding_box), self.sheet.name , self.sheet.precedence, topo.sim.time(),self.sheet.row_precedence)
             self.sheet.curve_dict[self.x_axis][curve_label].update({key:Response})
         for f in self.post_collect_responses_hook: f(self._fullmatrix[self.sheet],curve_label,self.sheet)
@@ -650,6 +965,16 @@ class PatternPresenter(param.Parameterized):
 
         
     def __call__(self,features_values,param_dict):
+        inputs = self.generators(features_values,param_dict)
+        pattern_present(inputs, self.duration, plastic=False,
+                     apply_output_fns=self.apply_output_fns)
+
+
+    def generators(self,features_values,param_dict):
+        """
+        Return a dictionary of the PatternGenerator to present on each
+        GeneratorSheet (by name) for the given feature values.
+        """
         for param,value in param_dict.iteritems():
            # CEBALERT: why not setattr(self.gen,param,value)
            # CEBALERT: messed up spacing?
@@ -910,9 +1235,8 @@ class PatternPresenter(param.Parameterized):
         # blank patterns for unused generator sheets
         for sheet_name in set(all_input_sheet_names).difference(set(input_sheet_names)):
             inputs[sheet_name]=pattern.Constant(scale=0)
-            
-        pattern_present(inputs, self.duration, plastic=False,
-                     apply_output_fns=self.apply_output_fns)
+
+        return inputs
 
 
 
@@ -1129,6 +1453,15 @@ class MeasureResponseCommand(ParameterizedFunction):
         The default value of [] results in all GeneratorSheets being
         used.""")
 
+    processes = param.Integer(default=1,bounds=(1,None),doc="""
+        Number of processes to use for presenting the patterns
+        (see FeatureResponses.processes).""")
+
+    batch_size = param.Integer(default=0,bounds=(0,None),doc="""
+        If nonzero, the number of patterns for which to compute
+        linear responses at once, instead of presenting them (see
+        FeatureResponses.batch_size).""")
+
     __abstract = True
 
 
@@ -1136,7 +1469,8 @@ class MeasureResponseCommand(ParameterizedFunction):
         """Measure the response to the specified pattern and store the data in each sheet."""
         p=ParamOverrides(self,params)
         x=FeatureMaps(self._feature_list(p),name="FeatureMaps_for_"+self.name,
-                      sheet_views_prefix=p.sheet_views_prefix)
+                      sheet_views_prefix=p.sheet_views_prefix,processes=p.processes,
+                      batch_size=p.batch_size)
         static_params = dict([(s,p[s]) for s in p.static_parameters])
         if p.duration is not None:
             p.pattern_presenter.duration=p.duration
@@ -1286,7 +1620,8 @@ class FeatureCurveCommand(SinusoidalMeasureResponseCommand):
         curve_parameter.
         """
 
-        x=FeatureCurves(self._feature_list(p),sheet=sheet,x_axis=self.x_axis)
+        x=FeatureCurves(self._feature_list(p),sheet=sheet,x_axis=self.x_axis,
+                        processes=p.processes,batch_size=p.batch_size)
         for curve in p.curve_parameters:
             static_params = dict([(s,p[s]) for s in p.static_parameters])
             static_params.update(curve)
@@ -21,9 +21,10 @@ $Id$
 
 __version__ = '$Revision$'
 
+import os
 from copy import copy
 
-from numpy import abs,array,zeros,where,append
+from numpy import abs,array,zeros,empty,where,append,int32,arange,float64,asarray
 from numpy.oldnumeric import Float,Float32
 
 import param
@@ -158,6 +159,11 @@ class ConnectionField(object):
         
         WARNING: Any c-optimized code can bypass this property and
         access directly _has_norm_total, _norm_total
+
+        Note that for the CFs of a CFProjection, projection-level
+        functions (such as learning and weights output functions)
+        instead keep the norm_total of every CF in the projection's
+        norm_totals and has_norm_totals arrays.
        
         """)
 
@@ -308,6 +314,141 @@ class ConnectionField(object):
 
 
 
+class CFWeightStore(object):
+    """
+    Contiguous storage for the weights and masks of a list of ConnectionFields.
+
+    All the weights are copied into a single one-dimensional array
+    (and likewise for the masks), and each ConnectionField's weights
+    and mask are then replaced with views into those arrays, so that
+    the ConnectionFields themselves keep working as before.  An index
+    table records where each CF lives in the buffers:
+
+      offsets[i]  start of CF i's weights in the weights (and masks) array
+      sizes[i]    number of weights in CF i
+      slices[i]   CF i's input_sheet_slice, i.e. (r1,r2,c1,c2)
+
+    The shape of CF i's weights matrix is therefore
+    (r2-r1,c2-c1).  Null CFs (None) are stored with a size of zero
+    and an empty slice.
+
+    Optimized functions can use the buffers and the table to process
+    all the CFs in a projection as a single sweep through memory,
+    rather than looking up each CF's arrays individually.
+
+    Because each CF's weights are stored row by row, and the CFs one
+    after another, the weights buffer is also exactly the data array
+    of a sparse matrix in compressed sparse row (CSR) format with one
+    row per CF and one column per input unit; see csr_matrix().
+
+    Anything that replaces (rather than modifies in place) the
+    weights or mask array of a CF, or that adds or removes CFs, must
+    call pack() again afterwards to keep the store consistent.
+    """
+
+    def __init__(self,flatcfs):
+        self.pack(flatcfs)
+
+
+    def pack(self,flatcfs):
+        """
+        Copy the weights and masks of the given CFs into new contiguous
+        buffers, and make each CF's arrays views into them.
+        """
+        n_cfs = len(flatcfs)
+        self._csr = None
+        self.slices = zeros((n_cfs,4),dtype=int32)
+        self.sizes = zeros(n_cfs,dtype=int32)
+        for i,cf in enumerate(flatcfs):
+            if cf is not None:
+                self.slices[i] = cf.input_sheet_slice
+                self.sizes[i] = cf.weights.size
+
+        self.offsets = zeros(n_cfs,dtype=int32)
+        self.offsets[1:] = self.sizes.cumsum()[:-1]
+
+        n_weights = int(self.sizes.sum())
+        self.weights = zeros(n_weights,dtype=weight_type)
+        self.masks = zeros(n_weights,dtype=weight_type)
+
+        for i,cf in enumerate(flatcfs):
+            if cf is not None:
+                start,stop = self.offsets[i],self.offsets[i]+self.sizes[i]
+                self.weights[start:stop] = cf.weights.ravel()
+                self.masks[start:stop] = cf.mask.ravel()
+        self.attach(flatcfs)
+
+
+    def attach(self,flatcfs):
+        """
+        Make the weights and mask of each of the given CFs views into
+        the existing buffers, without copying anything (e.g. after
+        unpickling, when the CFs were saved without their arrays).
+        """
+        for i,cf in enumerate(flatcfs):
+            if cf is not None:
+                start,stop = self.offsets[i],self.offsets[i]+self.sizes[i]
+                cf.weights = self.weights[start:stop].reshape(self.shape(i))
+                cf.mask = self.masks[start:stop].reshape(self.shape(i))
+
+
+    def shape(self,i):
+        """Return the shape of the weights matrix of CF i."""
+        r1,r2,c1,c2 = self.slices[i]
+        return (r2-r1,c2-c1)
+
+
+    def csr_matrix(self,input_shape):
+        """
+        Return a scipy.sparse.csr_matrix of all the weights, with one
+        row per CF and one column per element of an input activity
+        array of shape input_shape.
+
+        The matrix's data array is the weights buffer itself, so
+        changes to the matrix's values and to the CFs' weights are
+        seen by both.  The matrix is built only once (until the next
+        pack()); requires scipy.
+        """
+        if self._csr is None or self._csr.shape[1]!=input_shape[0]*input_shape[1]:
+            from scipy.sparse import csr_matrix
+            icols = input_shape[1]
+            # For each weight: the CF it belongs to, its position in that
+            # CF, and hence its row and column in the input activity
+            cf = arange(len(self.sizes)).repeat(self.sizes)
+            position = arange(len(self.weights)) - self.offsets[cf]
+            r1,r2,c1,c2 = self.slices[cf].T
+            rows,cols = divmod(position,c2-c1)
+            indices = ((r1+rows)*icols + c1+cols).astype(int32)
+            indptr = append(self.offsets,len(self.weights)).astype(int32)
+            self._csr = csr_matrix((self.weights,indices,indptr),
+                                   shape=(len(self.sizes),input_shape[0]*input_shape[1]),
+                                   copy=False)
+        return self._csr
+
+
+    def nbytes(self):
+        return self.weights.nbytes + self.masks.nbytes + self.slices.nbytes + \
+               self.sizes.nbytes + self.offsets.nbytes
+
+
+    # The buffers are pickled instead of the CFs' own weights and
+    # masks (see CFProjection.__getstate__()), so that a
+    # memory-mapped snapshot maps them directly; the owning
+    # CFProjection attaches its CFs to them again on unpickling.
+    def __getstate__(self):
+        return dict([(name,getattr(self,name)) for name in
+                     ('weights','masks','slices','sizes','offsets')])
+
+    def __setstate__(self,state):
+        # (stores from older snapshots were saved empty)
+        if not state:
+            self.pack([])
+        else:
+            self.__dict__.update(state)
+            self._csr = None
+
+
+
 class CFPResponseFn(param.Parameterized):
     """
     Map an input activity matrix into an output matrix using the CFs
@@ -438,9 +579,10 @@ class CFPOF_Plugin(CFPOutputFn):
         if type(self.single_cf_fn) is not IdentityTF:
             single_cf_fn = self.single_cf_fn
 
+            has_norm_totals = iterator.has_norm_totals
             for cf,i in iterator():
                 single_cf_fn(cf.weights)
-                del cf.norm_total
+                has_norm_totals[i] = False
 
 
 class CFPOF_Identity(CFPOutputFn):
@@ -551,6 +693,14 @@ class CFProjection(Projection):
         The default of 1 gives a minimum matrix of 3x3. 0 would
         allow a 1x1 matrix.""")
 
+    pack_weights = param.Boolean(default=False,constant=True,doc="""
+        Whether to store the weights and masks of all CFs in one
+        contiguous CFWeightStore (available as weight_store), with
+        each ConnectionField's arrays being views into it.  Packed
+        weights use less memory for projections with many small CFs,
+        and allow optimized functions to process the whole projection
+        in one sweep through memory.""")
+
 
     precedence = param.Number(default=0.8)
 
@@ -625,8 +775,44 @@ class CFProjection(Projection):
         vectorized_create_cf = simple_vectorize(self._create_cf)
         self.cfs = vectorized_create_cf(*self._generate_coords())
         self.flatcfs = list(self.cfs.flat)
+        self._init_norm_totals(self.cfs.size)
+
+        if self.pack_weights:
+            self.weight_store = CFWeightStore(self.flatcfs)
+        else:
+            self.weight_store = None
 
         
+    def _init_norm_totals(self,n_cfs):
+        """
+        Create the arrays holding the norm_total of each of the n_cfs
+        CFs in flatcfs, for use by projection-level functions.
+
+        norm_totals[i] is the value for CF i if has_norm_totals[i] is
+        True (e.g. the sum of its weights as computed while learning,
+        or a joint sum across several projections); otherwise the sum
+        of CF i's weights should be used (see get_norm_totals()).  As
+        for ConnectionField.norm_total, anything that changes the
+        weights of a CF must reset its has_norm_totals entry.
+        """
+        self.norm_totals = zeros(n_cfs,dtype=float64)
+        self.has_norm_totals = zeros(n_cfs,dtype=bool)
+
+
+    def get_norm_totals(self,units):
+        """
+        Return an array of the norm_total of each of the given units
+        (indexes into flatcfs).
+        """
+        units = asarray(units,dtype=int)
+        norm_totals = self.norm_totals[units]
+        for j in (~self.has_norm_totals[units]).nonzero()[0]:
+            cf = self.flatcfs[units[j]]
+            if cf is not None:
+                norm_totals[j] = abs(cf.weights).sum()
+        return norm_totals
+
+
     def _create_cf(self,x,y):
         """
         Create a ConnectionField at x,y in the src sheet.
@@ -738,6 +924,47 @@ class CFProjection(Projection):
             of(MaskedCFIter(self,active_units_mask=active_units_mask))
 
 
+    def __getstate__(self):
+        """
+        Return the object's state (as in the superclass), except that
+        if there is a weight_store, the CFs are replaced by copies
+        without their weights and masks, which are saved only once,
+        in the store's buffers.
+        """
+        state = super(CFProjection,self).__getstate__()
+        if getattr(self,'weight_store',None) is not None and 'flatcfs' in state:
+            stripped = {}
+            for cf in state['flatcfs']:
+                if cf is not None:
+                    stripped[id(cf)] = copy(cf)
+                    stripped[id(cf)].weights = stripped[id(cf)].mask = None
+            strip = lambda cf: stripped.get(id(cf),cf)
+            state['flatcfs'] = [strip(cf) for cf in state['flatcfs']]
+            if 'cfs' in state:
+                cfs = state['cfs'].copy()
+                for i,cf in enumerate(cfs.flat):
+                    cfs.flat[i] = strip(cf)
+                state['cfs'] = cfs
+        return state
+
+
+    def __setstate__(self,state):
+        """
+        Restore the object's state (as in the superclass), then make
+        the CFs share a weight_store again if there is one.
+        """
+        super(CFProjection,self).__setstate__(state)
+        if getattr(self,'weight_store',None) is not None:
+            if len(self.weight_store.sizes)==len(self.flatcfs):
+                self.weight_store.attach(self.flatcfs)
+            else:
+                # (older snapshots saved the CFs' own arrays)
+                self.weight_store.pack(self.flatcfs)
+        # (snapshots from before norm_totals were held by the projection)
+        if 'norm_totals' not in state and 'flatcfs' in state:
+            self._init_norm_totals(len(self.flatcfs))
+
+
     # CEBALERT: see gc alert in simulation.__new__
     def _cleanup(self):
         for cf in self.cfs.flat:
@@ -771,17 +998,12 @@ class CFProjection(Projection):
     ## KKALERT: active_units_mask needs to be set explicitly (i.e. there's no default value) in
     ## order to maintain the same mask as MaskedCFIter when used to iterate over norm_totals
     def set_masked_norm_totals(self,norm_totals):
-        for (n,i) in zip(norm_totals,self.norm_total_posititions):
-            self.flatcfs[i].norm_total = n
+        self.norm_totals[self.norm_total_posititions] = norm_totals
+        self.has_norm_totals[self.norm_total_posititions] = True
     def get_masked_norm_totals(self,active_units_mask):
         iterator = MaskedCFIter(self,active_units_mask=active_units_mask)
-        self.norm_total_posititions = []
-        norm_totals = array([])
-        for (cf,i) in iterator():
-            self.norm_total_posititions.append(i)
-            norm_totals = append(norm_totals, cf.norm_total)
-
-        return norm_totals
+        self.norm_total_posititions = [i for (cf,i) in iterator()]
+        return self.get_norm_totals(self.norm_total_posititions)
 
 class MPI_CFProjection(CFProjection):
     
@@ -789,12 +1011,37 @@ class MPI_CFProjection(CFProjection):
     
     # pmi.execfile_ should be called exactly once
     pmi_initialised = param.Boolean(default=False)
+
+    nonblocking = param.Boolean(default=False,doc="""
+        Whether activate() should return as soon as the nodes have
+        computed their parts of the activity, without waiting for them
+        to be gathered onto the controller.  The controller can then
+        go on to activate the other projections into the dest sheet
+        while the activity is in transit, and the sheet waits for it
+        (see wait_for_activity()) only when combining the activity
+        of its projections.""")
+
+    decomposition = param.ObjectSelector(default='flat',objects=['flat','tiles'],
+                                         constant=True,doc="""
+        How the units of the dest sheet are divided among the nodes:
+        'flat' gives each node a contiguous range of the flattened
+        sheet (i.e. a band of rows), while 'tiles' gives each node a
+        2D tile of the sheet.  Each node is sent only the region of
+        the input read by its own CFs (its part of the sheet plus a
+        halo of about the CF radius), which for many nodes is much
+        smaller for tiles than for bands, reducing the input traffic
+        on each step.  Either way, the parts are chosen to have
+        roughly equal numbers of connections.""")
         
     def __init__(self,initialize_cfs=True, **params):
         self.pmiobj = pmi.create('MPI_CFProjection_node')
+        self._activity_pending = False
+        self._plans = {}
+        self._unit_order = None
         super(MPI_CFProjection,self).__init__(**params)
         
         self.init_activity(self.activity)
+        pmi.call(self.pmiobj,'_set_input_shape',self.src.activity.shape)
         
         self.mask = self.dest.mask
         self.allow_skip_non_responding_units = self.dest.allow_skip_non_responding_units
@@ -809,17 +1056,52 @@ class MPI_CFProjection(CFProjection):
     def __set_flatcfs(self,flatcfs):
         # It must be possible to avoid having two calls here (by somehow calling pmi from worker 0),
         # but I couldn't figure out how. However, this is only a "cosmetic" issue anyway
-        pmi.localcall(self.pmiobj,'_set_flatcfs_ref',flatcfs)
+        # The projections to a sheet settled on the nodes must all
+        # divide its units the same way (see MPI_Settling)
+        partition_key = self.dest.name if getattr(self.dest,'mpi_settle',False) else None
+        pmi.localcall(self.pmiobj,'_set_flatcfs_ref',flatcfs,self.dest.mask.data,
+                      self.decomposition,partition_key)
         pmi.call(self.pmiobj,'_set_flatcfs_chunk')
+        self._unit_order = pmi.localcall(self.pmiobj,'get_unit_order')
+        self.verbose("Units (first,number,connections) on each node: %s"%self.partition())
     def __get_flatcfs(self):
         flatcfs_list = pmi.invoke(self.pmiobj,'_get_flatcfs_chunk')
         flatcfs = []
         for flatcfs_row in flatcfs_list:
             flatcfs.extend(flatcfs_row)
+        if self._unit_order is not None:
+            node_flatcfs,flatcfs = flatcfs,[None]*len(flatcfs)
+            for i,cf in zip(self._unit_order,node_flatcfs):
+                flatcfs[i] = cf
         return copy(flatcfs)
     def __del_flatcfs(self):
         pmi.call(self.pmiobj,'_set_flatcfs_ref',None)
     flatcfs = property(__get_flatcfs,__set_flatcfs,__del_flatcfs)
+
+
+    def partition(self):
+        """
+        Return a list of the first unit, number of units, and number
+        of connections for each node.
+
+        The units are divided among the nodes in contiguous ranges or
+        in tiles (see decomposition) with roughly equal numbers of
+        connections, not counting units masked out of the dest sheet
+        when the CFs were first created.
+        """
+        return pmi.localcall(self.pmiobj,'get_partition')
+
+
+    def _set_from_nodes(self,a,values):
+        """
+        Set the elements of the array a from the flat array of values
+        gathered from the nodes (which are in the order of the nodes'
+        units; see decomposition).
+        """
+        if self._unit_order is None:
+            a.flat[:] = values
+        else:
+            a.flat[self._unit_order] = values
     
     
     def __set_strength(self,strength):
@@ -867,7 +1149,9 @@ class MPI_CFProjection(CFProjection):
         mask = mask_list[0]
         for mask_item in mask_list[1:]:
             mask.data = append(mask.data, mask_item.data,1)
-        mask.data = mask.data.reshape(self.mask_shape[0],self.mask_shape[1])
+        data = mask.data.ravel()
+        mask.data = zeros(self.mask_shape,dtype=data.dtype)
+        self._set_from_nodes(mask.data,data)
 
         return copy(mask)
     def __del_dest_mask(self):
@@ -1019,14 +1303,31 @@ class MPI_CFProjection(CFProjection):
     
     
 
+    def _pmi(self,pmi_fn,fn_name,*args,**kw):
+        # Make a per-step collective call to the nodes, recording it
+        # as (dest,projection,'pmi fn_name') if the simulation is
+        # being profiled (see topo.base.simulation.Profiler)
+        return self.dest._profiled(self.name,'pmi '+fn_name,pmi_fn,self.pmiobj,fn_name,*args,**kw)
+
+
+    def _pmi_plan(self,pmi_fn_name,fn_name,**kw):
+        # As _pmi(), but for a call whose arguments are the same every
+        # time: the call is recorded in a pmi.Plan the first time, so
+        # that afterwards only the plan's number has to be broadcast
+        # to the nodes.  The plans are discarded whenever the
+        # arguments change (see init_activity()).
+        plan = self._plans.get(fn_name)
+        if plan is None:
+            plan = self._plans[fn_name] = pmi.Plan()
+            getattr(plan,pmi_fn_name)(self.pmiobj,fn_name,**kw)
+        return self.dest._profiled(self.name,'pmi '+fn_name,plan)[0]
+
+
     def get_masked_norm_totals(self, active_units_mask):
-        norm_totals_list = pmi.invoke(self.pmiobj,"get_masked_norm_totals",active_units_mask)
-        norm_totals = numpy.array([])
-        for n in norm_totals_list:
-            norm_totals = numpy.append(norm_totals, n)
-        return norm_totals
+        return self._pmi(pmi.call,"get_masked_norm_totals",active_units_mask)
     def set_masked_norm_totals(self, norm_totals):
-        pmi.invoke(self.pmiobj,"set_masked_norm_totals",numpy.array(norm_totals))
+        pmi.localcall(self.pmiobj,"_set_norm_totals",norm_totals)
+        self._pmi_plan('call',"set_masked_norm_totals")
         
     
     def get_dest_mask(self):
@@ -1037,8 +1338,15 @@ class MPI_CFProjection(CFProjection):
         print "__init_activity(self): METHOD STUB"
         
     def activate(self, input_activity):
-        pmi.invoke_opt(pmiobj=self.pmiobj,fn_name='activate',data=input_activity,rbuf=self.activity_rbuf)
-        self.activity.flat[:] = self.activity_rbuf[0]
+        # (the input is scattered by the nodes themselves, see MPI_CFProjection_node.activate)
+        pmi.localcall(self.pmiobj,'_set_input',input_activity)
+        if self.nonblocking:
+            self.wait_for_activity()
+            self._pmi_plan('call','activate_nonblocking')
+            self._activity_pending = True
+        else:
+            self._pmi_plan('invoke_opt','activate',data=None,rbuf=self.activity_rbuf)
+            self._set_from_nodes(self.activity,self.activity_rbuf[0])
 
         """
         self.activity = numpy.array([])
@@ -1048,18 +1356,179 @@ class MPI_CFProjection(CFProjection):
         """
 
 
+    def wait_for_activity(self):
+        if self._activity_pending:
+            self._pmi(pmi.localcall,'wait_for_activity')
+            self._set_from_nodes(self.activity,self.activity_rbuf[0])
+            self._activity_pending = False
+
+
+    def gather_activity(self):
+        """
+        Gather this projection's activity from the nodes, when it has
+        been computed there without being sent to the controller (see
+        MPI_Settling).
+        """
+        self.wait_for_activity()
+        pmi.call(self.pmiobj,'gather_activity')
+        self._set_from_nodes(self.activity,self.activity_rbuf[0])
+
+
     def init_activity(self,activity):
+        self.wait_for_activity()
         self.activity = activity
         self.activity_rbuf = pmi.call(self.pmiobj,'_set_activity',activity)
         #for efficient MPI comms
+        self._plans = {}
 
         
     def learn(self):
-        pmi.call(self.pmiobj,'learn')
+        self.wait_for_activity()
+        self._pmi_plan('call','learn')
 
 
     def apply_learn_output_fns(self,active_units_mask=True):
-        pmi.invoke(self.pmiobj,'apply_learn_output_fns', active_units_mask)
+        self._pmi(pmi.invoke,'apply_learn_output_fns', active_units_mask)
+
+
+    # Parameters whose values are held by the nodes
+    _node_parameters = ['strength','n_units','allow_skip_non_responding_units',
+                        'response_fn','allow_null_cfs','nominal_bounds_template',
+                        'cf_shape','same_cf_shape_for_all_cfs','learning_fn',
+                        'learning_rate','weights_output_fns','coord_mapper',
+                        'autosize_mask','mask_threshold','apply_output_fns_init',
+                        'min_matrix_radius','mask_template','_slice_template']
+
+    def save_shards(self,basename):
+        """
+        Have each node save its own CFs to a separate file (named
+        basename.<rank>), and record a manifest of those files in this
+        projection, so that it can be pickled without gathering all
+        the CFs onto the controller (see load_shards()).
+        """
+        files = pmi.invoke(self.pmiobj,'_save_shard',basename)
+        self._shard_manifest = pmi.localcall(self.pmiobj,'_get_shard_manifest')
+        self._shard_manifest['files'] = files
+
+
+    def load_shards(self,dirname=''):
+        """
+        After unpickling, load the CFs saved by save_shards() from
+        the files in dirname, and restore the rest of the state held
+        by the nodes.
+
+        The number of nodes need not be the same as when the shards
+        were saved; the units are divided among the current nodes,
+        each of which reads the parts of the shards it needs.
+        """
+        m = self._shard_manifest
+        pmi.call(self.pmiobj,'_load_shards',[os.path.join(dirname,f) for f in m['files']],
+                 m['counts'],m['displs'],m['unit_costs'],m.get('order'),
+                 m.get('decomposition','flat'),m.get('sheet_shape'),m.get('partition_key'))
+        self._unit_order = pmi.localcall(self.pmiobj,'get_unit_order')
+
+        for name,value in self._node_state.items():
+            setattr(self,name,value)
+        del self._node_state
+
+        self.init_activity(self.activity)
+        pmi.call(self.pmiobj,'_set_input_shape',self.src.activity.shape)
+        self.mask = self.dest.mask
+        self.set_dest_ref()
+
+        # (cfs is not pickled; see __getstate__())
+        flatcfs = self.flatcfs
+        self.cfs = empty(len(flatcfs),dtype=object)
+        self.cfs[:] = flatcfs
+        self.cfs.shape = self.dest.shape
+
+
+    def __getstate__(self):
+        # The CFs are saved separately by the nodes (see
+        # save_shards()); cfs holds only the controller's copies from
+        # when they were created.
+        state = super(MPI_CFProjection,self).__getstate__()
+        for name in ('cfs','pmiobj','activity_rbuf','_activity_pending','_plans','_unit_order'):
+            state.pop(name,None)
+        state['_node_state'] = dict([(name,getattr(self,name)) for name in self._node_parameters])
+        return state
+
+
+    def __setstate__(self,state):
+        # Bypasses CFProjection.__setstate__(), because the CFs are
+        # not available until load_shards() is called.
+        self.pmiobj = pmi.create('MPI_CFProjection_node')
+        self._activity_pending = False
+        self._plans = {}
+        self._unit_order = None
+        super(CFProjection,self).__setstate__(state)
+
+
+
+class MPI_Settling(object):
+    """
+    Settles the activity of a sheet whose incoming projections are all
+    MPI_CFProjections on the MPI nodes, so that the controller is
+    involved only at the start and end rather than on every settling
+    step (see topo.sheet.lissom.LISSOM.mpi_settle).
+
+    The activity of the afferent projections must already have been
+    computed (by activating them as usual); the sheet's output_fns
+    and the activation of its lateral projections (those from the
+    sheet itself) are then applied on the nodes for each step.  Each
+    node applies the output_fns to its own units only, and a fresh
+    copy of them is sent to the nodes each time, so they must be
+    stateless TransferFns that process each unit independently of the
+    others (i.e. have _pointwise set); ValueError is raised otherwise.  Only the
+    settled activity of the sheet is sent to the controller; the
+    activity of the lateral projections can be fetched when needed
+    using their gather_activity() methods.
+    """
+
+    def __init__(self,sheet):
+        self.sheet = sheet
+        self.projections = list(sheet.in_connections)
+
+        def units(p):
+            order = p._unit_order
+            return ([(first,count) for first,count,cost in p.partition()],
+                    None if order is None else order.tolist())
+
+        for p in self.projections:
+            if not isinstance(p,MPI_CFProjection):
+                raise ValueError("Settling on the MPI nodes requires all the projections to %s to be MPI_CFProjections, but %s is not."%(sheet.name,p.name))
+            if p.activity_group[1] is not numpy.add or p.activity_group != self.projections[0].activity_group:
+                raise ValueError("Settling on the MPI nodes requires all the projections to %s to be summed in the same activity_group, but %s is not."%(sheet.name,p.name))
+            if units(p) != units(self.projections[0]):
+                raise ValueError("Settling on the MPI nodes requires all the projections to %s to divide its units among the nodes in the same way, but %s does not (mpi_settle must be set before the projections are connected)."%(sheet.name,p.name))
+        self._check_output_fns()
+
+        self.pmiobj = pmi.create('MPI_Settling_node')
+        pmi.call(self.pmiobj,'set_shape',sheet.shape)
+        for p in self.projections:
+            pmi.call(self.pmiobj,'add_projection',p.pmiobj,p.src is sheet)
+
+
+    def _check_output_fns(self):
+        # (TransferFnWithState lives in topo.transferfn, which imports
+        # this module)
+        from topo.transferfn.basic import TransferFnWithState
+        for of in self.sheet.output_fns:
+            if isinstance(of,TransferFnWithState) or not getattr(of,'_pointwise',False):
+                raise ValueError("Settling on the MPI nodes requires the output_fns of %s to be stateless and to process each unit independently of the others, but %s is not known to be."%(self.sheet.name,of.__class__.__name__))
+
+
+    def __call__(self,steps):
+        """Settle for the given number of steps, setting the sheet's activity."""
+        for p in self.projections:
+            p.wait_for_activity()
+        # (output_fns may have been changed since __init__())
+        self._check_output_fns()
+        output_fns = self.sheet.output_fns if self.sheet.apply_output_fns else []
+
+        activity = self.sheet._profiled(self.sheet.name,'pmi settle',pmi.call,
+                                        self.pmiobj,'settle',steps,output_fns)
+        self.projections[0]._set_from_nodes(self.sheet.activity,activity)
 
 
 # CEB: have not yet decided proper location for this method
@@ -1109,6 +1578,9 @@ class CFIter(object):
     def __init__(self,cfprojection,active_units_mask=False,ignore_sheet_mask=False):
 
         self.flatcfs = cfprojection.flatcfs
+        self.weight_store = getattr(cfprojection,'weight_store',None)
+        self.norm_totals = cfprojection.norm_totals
+        self.has_norm_totals = cfprojection.has_norm_totals
 
         self.activity = cfprojection.get_dest_activity_opt()
         self.mask = cfprojection.get_dest_mask()
@@ -1298,6 +1770,10 @@ class ResizableCFProjection(CFProjection):
                                        mask=mask_template,
                                        output_fns=output_fns,
                                        min_matrix_radius=self.min_matrix_radius)
+        self.has_norm_totals[:] = False
+
+        if self.weight_store is not None:
+            self.weight_store.pack(self.flatcfs)
 
 
     def change_density(self, new_wt_density):
@@ -32,6 +32,12 @@ class TransferFn(param.Parameterized):
     # term for it, general to output functions?  JAB: Please do rename it!
     norm_value = param.Parameter(default=None)
 
+    # Whether each element of the output depends only on the same
+    # element of the input, so that the function can be applied
+    # separately to any parts of a matrix (e.g. on different MPI
+    # nodes; see topo.base.cf.MPI_Settling).
+    _pointwise = False
+
 
     def __call__(self,x):
         raise NotImplementedError
@@ -48,6 +54,7 @@ class IdentityTF(TransferFn):
     derive other classes from this object, modify it to have different
     behavior, add side effects, or anything of that nature.
     """
+    _pointwise = True
 
     def __call__(self,x,sum=None):
         pass
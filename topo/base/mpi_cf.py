@@ -1,6 +1,7 @@
 from mpi4py import MPI
 
-import numpy as np,copy
+import numpy as np,copy,os
+import cPickle as pickle
 
 
 from topo.base.cf import CFProjection, MaskedCFIter
@@ -12,23 +13,167 @@ import topo.transferfn.projfn
 
 activity_sum = None
 
-
-
+# Partitions (counts, displs, order) shared by all the projections to
+# the same sheet, by sheet name (see MPI_Settling_node)
+_shared_partitions = {}
+
+
+
+def _partition(n,size):
+    """
+    Return the counts and displacements (as used by Scatterv and
+    Gatherv) that divide n items among size nodes: each node gets n/size
+    items, except the last, which also gets any that are left over.
+    """
+    items_per_node = n/size
+    counts = np.array([items_per_node]*(size-1) + [n-items_per_node*(size-1)],dtype='i')
+    displs = np.arange(size,dtype='i')*items_per_node
+    return counts,displs
+
+
+def _balanced_partition(costs,size):
+    """
+    Return the counts and displacements that divide items with the
+    given costs among size nodes in contiguous ranges of roughly
+    equal total cost (giving each node at least one item, if there
+    are enough).
+    """
+    n = len(costs)
+    total = float(np.sum(costs))
+    if n == 0 or total == 0:
+        return _partition(n,size)
+
+    # first item of each node after the first
+    k = np.arange(1,size)
+    starts = np.searchsorted(np.cumsum(costs,dtype=float),total*k/size,side='right')
+    if n >= size:
+        starts = k + np.maximum.accumulate(np.clip(starts-k,0,n-size))
+
+    displs = np.concatenate(([0],starts)).astype('i')
+    counts = np.diff(np.concatenate((displs,[n]))).astype('i')
+    return counts,displs
+
+
+def _tile_partition(costs,shape,size):
+    """
+    Return the order, counts and displacements that divide the units
+    of a sheet of the given shape, with the given (flattened) costs,
+    among size nodes in 2D tiles of roughly equal total cost.
+
+    The tiles form a grid whose number of rows and columns is chosen
+    to keep the tiles as close to square as possible.  The sheet rows
+    are first divided into bands of roughly equal cost (one per row
+    of tiles), and then each band is divided by columns.  order lists
+    the units (indexes into the flattened sheet) of each node in turn,
+    row by row within each tile, and counts and displs then refer to
+    that order (as used by Scatterv and Gatherv).
+    """
+    rows,cols = shape
+    costs = np.asarray(costs,dtype=float).reshape(shape)
+
+    # number of tile rows and columns giving the smallest tile perimeter
+    tile_rows = min([r for r in range(1,size+1) if size%r==0],
+                    key=lambda r: rows/float(r) + cols/float(size/r))
+    tile_cols = size/tile_rows
+
+    order = []
+    band_counts,band_displs = _balanced_partition(costs.sum(axis=1),tile_rows)
+    for r1,n_rows in zip(band_displs,band_counts):
+        band = costs[r1:r1+n_rows]
+        tile_counts,tile_displs = _balanced_partition(band.sum(axis=0),tile_cols)
+        for c1,n_cols in zip(tile_displs,tile_counts):
+            order.append((np.arange(r1,r1+n_rows)[:,np.newaxis]*cols +
+                          np.arange(c1,c1+n_cols)).ravel())
+
+    counts = np.array([len(units) for units in order],dtype='i')
+    displs = np.concatenate(([0],np.cumsum(counts)[:-1])).astype('i')
+    return np.concatenate(order).astype(int),counts,displs
+
+
+
+def _read_shards(filenames,counts,displs,order,units):
+    """
+    Return the CFs of the given units (indexes into the flattened
+    sheet), from the shards saved by MPI_CFProjection_node._save_shard()
+    in filenames, where shard i holds units displs[i] to
+    displs[i]+counts[i] (of order, if the units were in tiles).
+
+    Only the shards holding some of the units are read.
+    """
+    # position of each unit in the list returned, or -1
+    position = -np.ones(np.sum(counts),dtype=int)
+    position[units] = np.arange(len(units))
+
+    flatcfs = [None]*len(units)
+    for filename,shard_start,shard_count in zip(filenames,displs,counts):
+        if order is None:
+            shard_units = np.arange(shard_start,shard_start+shard_count)
+        else:
+            shard_units = order[shard_start:shard_start+shard_count]
+        if (position[shard_units] >= 0).any():
+            f = open(filename,'rb')
+            shard_units,cfs = pickle.load(f)
+            f.close()
+            # (shards saved as the index of their first unit)
+            if np.isscalar(shard_units):
+                shard_units = np.arange(shard_units,shard_units+len(cfs))
+            for i,cf in zip(position[shard_units],cfs):
+                if i >= 0:
+                    flatcfs[i] = cf
+    return flatcfs
+
+
+
+# All the per-step traffic (input activity, dest activity, and
+# norm_totals) uses the buffer-based MPI collectives on float buffers
+# allocated when the projection is connected, avoiding pickling.
+#
+# The units of the dest sheet are divided among the nodes either in
+# contiguous ranges of the flattened sheet, or in 2D tiles (see
+# MPI_CFProjection.decomposition).  For tiles, order lists the units
+# of each node in turn, and everything exchanged with the controller
+# (activity, mask, CFs) is in that order; for ranges, order is None.
+# Either way, each node is sent only the region of the input read by
+# its own CFs (its part of the dest sheet plus a halo of about the CF
+# radius; see _set_input_window()), rather than the whole input.
 class MPI_CFProjection_node(CFProjection):
     def __init__(self):
+        # Parameterized.__init__() is not called, but constant
+        # parameters still have to be settable from the controller
+        self.initialized = False
         self.comm = MPI.COMM_WORLD
         self.rank = self.comm.Get_rank()
         self.size = self.comm.Get_size()
 
         self.input_buffer = None
+        self.counts = None
+        self.displs = None
+        self.order = None
+        self.decomposition = 'flat'
+        self.sheet_shape = None
+        self.partition_key = None
+        self.input_window_count = 0
+        self.node_costs = None
+        self.unit_costs = None
+        self.activity_rbuf = None
+        self.gather_request = None
 
         #self.activity_copy = numpy.array([])
         
         
 
     #KKALERT: same as CFProjection activate except for return
-    def activate(self,input_activity):
-        """Activate using the specified response_fn and output_fn."""
+    def activate(self,input_activity=None):
+        """
+        Activate using the specified response_fn and output_fn.
+
+        If input_activity is None, this node's region of it is
+        scattered from the controller's input buffer (see
+        _set_input()).
+        """
+        if input_activity is None:
+            self._scatter_input()
+            input_activity = self.input_activity
 
         self.input_buffer = input_activity
         self.activity *=0.0
@@ -39,9 +184,44 @@ class MPI_CFProjection_node(CFProjection):
             of(self.activity)
 
         return [self.activity,MPI.DOUBLE]
+
+
+    def activate_nonblocking(self):
+        """
+        Activate as for activate(), but start gathering the activity
+        onto the controller without waiting for it to arrive, so that
+        the nodes can go on to other work (e.g. activating the next
+        projection) in the meantime.  See wait_for_activity().
+        """
+        # self.activity is the send buffer of any earlier gather
+        self.wait_for_activity()
+        self.activate()
+        self.gather_request = self.comm.Igatherv([self.activity,MPI.DOUBLE],
+                                                 self.activity_rbuf,root=0)
+
+
+    def wait_for_activity(self):
+        """
+        Wait for the gather started by activate_nonblocking() to
+        complete (on the controller, until the activity is in the
+        receive buffer; on the other nodes, until it has been sent).
+        """
+        if self.gather_request is not None:
+            self.gather_request.Wait()
+            self.gather_request = None
+
+
+    def gather_activity(self):
+        """
+        Gather the activity onto the controller, for when it was
+        computed without being gathered (see MPI_Settling_node).
+        """
+        self.wait_for_activity()
+        self.comm.Gatherv([self.activity,MPI.DOUBLE],self.activity_rbuf,root=0)
             
 
     def learn(self):
+        self.wait_for_activity()
         if self.input_buffer != None:
             dest_activity = self.get_dest_activity_opt()
             
@@ -68,97 +248,259 @@ class MPI_CFProjection_node(CFProjection):
         self.dest_ref = dest
 
     def get_dest_activity_opt(self):
-        self.comm = MPI.COMM_WORLD
-
+        """Scatter the dest activity from the controller, returning this node's part."""
         if self.rank == 0:
-            activity = self.dest_ref.activity
-            items_per_node = int(round(activity.size/self.size))
-            data = []
-            start_i = 0
-            for i in range(self.size):
-                if i+1 < self.size:
-                    data.append(activity.flat[start_i : start_i+items_per_node])
-                else:
-                    data.append(activity.flat[start_i : ])
-                start_i+=items_per_node
+            activity = np.ascontiguousarray(self.dest_ref.activity,dtype=np.float64).ravel()
+            if self.order is not None:
+                activity = activity[self.order]
+            sendbuf = [activity,(self.counts,self.displs),MPI.DOUBLE]
         else:
-            data = None
-        
-        activity = self.comm.scatter(data, root = 0)
-        return activity
+            sendbuf = None
+
+        self.comm.Scatterv(sendbuf,[self.dest_activity,MPI.DOUBLE],root=0)
+        return self.dest_activity
         
 
     def get_dest_activity(self):
+        """Broadcast the whole dest activity from the controller, returning this node's part."""
         if self.rank == 0:
-            activity = self.dest_ref.activity
+            self.dest_activity_all[:] = self.dest_ref.activity.ravel()
+
+        self.comm.Bcast([self.dest_activity_all,MPI.DOUBLE],root=0)
+
+        return self._local_part(self.dest_activity_all)
+
+
+    def _units(self,rank):
+        """Return the indexes (into the flattened sheet) of the given node's units."""
+        start,count = self.displs[rank],self.counts[rank]
+        if self.order is None:
+            return np.arange(start,start+count)
         else:
-            activity = None
+            return self.order[start:start+count]
 
-        activity = self.comm.bcast(obj=activity, root=0)
-        
-        items_per_node = int(round(activity.size/self.size))
-        if self.rank+1<self.size:
-            activity_chunk = activity.reshape(1,activity.size)[0][self.rank * items_per_node : (self.rank+1) * items_per_node]
+    def _local_units(self):
+        """Return the indexes (into the flattened sheet) of this node's units."""
+        return self._units(self.rank)
+
+    def _local_part(self,a):
+        """Return this node's part of the flattened sheet array a."""
+        start,count = self.displs[self.rank],self.counts[self.rank]
+        if self.order is None:
+            return a[start:start+count]
         else:
-            activity_chunk = activity.reshape(1,activity.size)[0][self.rank * items_per_node : ]
-        return activity_chunk
+            return a[self.order[start:start+count]]
     
     
-    def _set_flatcfs_ref(self, flatcfs_ref):
+    def _set_flatcfs_ref(self, flatcfs_ref, sheet_mask=None, decomposition='flat', partition_key=None):
         self.flatcfs_ref = flatcfs_ref
+        self.sheet_mask_ref = sheet_mask
+        self.decomposition = decomposition
+        self.partition_key = partition_key
+        if sheet_mask is not None:
+            self.sheet_shape = sheet_mask.shape
     def _set_flatcfs_chunk(self):
+        # The units are divided among the nodes the first time the CFs
+        # are distributed, and then the same partition is used for
+        # everything else (activity, mask, norm_totals, learning).
         if self.rank == 0:
-            #there should be a better way of distributing these
-            items_per_node = len(self.flatcfs_ref)/self.size
-            data = []
-            start_i = 0
-            for i in range(self.size):
-                if i+1 < self.size:
-                    data.append(self.flatcfs_ref[start_i : start_i+items_per_node])
-                else:
-                    data.append(self.flatcfs_ref[start_i : ])
-                start_i+=items_per_node
+            if self.counts is None:
+                self._set_partition(self._unit_costs())
+            if self.order is None:
+                flatcfs = self.flatcfs_ref
+            else:
+                flatcfs = [self.flatcfs_ref[i] for i in self.order]
+            data = [flatcfs[start:start+count] for start,count in zip(self.displs,self.counts)]
+            partition = (self.counts,self.displs,self.order,self.node_costs,self.partition_key)
         else:
             data = None
+            partition = None
+        self.counts,self.displs,self.order,self.node_costs,self.partition_key = self.comm.bcast(partition, root=0)
+        if self.partition_key is not None:
+            _shared_partitions[self.partition_key] = (self.counts,self.displs,self.order)
         self.flatcfs = self.comm.scatter(data, root = 0)
+        self._init_norm_totals(len(self.flatcfs))
+        self._set_input_window()
+
+
+    def _set_input_window(self):
+        """
+        Find the region of the input sheet read by this node's CFs,
+        i.e. its part of the dest sheet plus a halo of about the CF
+        radius, and set up the buffers for scattering each node's
+        region of the input (see _scatter_input()).
+        """
+        slices = [cf.input_sheet_slice for cf in self.flatcfs if cf is not None]
+        if len(slices) > 0:
+            slices = np.array(slices)
+            window = (slices[:,0].min(),slices[:,1].max(),slices[:,2].min(),slices[:,3].max())
+        else:
+            window = (0,0,0,0)
+        self.input_window = window
+        self.input_window_count += 1
+        r1,r2,c1,c2 = window
+        self.window_buf = np.zeros((r2-r1)*(c2-c1))
+
+        windows = self.comm.gather(window,root=0)
+        if self.rank == 0:
+            self.input_windows = windows
+            self.window_counts = np.array([(r2-r1)*(c2-c1) for r1,r2,c1,c2 in windows],dtype='i')
+            self.window_displs = np.concatenate(([0],np.cumsum(self.window_counts)[:-1])).astype('i')
+            self.window_sendbuf = np.zeros(self.window_counts.sum())
+
+    def _scatter_input(self):
+        """
+        Send each node the region of the controller's input buffer
+        read by its CFs (see _set_input_window()), copying it into
+        that node's input buffer.  The rest of the input buffer is
+        never read on the nodes other than the controller.
+        """
+        if self.rank == 0:
+            for (r1,r2,c1,c2),start,count in zip(self.input_windows,self.window_displs,self.window_counts):
+                self.window_sendbuf[start:start+count] = self.input_activity[r1:r2,c1:c2].ravel()
+            sendbuf = [self.window_sendbuf,(self.window_counts,self.window_displs),MPI.DOUBLE]
+        else:
+            sendbuf = None
+
+        self.comm.Scatterv(sendbuf,[self.window_buf,MPI.DOUBLE],root=0)
+
+        if self.rank != 0:
+            r1,r2,c1,c2 = self.input_window
+            self.input_activity[r1:r2,c1:c2] = self.window_buf.reshape(r2-r1,c2-c1)
+
+    def _unit_costs(self):
+        """
+        Return the work for each unit: the number of connections in
+        its CF (zero for null CFs, or for units masked out of the
+        sheet).
+        """
+        costs = np.array([0 if cf is None else (cf.mask if cf.mask is not None else cf.weights).ravel().nonzero()[0].size
+                          for cf in self.flatcfs_ref])
+        if self.sheet_mask_ref is not None:
+            costs *= self.sheet_mask_ref.ravel()!=0
+        return costs
+
+    def _set_partition(self,costs):
+        # The projections to a sheet with a partition_key all use the
+        # partition of the first one (see MPI_Settling_node)
+        self.unit_costs = costs
+        shared = _shared_partitions.get(self.partition_key)
+        if shared is not None and shared[0].sum() == len(costs):
+            self.counts,self.displs,self.order = shared
+        elif self.decomposition == 'tiles' and self.sheet_shape is not None:
+            self.order,self.counts,self.displs = _tile_partition(costs,self.sheet_shape,self.size)
+        else:
+            self.order = None
+            self.counts,self.displs = _balanced_partition(costs,self.size)
+        if self.partition_key is not None:
+            _shared_partitions[self.partition_key] = (self.counts,self.displs,self.order)
+
+        if self.order is not None:
+            costs = costs[self.order]
+        self.node_costs = [int(costs[start:start+count].sum())
+                           for start,count in zip(self.displs,self.counts)]
+
+    def _get_partition(self,n):
+        if self.counts is None or self.counts.sum()!=n:
+            self.counts,self.displs = _partition(n,self.size)
+            self.order = None
+        return self.counts,self.displs
+
+    def get_partition(self):
+        """
+        Return the first unit, number of units, and cost (number of
+        connections) for each node.
+        """
+        if self.order is None:
+            first = self.displs
+        else:
+            first = [self.order[start] if count > 0 else None
+                     for start,count in zip(self.displs,self.counts)]
+        return zip(first,self.counts,self.node_costs or [None]*self.size)
+    def get_unit_order(self):
+        return self.order
     def _get_flatcfs_chunk(self):
         return self.flatcfs
 
+
+    def _save_shard(self,basename):
+        """
+        Save this node's CFs (and the indexes of their units) to its
+        own file, returning the file's name.
+        """
+        filename = "%s.%d"%(basename,self.rank)
+        f = open(filename,'wb')
+        pickle.dump((self._local_units(),self.flatcfs),f,2)
+        f.close()
+        return os.path.basename(filename)
+
+    def _get_shard_manifest(self):
+        return dict(counts=self.counts,displs=self.displs,order=self.order,
+                    unit_costs=self.unit_costs,decomposition=self.decomposition,
+                    sheet_shape=self.sheet_shape,partition_key=self.partition_key)
+
+    def _load_shards(self,filenames,counts,displs,unit_costs,order=None,
+                     decomposition='flat',sheet_shape=None,partition_key=None):
+        """
+        Load this node's CFs from shards saved by _save_shard() on
+        (possibly a different number of) nodes, where shard i holds
+        units displs[i] to displs[i]+counts[i] (of order, if the units
+        were divided into tiles).
+
+        The units are first divided among the current nodes, based on
+        unit_costs; each node then reads only the shards that overlap
+        its own units.
+        """
+        if unit_costs is None:
+            unit_costs = np.ones(np.sum(counts),dtype=int)
+        self.decomposition = decomposition
+        self.sheet_shape = sheet_shape
+        self.partition_key = partition_key
+        self._set_partition(unit_costs)
+
+        self.flatcfs = _read_shards(filenames,counts,displs,order,self._local_units())
+        self._init_norm_totals(len(self.flatcfs))
+        self._set_input_window()
+
     
     def _set_activity(self, activity):
+        self.wait_for_activity()
         if activity==None:
             self.activity = None
         else:
-            activity_copy = activity.copy()
-            activity_copy = activity_copy.ravel()
-            items_per_node = activity_copy.size / self.size
-            if self.rank+1<self.size:
-                self.activity = activity_copy[self.rank * items_per_node : (self.rank+1) * items_per_node]
-            else:
-                self.activity = activity_copy[self.rank * items_per_node : ]
+            self._get_partition(activity.size)
+            count = self.counts[self.rank]
+            self.activity = np.array(self._local_part(activity.ravel()))
+
+            # receive buffers for the per-step collectives
+            self.dest_activity = np.zeros(count)
+            self.dest_activity_all = np.zeros(activity.size)
+            self.norm_totals_all = np.zeros(activity.size)
+            self.norm_totals_chunk = np.zeros(count)
+            self.norm_counts = np.zeros(self.size,dtype='i')
+            self.norm_displs = np.zeros(self.size,dtype='i')
 
             if self.rank==0:
                 #recvcounts and displacements, for MPI Gatherv
-                counts = np.array([items_per_node]*(self.size-1) + 
-                                  [activity_copy.size - items_per_node*(self.size-1)])
-                displs = np.arange(0,activity_copy.size,items_per_node)[:self.size]
-                return [activity_copy,(counts,displs),MPI.DOUBLE]
-            #self.activity_copy = self.activity.copy()
-            
+                self.activity_rbuf = [np.zeros(activity.size),(self.counts,self.displs),MPI.DOUBLE]
+                return self.activity_rbuf
+
+
+    def _set_input_shape(self,shape):
+        self.input_activity = np.zeros(shape)
+
+    def _set_input(self,input_activity):
+        # Controller only: fill the buffer to be scattered by activate()
+        self.input_activity[:] = input_activity
 
-    
 
     def _set_dest_mask(self,dest_mask):
         if dest_mask == None:
             self.mask = None
         else:
-            items_per_node = int(round(dest_mask.data.size / self.size))
+            self._get_partition(dest_mask.data.size)
             self.mask = copy.copy(dest_mask)
-            self.mask.data = self.mask.data.reshape(1,self.mask.data.size)
-            if self.rank+1<self.size:
-                self.mask.data = self.mask.data[0][self.rank * items_per_node : (self.rank+1) * items_per_node]
-            else:
-                self.mask.data = self.mask.data[0][self.rank * items_per_node :]
+            self.mask.data = self._local_part(self.mask.data.ravel())
     def _get_dest_mask(self):
         return self.mask
         
@@ -249,31 +591,48 @@ class MPI_CFProjection_node(CFProjection):
     
     
     
-    def set_masked_norm_totals(self,norm_totals):
+    def _set_norm_totals(self,norm_totals):
+        # Controller only: fill the buffer to be scattered by set_masked_norm_totals()
+        self.norm_totals_all[:len(norm_totals)] = norm_totals
+
+    def set_masked_norm_totals(self):
+        """
+        Scatter the norm_totals from the controller's buffer (see
+        _set_norm_totals()) the same way they were gathered by
+        get_masked_norm_totals().
+        """
         if self.rank == 0:
-            data = self.norm_sizes
+            sendbuf = [self.norm_totals_all,(self.norm_counts,self.norm_displs),MPI.DOUBLE]
         else:
-            data = None
-        (start_i, end_i) = self.comm.scatter(data, root=0)
-        norm_totals_chunk = norm_totals[start_i:end_i]
+            sendbuf = None
+        norm_totals_chunk = self.norm_totals_chunk[:self.n_norm_totals]
+        self.comm.Scatterv(sendbuf,[norm_totals_chunk,MPI.DOUBLE],root=0)
         super(MPI_CFProjection_node,self).set_masked_norm_totals(norm_totals_chunk)
             
     def get_masked_norm_totals(self,active_units_mask):
+        """
+        Gather the norm_totals of the CFs included by
+        active_units_mask on all the nodes, returning them on the
+        controller.
+        """
         norm_totals = super(MPI_CFProjection_node,self).get_masked_norm_totals(active_units_mask=active_units_mask)
-        norm_size = len(norm_totals)
+        norm_totals = np.ascontiguousarray(norm_totals,dtype=np.float64)
         
-        # the following algorithm saves the number of unmasked non-totals on each node in order
+        # the number of unmasked norm_totals on each node is saved in order
         # to distribute them on set_masked_norm_totals the same way they were gathered
-        norm_size = self.comm.gather(norm_size, root=0)
+        self.n_norm_totals = len(norm_totals)
+        self.comm.Gather([np.array([self.n_norm_totals],dtype='i'),MPI.INT],
+                         [self.norm_counts,MPI.INT],root=0)
         
         if self.rank == 0:
-            self.norm_sizes = []
-            start_i = 0
-            for n in norm_size:
-                self.norm_sizes.append((start_i, start_i+n))
-                start_i += n
+            self.norm_displs[1:] = self.norm_counts.cumsum()[:-1]
+            recvbuf = [self.norm_totals_all,(self.norm_counts,self.norm_displs),MPI.DOUBLE]
+        else:
+            recvbuf = None
+        self.comm.Gatherv([norm_totals,MPI.DOUBLE],recvbuf,root=0)
         
-        return norm_totals
+        if self.rank == 0:
+            return self.norm_totals_all[:self.norm_counts.sum()].copy()
 
     def set_fake_src(self,fake_src):
         self.fake_src = fake_src
@@ -292,3 +651,132 @@ class MPI_CFProjection_node(CFProjection):
 
     """<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< GETTERS AND SETTERS <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<"""
     
+
+
+
+class MPI_Settling_node(object):
+    """
+    The nodes' part of settling the activity of a sheet whose
+    projections are all MPI_CFProjections, without involving the
+    controller on each step (see topo.sheet.lissom.LISSOM.mpi_settle).
+
+    On each step, each node sums the activity of its own units from
+    all the projections, applies the sheet's output_fns, and then
+    sends the other nodes the parts of the result read by their
+    lateral CFs (and receives the parts of theirs read by its own),
+    before activating its lateral projections for the next step.
+    Only the settled activity is gathered onto the controller.
+
+    All the projections must divide the units among the nodes in the
+    same way, which they do if they share a partition_key.
+    """
+    def __init__(self):
+        self.comm = MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+
+        self.shape = None
+        self.projections = []
+        self.lateral = []
+        self.halo_key = None
+
+
+    def set_shape(self,shape):
+        self.shape = shape
+        self.halo_key = None
+
+    def add_projection(self,projection,lateral):
+        self.projections.append(projection)
+        if lateral:
+            self.lateral.append(projection)
+        self.halo_key = None
+
+
+    def _set_halo(self):
+        """
+        Work out which of this node's units are read by each node's
+        lateral CFs (those in that node's input window), and which of
+        each node's units are read by this node's own lateral CFs, and
+        allocate the buffers for exchanging them (see settle()).
+        """
+        p = self.projections[0]
+        self.activity = np.zeros(p.counts[self.rank])
+        self.sheet_activity = np.zeros(self.shape)
+        if self.rank == 0:
+            self.activity_rbuf = [np.zeros(p.counts.sum()),(p.counts,p.displs),MPI.DOUBLE]
+        else:
+            self.activity_rbuf = None
+
+        # union of the input windows of the lateral projections
+        windows = [q.input_window for q in self.lateral if q.input_window != (0,0,0,0)]
+        if len(windows) > 0:
+            windows = np.array(windows)
+            window = (windows[:,0].min(),windows[:,1].max(),windows[:,2].min(),windows[:,3].max())
+        else:
+            window = (0,0,0,0)
+
+        def inside(units,window):
+            r1,r2,c1,c2 = window
+            rows,cols = divmod(units,self.shape[1])
+            return (rows>=r1) & (rows<r2) & (cols>=c1) & (cols<c2)
+
+        units = p._local_units()
+        send = [np.nonzero(inside(units,w))[0] for w in self.comm.allgather(window)]
+        recv = [p._units(rank)[inside(p._units(rank),window)] for rank in range(self.size)]
+
+        self.send_positions = np.concatenate(send).astype(int)
+        self.send_buf = np.zeros(len(self.send_positions))
+        self.send_counts = np.array([len(x) for x in send],dtype='i')
+        self.send_displs = np.concatenate(([0],np.cumsum(self.send_counts)[:-1])).astype('i')
+        self.recv_units = np.concatenate(recv).astype(int)
+        self.recv_buf = np.zeros(len(self.recv_units))
+        self.recv_counts = np.array([len(x) for x in recv],dtype='i')
+        self.recv_displs = np.concatenate(([0],np.cumsum(self.recv_counts)[:-1])).astype('i')
+
+    def _exchange_halo(self):
+        """
+        Fill the part of sheet_activity read by this node's lateral
+        CFs from the activity of the nodes owning those units.
+        """
+        self.send_buf[:] = self.activity[self.send_positions]
+        self.comm.Alltoallv([self.send_buf,(self.send_counts,self.send_displs),MPI.DOUBLE],
+                            [self.recv_buf,(self.recv_counts,self.recv_displs),MPI.DOUBLE])
+        self.sheet_activity.flat[self.recv_units] = self.recv_buf
+
+
+    def settle(self,steps,output_fns):
+        """
+        Compute the activity of the sheet over the given number of
+        settling steps, starting from the current activity of the
+        afferent projections (and no lateral activity), and return it
+        (in the projections' order of units) on the controller.
+
+        As for the steps driven by the controller, the lateral
+        projections are finally activated by the settled activity, so
+        that they have it as their input when learning.
+        """
+        # (the input windows change if the CFs are redistributed)
+        halo_key = tuple(q.input_window_count for q in self.lateral)
+        if halo_key != self.halo_key:
+            self._set_halo()
+            self.halo_key = halo_key
+
+        for q in self.lateral:
+            q.wait_for_activity()
+            q.activity *= 0.0
+
+        for step in range(steps):
+            self.activity *= 0.0
+            for q in self.projections:
+                self.activity += q.activity
+            for of in output_fns:
+                of(self.activity)
+
+            if len(self.lateral) > 0:
+                self._exchange_halo()
+                for q in self.lateral:
+                    q.activate(self.sheet_activity)
+
+        self.comm.Gatherv([self.activity,MPI.DOUBLE],self.activity_rbuf,root=0)
+        if self.rank == 0:
+            return self.activity_rbuf[0]
@@ -8,7 +8,7 @@ __version__='$Revision$'
 
 from math import pi
 
-from numpy import add,subtract,cos,sin
+from numpy import add,subtract,cos,sin,newaxis,ndarray,empty
 
 import param
 from param.parameterized import ParamOverrides
@@ -28,6 +28,38 @@ from functionfamily import TransferFn
 # them be used like the current ones.
 # (PatternGenerator-->TwoDPatternGenerator?)
 
+# Cache of the sheet coordinates of the columns and rows of pattern
+# matrices, keyed by bounds and density.  During training and map
+# measurement, patterns are generated over and over with the same few
+# bounds and densities, so constructing a SheetCoordinateSystem each
+# time is wasted work.
+_coordinate_vectors_cache = {}
+_coordinate_vectors_cache_size = 64
+
+def _coordinate_vectors(bounds,xdensity,ydensity):
+    """
+    Return the x and y sheet coordinates of the columns and rows of a
+    matrix with the given bounds and density, as returned by
+    SheetCoordinateSystem.sheetcoordinates_of_matrixidx().
+
+    The arrays returned are shared, and so are read-only.
+    """
+    key = (bounds.lbrt(),xdensity,ydensity)
+    try:
+        return _coordinate_vectors_cache[key]
+    except KeyError:
+        pass
+
+    x_points,y_points = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
+    x_points.flags.writeable = False
+    y_points.flags.writeable = False
+
+    if len(_coordinate_vectors_cache) >= _coordinate_vectors_cache_size:
+        _coordinate_vectors_cache.clear()
+    _coordinate_vectors_cache[key] = x_points,y_points
+    return x_points,y_points
+
+
 # JLALERT: PatternGenerator should have
 # override_plasticity_state/restore_plasticity_state functions which
 # can override the plasticity of any output_fn that has state, in case
@@ -159,7 +191,7 @@ class PatternGenerator(param.Parameterized):
         # will be sampled.
 
         # CB: note to myself - use slice_._scs if supplied?
-        x_points,y_points = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
+        x_points,y_points = _coordinate_vectors(bounds,xdensity,ydensity)
             
         # Generate matrices of x and y sheet coordinates at which to
         # sample pattern, at the correct orientation
@@ -180,21 +212,56 @@ class PatternGenerator(param.Parameterized):
         """
         raise NotImplementedError
 
-        
+
+    # Parameters read by _support_radius(), other than size.
+    _support_parameters = []
+
+    def _support_radius(self,p,cutoff):
+        """
+        Return the distance from the pattern center beyond which
+        function() is below cutoff everywhere, or None if the pattern
+        does not fall off like that (the default).
+
+        Subclasses whose patterns are spatially localized can override
+        this (and list the parameters it uses in _support_parameters)
+        so that they can be evaluated only in a box around their
+        center, e.g. by Composite.
+        """
+        return None
+
+
     def _create_and_rotate_coordinate_arrays(self, x, y, orientation):
         """
         Create pattern matrices from x and y vectors, and rotate
         them to the specified orientation.
+
+        The matrices from the previous call are reused if they are
+        the right shape, so the pattern_x and pattern_y arrays are
+        only valid until the next call.
         """
-        # Using this two-liner requires that x increase from left to
-        # right and y decrease from left to right; I don't think it
-        # can be rewritten in so little code otherwise - but please
-        # prove me wrong.
-        pattern_y = subtract.outer(cos(orientation)*y, sin(orientation)*x)
-        pattern_x = add.outer(sin(orientation)*y, cos(orientation)*x)
+        shape = (len(y),len(x))
+        pattern_x = self._coordinate_buffer('pattern_x',shape)
+        pattern_y = self._coordinate_buffer('pattern_y',shape)
+
+        # Using these two lines (outer products) requires that x
+        # increase from left to right and y decrease from left to
+        # right; I don't think it can be rewritten in so little code
+        # otherwise - but please prove me wrong.
+        subtract((cos(orientation)*y)[:,newaxis], sin(orientation)*x, pattern_y)
+        add((sin(orientation)*y)[:,newaxis], cos(orientation)*x, pattern_x)
         return pattern_x, pattern_y
 
 
+    def _coordinate_buffer(self,name,shape):
+        # Return the array self.<name> if it can be overwritten with a
+        # coordinate matrix of the given shape, or else a new array.
+        buf = self.__dict__.get(name)
+        if not (isinstance(buf,ndarray) and buf.shape==shape and
+                buf.dtype==float and buf.flags.writeable):
+            buf = empty(shape)
+        return buf
+
+
     def _apply_mask(self,p,mat):
         """Create (if necessary) and apply the mask to the given matrix mat."""
         mask = p.mask
@@ -243,8 +310,9 @@ class Constant(PatternGenerator):
     # coordinate transformations (which would have no effect anyway)
     def __call__(self,**params_to_override):
         p = ParamOverrides(self,params_to_override)
-        
-        shape = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape
+
+        x_points,y_points = _coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+        shape = (len(y_points),len(x_points))
 
         result = p.scale*ones(shape, Float)+p.offset
         self._apply_mask(p,result)
@@ -220,6 +220,19 @@ class Projection(EPConnection):
         """
         raise NotImplementedError
 
+
+    def wait_for_activity(self):
+        """
+        Wait until the activity computed by the last call to activate()
+        is available.
+
+        Projections that compute their activity asynchronously (so
+        that several projections can be activated at once) must
+        override this method; for others, the activity is available
+        as soon as activate() returns.
+        """
+        pass
+
     
     def learn(self):
         """
@@ -481,12 +494,13 @@ class ProjectionSheet(Sheet):
             tmp_activity = self.activity.copy() * 0.0
             
             for proj in tmp_dict[priority]:
+                proj.wait_for_activity()
                 tmp_activity += proj.activity
             self.activity=tmp_dict[priority][0].activity_group[1](self.activity,tmp_activity)
         
         if self.apply_output_fns:
             for of in self.output_fns:
-                of(self.activity)
+                self._profiled(of.__class__.__name__,'output_fn',of,self.activity)
     
         self.send_output(src_port='Activity',data=self.activity)
     
@@ -518,8 +532,8 @@ class ProjectionSheet(Sheet):
             if not isinstance(proj,Projection):
                 self.debug("Skipping non-Projection "+proj.name)
             else:
-                proj.learn()
-                proj.apply_learn_output_fns()
+                self._profiled(proj.name,'learn',proj.learn)
+                self._profiled(proj.name,'learn_output_fns',proj.apply_learn_output_fns)
 
 
     def present_input(self,input_activity,conn):
@@ -530,7 +544,7 @@ class ProjectionSheet(Sheet):
         The sheet's own activity is not calculated until activate()
         is called.
         """
-        conn.activate(input_activity)
+        self._profiled(conn.name,'activate',conn.activate,input_activity)
 
 
     def projections(self,name=None):
@@ -59,7 +59,7 @@ from param.parameterized import as_uninitialized,OptionalSingleton
 
 from copy import copy, deepcopy
 import time
-import bisect
+from heapq import heappush, heappop, heapify
 
 # JABALERT: Are these used for anything?
 SLEEP_EXCEPTION = "Sleep Exception"
@@ -216,6 +216,18 @@ class EventProcessor(param.Parameterized):
         raise NotImplementedError
 
 
+    def _profiled(self,item,operation,fn,*args,**kw):
+        """
+        Return fn(*args,**kw), recording the time taken under the key
+        (self.name,item,operation) if the simulation is being
+        profiled (see Profiler).
+        """
+        profiler = getattr(self.simulation,'profiler',None)
+        if profiler is None:
+            return fn(*args,**kw)
+        return profiler.call((self.name,item,operation),fn,*args,**kw)
+
+
     def process_current_time(self):
         """
         Called by the simulation before advancing the simulation
@@ -412,6 +424,10 @@ class Event(object):
         else:
             return 0
 
+    def _profile_key(self):
+        # (see Profiler)
+        return ('Simulation',self.__class__.__name__,'event')
+
 
 class EPConnectionEvent(Event):
     """
@@ -440,6 +456,9 @@ class EPConnectionEvent(Event):
     def __call__(self,sim):
         self.conn.dest.input_event(self.conn,self.data)
 
+    def _profile_key(self):
+        return (self.conn.dest.name,self.conn.name,'input_event')
+
     def __repr__(self):
         return "EPConnectionEvent(time="+`self.time`+",conn="+`self.conn`+")"
 
@@ -514,6 +533,10 @@ class FunctionEvent(Event):
     def __call__(self,sim):
         self.fn(*self.args,**self.kw)
 
+    def _profile_key(self):
+        owner = getattr(getattr(self.fn,'im_self',None),'name','Simulation')
+        return (owner,getattr(self.fn,'__name__',repr(self.fn)),'event')
+
     def __repr__(self):
         return 'FunctionEvent(%s,%s,*%s,**%s)' % (`self.time`,`self.fn`,`self.args`,`self.kw`)
 
@@ -586,6 +609,155 @@ class PeriodicEventSequence(EventSequence):
         return 'PeriodicEventSequence(%s,%s,%s)' % (`self.time`,`self.period`,`self.sequence`)
 
 
+
+class EventQueue(object):
+    """
+    Priority queue of Events, ordered by time.
+
+    Simultaneous events are kept in the order in which they were
+    added (i.e. they are processed FIFO).  The events are stored in a
+    binary heap of (time,sequence_number,event) entries, so adding
+    an event and removing the earliest one each take O(log N) time.
+
+    Indexing and iteration give the events in time order, as for a
+    sorted list; looking at the earliest event (queue[0]) is cheap,
+    but any other access requires sorting the whole queue.
+    """
+
+    def __init__(self,events=()):
+        self._heap = []
+        self._count = 0
+        for event in events:
+            self.push(event)
+
+    def push(self,event):
+        """Add event to the queue, after any others with the same time."""
+        heappush(self._heap,(event.time,self._count,event))
+        self._count+=1
+
+    def pop(self):
+        """Remove and return the earliest event."""
+        return heappop(self._heap)[2]
+
+    def remove_if(self,condition):
+        """Remove all the events for which condition(event) is true."""
+        self._heap = [entry for entry in self._heap if not condition(entry[2])]
+        heapify(self._heap)
+
+    def _sorted(self):
+        return [entry[2] for entry in sorted(self._heap)]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __getitem__(self,index):
+        if index==0 and self._heap:
+            return self._heap[0][2]
+        return self._sorted()[index]
+
+    def __iter__(self):
+        return iter(self._sorted())
+
+    def __repr__(self):
+        return 'EventQueue(%s)' % (`self._sorted()`)
+
+
+
+class Profiler(object):
+    """
+    Accumulates the number of calls and the total wall-clock time
+    spent in each part of a simulation.
+
+    To profile a simulation, set its profiler attribute to a Profiler
+    instance (e.g. topo.sim.profiler=Profiler()), run the simulation,
+    and then print profiler.table() or use profiler.save_json(); set
+    profiler back to None to stop.  While profiler is None, the cost
+    is one attribute check per timed call.
+
+    Times are recorded under keys (owner,item,operation), where owner
+    is usually the name of an EventProcessor, item the name of a
+    Projection or function (or ''), and operation the kind of work
+    done, e.g. ('V1','LateralInhibitory','learn').  The Simulation
+    records:
+
+      ('Simulation','','run')           each call to run()
+      (dest,connection,'input_event')   delivery of an EPConnectionEvent
+      (ep,function,'event')             other events (e.g. input generation)
+      (ep,'','process_current_time')    end-of-timestep processing for each EP
+      (dest,connection,'connect')       creating a connection (e.g. its CFs)
+
+    and ProjectionSheets and Projections add their own entries (for
+    activating, learning, output functions, and so on).  Entries
+    overlap (e.g. 'input_event' includes the Projection's 'activate'),
+    so they are not meant to be summed.
+    """
+    # CB: not a Parameterized for the same reason as Event
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discard all the recorded times."""
+        self.calls = {}
+        self.times = {}
+
+    def add(self,key,duration,calls=1):
+        """Record calls taking duration seconds in total under key."""
+        self.calls[key] = self.calls.get(key,0)+calls
+        self.times[key] = self.times.get(key,0.0)+duration
+
+    def call(self,key,fn,*args,**kw):
+        """Return fn(*args,**kw), recording the time taken under key."""
+        start = time.time()
+        try:
+            return fn(*args,**kw)
+        finally:
+            self.add(key,time.time()-start)
+
+    def results(self):
+        """
+        Return a list of dictionaries, one for each key, giving the
+        owner, item, operation, number of calls, total time (s),
+        time per call (s), and percentage of the time spent in
+        Simulation.run(), ordered by decreasing total time.
+        """
+        run_time = self.times.get(('Simulation','','run'),0.0)
+        results = []
+        for key,total in self.times.items():
+            calls = self.calls[key]
+            results.append(dict(owner=key[0],item=key[1],operation=key[2],
+                                calls=calls,total=total,
+                                per_call=total/calls if calls else 0.0,
+                                percent=100.0*total/run_time if run_time else 0.0))
+        results.sort(key=lambda r: -r['total'])
+        return results
+
+    def table(self,n=None):
+        """
+        Return the results() (or the first n of them) as a string
+        formatted as a table.
+        """
+        lines = ["%-20s %-24s %-22s %8s %11s %13s %7s"%
+                 ("Owner","Item","Operation","Calls","Total (s)","Per call (ms)","% run")]
+        for r in self.results()[:n]:
+            lines.append("%-20s %-24s %-22s %8d %11.3f %13.3f %7.1f"%
+                         (r['owner'],r['item'],r['operation'],r['calls'],
+                          r['total'],1000*r['per_call'],r['percent']))
+        return "\n".join(lines)
+
+    def save_json(self,filename):
+        """Save the results() to the specified file, in JSON format."""
+        try:
+            import json
+        except ImportError: # Python 2.5
+            import simplejson as json
+        f = open(filename,'w')
+        try:
+            json.dump(self.results(),f,indent=1)
+        finally:
+            f.close()
+
+
 # CB: code that previously existed in various places now collected
 # together. The original timing code was not properly tested, and the
 # current code has not been tested either: needs writing cleanly and
@@ -734,15 +906,14 @@ class SomeTimer(param.Parameterized):
 
 
 
-# Simulation stores its events in a linear-time priority queue (i.e., a
-# sorted list.) For efficiency, e.g. for spiking neuron simulations,
-# we'll probably need to replace the linear priority queue with a more
-# efficient one.  Jeff has an O(log N) minheap implementation, but
-# there are likely to be many others to select from.
+# Simulation stores its events in an O(log N) priority queue (a
+# minheap; see EventQueue), so that long queues (e.g. for spiking
+# neuron simulations, or many delayed connections) remain cheap to
+# maintain.
 #
 class Simulation(param.Parameterized,OptionalSingleton):
     """
-    A simulation class that uses a simple sorted event list (instead of
+    A simulation class that uses a simple event queue (instead of
     e.g. a sched.scheduler object) to manage events and dispatching.
 
     Simulation is a singleton: there is only one instance of
@@ -826,6 +997,11 @@ class Simulation(param.Parameterized,OptionalSingleton):
         and reloading a series of simulations without polluting the
         memory space with unused simulations.""")
 
+    profiler = param.Parameter(default=None,doc="""
+        If not None, a Profiler in which to accumulate the time spent
+        in each part of the simulation (e.g. in each Projection's
+        activation and learning) whenever run() is called.""")
+
     startup_commands = param.Parameter(instantiate=True,default=[],doc="""
         List of string commands that will be exec'd in
         __main__.__dict__ (i.e. as if they were entered at the
@@ -853,6 +1029,9 @@ class Simulation(param.Parameterized,OptionalSingleton):
     
     eps_to_start = []
 
+    # Time at which the current (or last) call to run() stops
+    _stop_time = Forever
+
     name = param.Parameter(constant=False)
 
 
@@ -989,7 +1168,7 @@ class Simulation(param.Parameterized,OptionalSingleton):
             param.Dynamic.time_fn = self.time
 
 
-        self.events = [] # CB: consider collections.deque? (PEP 290)
+        self.events = EventQueue()
         self._events_stack = []
         self.eps_to_start = []
         self.item_scale=1.0 # this variable determines the size of each item in a diagram
@@ -1005,6 +1184,16 @@ class Simulation(param.Parameterized,OptionalSingleton):
                                simulation_time_fn=self.time)
 
 
+    def __setstate__(self,state):
+        # Snapshots saved before EventQueue was introduced store the
+        # events as sorted lists.
+        if isinstance(state.get('events'),list):
+            state['events'] = EventQueue(state['events'])
+            state['_events_stack'] = [(t,EventQueue(events))
+                                      for t,events in state.get('_events_stack',[])]
+        super(Simulation,self).__setstate__(state)
+
+
     def __getitem__(self,item_name):
         """
         Return item_name if it exists as an EventProcessor in
@@ -1201,6 +1390,9 @@ class Simulation(param.Parameterized,OptionalSingleton):
 
         self.eps_to_start=[]
 
+        profiler = self.profiler
+        if profiler is not None:
+            run_start = time.time()
         
         # Complicated expression for min(time+duration,until)
         if duration == Forever:
@@ -1209,6 +1401,8 @@ class Simulation(param.Parameterized,OptionalSingleton):
             stop_time = self._time + duration
         else:
             stop_time = min(self._time+duration,until) 
+
+        self._stop_time = stop_time
             
         did_event = False
 
@@ -1218,7 +1412,7 @@ class Simulation(param.Parameterized,OptionalSingleton):
             if self.events[0].time < self._time:
                 # Warn and then discard events scheduled *before* the current time
                 self.warning('Discarding stale (unprocessed) event',repr(self.events[0]))
-                self.events.pop(0)
+                self.events.pop()
                 
             elif self.events[0].time > self._time:
                 # Before moving on to the next time, do any processing
@@ -1229,7 +1423,10 @@ class Simulation(param.Parameterized,OptionalSingleton):
                     did_event = False
                     #self.debug("Time to sleep; next event time: %s",self.timestr(self.events[0].time))
                     for ep in self._event_processors.values():
-                        ep.process_current_time()
+                        if profiler is None:
+                            ep.process_current_time()
+                        else:
+                            profiler.call((ep.name,'','process_current_time'),ep.process_current_time)
                     
                 # Set the time to the frontmost event.  Bear in mind
                 # that the front event may have been changed by the
@@ -1239,9 +1436,12 @@ class Simulation(param.Parameterized,OptionalSingleton):
                 
             else:
                 # Pop and call the event at the head of the queue.
-                event = self.events.pop(0)
+                event = self.events.pop()
                 self.debug(lambda:"Delivering %s"%(event))
-                event(self)
+                if profiler is None:
+                    event(self)
+                else:
+                    profiler.call(event._profile_key(),event,self)
                 did_event=True
 
 
@@ -1255,6 +1455,9 @@ class Simulation(param.Parameterized,OptionalSingleton):
         if stop_time != Forever :
             self._time = stop_time
 
+        if profiler is not None:
+            profiler.add(('Simulation','','run'),time.time()-run_start)
+
     def sleep(self,delay):
         """
         Advance the simulator time by the specified amount.
@@ -1269,22 +1472,9 @@ class Simulation(param.Parameterized,OptionalSingleton):
         Enqueue an Event at an absolute simulation clock time.
         """
         assert isinstance(event,Event)
-
-        if not self.events or event >= self.events[-1]:
-            # The new event goes at the end of the event queue if there
-            # isn't a queue right now, or if it's later than the last
-            # event's time. 
-            self.events.append(event)
-        elif event < self.events[0]:
-            # If it's earlier than the first item it goes at the beginning.
-            self.events.insert(0,event)
-        else:
-            # Otherwise, it's inserted at the appropriate
-            # position somewhere inside the event queue.
-            # New events are enqueued after (right of) existing
-            # events with the same time, i.e. 'simultaneous' events
-            # are executed FIFO.
-            bisect.insort_right(self.events,event)
+        # New events are enqueued after existing events with the same
+        # time, i.e. 'simultaneous' events are executed FIFO.
+        self.events.push(event)
 
     def schedule_command(self,time,command_string):
         """
@@ -1336,7 +1526,7 @@ class Simulation(param.Parameterized,OptionalSingleton):
         # CBALERT: does it make more sense to put the original events onto the
         # stack, and replace self.events with the copies? Not sure this makes
         # any practical difference currently.
-        self._events_stack.append((self._time,[copy(event) for event in self.events]))
+        self._events_stack.append((self._time,EventQueue([copy(event) for event in self.events])))
 
 
     def event_pop(self):
@@ -1358,11 +1548,7 @@ class Simulation(param.Parameterized,OptionalSingleton):
         function, then clear out the events that should be deleted, do the measurement or 
         analysis, and then do state_pop to restore the original state.
         """
-        events_temp = []
-        for e in self.events:
-            if not isinstance(e,event_type):
-                events_temp = events_temp + [e]
-        self.events = events_temp
+        self.events.remove_if(lambda e: isinstance(e,event_type))
 
 
 
@@ -1384,7 +1570,11 @@ class Simulation(param.Parameterized,OptionalSingleton):
             conn_params['name'] = src+'To'+dest
 
         # Looks up src and dest in our dictionary of objects
-        conn = connection_type(src=self[src],dest=self[dest],**conn_params)
+        if self.profiler is None:
+            conn = connection_type(src=self[src],dest=self[dest],**conn_params)
+        else:
+            conn = self.profiler.call((dest,conn_params['name'],'connect'),connection_type,
+                                      src=self[src],dest=self[dest],**conn_params)
         self[src]._src_connect(conn)
         self[dest]._dest_connect(conn)
         return conn
@@ -328,7 +328,8 @@ class measure_rfs(SingleInputResponseCommand):
     def __call__(self,**params):
         p=ParamOverrides(self,params)
         self.params('input_sheet').compute_default()
-        x=ReverseCorrelation(self._feature_list(p),input_sheet=p.input_sheet)
+        x=ReverseCorrelation(self._feature_list(p),input_sheet=p.input_sheet,
+                               batch_size=p.batch_size)
         static_params = dict([(s,p[s]) for s in p.static_parameters])
     
         if p.duration is not None:
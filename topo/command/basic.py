@@ -6,7 +6,7 @@ __version__='$Revision$'
 
 import cPickle as pickle
 
-import os,sys,re,string,time,platform
+import os,sys,re,string,time,platform,mmap
 
 import __main__
 
@@ -16,6 +16,9 @@ try:
 except ImportError:
     pass
 
+import numpy
+from numpy import ndarray, memmap, asarray, ascontiguousarray, uint8
+
 import param
 from param.parameterized import PicklableClassAttributes, ParameterizedFunction
 from param.parameterized import ParamOverrides
@@ -127,6 +130,10 @@ class ImportErrorObject(object):
     # error (rather than covering call, getitem, getattr, and maybe
     # other things I've forgotten about).
     def __getattr__(self,name):
+        # (private and special attributes are looked up without an
+        # instance having been initialized, e.g. when unpickling)
+        if name.startswith('_'):
+            raise AttributeError(name)
         return self._raise()
     def __getitem__(self,i):
         self._raise()
@@ -282,12 +289,105 @@ class UnpickleEnvironmentCreator(object):
 
         
 
-def save_snapshot(snapshot_name=None):
+# Snapshots saved with memory_map=True start with this line, giving the
+# position in the file of the array data
+_ARRAY_SNAPSHOT_HEADER = "Topographica snapshot with separate array data at %020d\n"
+
+# Smallest array (in number of elements) stored separately
+_min_separate_array_size = 16
+
+
+def _dump_with_separate_arrays(obj,filename):
+    """
+    Pickle obj to the file filename, storing the data of the NumPy
+    arrays it contains after the pickle, uncompressed and aligned,
+    rather than in the pickle itself.
+
+    The file is written under a temporary name and then renamed, so
+    that any arrays still mapped from an existing file of the same
+    name are unaffected.
+    """
+    arrays = []
+    pids = {}
+    size = [0]
+    def persistent_id(x):
+        if not (type(x) is ndarray or type(x) is memmap) or x.dtype.hasobject or \
+               x.dtype.fields is not None or x.size < _min_separate_array_size:
+            return None
+        pid = pids.get(id(x))
+        if pid is None:
+            offset = size[0] + (-size[0])%16
+            size[0] = offset + x.nbytes
+            # (x is kept so that its id is not reused during pickling)
+            arrays.append((offset,x))
+            pid = pids[id(x)] = (offset,x.dtype.str,x.shape)
+        return pid
+
+    tmp_filename = filename+".tmp"
+    f = open(tmp_filename,'wb')
+    try:
+        f.write(" "*len(_ARRAY_SNAPSHOT_HEADER%0))
+        pickler = pickle.Pickler(f,2)
+        pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+
+        data_start = f.tell() + (-f.tell())%mmap.ALLOCATIONGRANULARITY
+        for offset,x in arrays:
+            f.seek(data_start+offset)
+            f.write(ascontiguousarray(x).data)
+        f.seek(0)
+        f.write(_ARRAY_SNAPSHOT_HEADER%data_start)
+    finally:
+        f.close()
+    os.rename(tmp_filename,filename)
+
+
+def _load_with_separate_arrays(f,filename):
+    """
+    Unpickle an object saved by _dump_with_separate_arrays() from the
+    open file f (positioned just after the header) for file filename.
+
+    The arrays are memory-mapped copy-on-write from the file, so they
+    are read from disk only when they are first accessed, and can be
+    modified without affecting the file.
+    """
+    f.seek(0)
+    data_start = int(f.readline().split()[-1])
+    data = []
+    # (arrays that were shared when saved are shared again)
+    loaded = {}
+    def persistent_load(pid):
+        offset,dtype,shape = pid
+        if offset not in loaded:
+            if not data:
+                data.append(asarray(memmap(filename,dtype=uint8,mode='c',offset=data_start)))
+            dtype = numpy.dtype(dtype)
+            nbytes = dtype.itemsize*int(numpy.prod(shape))
+            loaded[offset] = data[0][offset:offset+nbytes].view(dtype).reshape(shape)
+        return loaded[offset]
+
+    unpickler = pickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+def save_snapshot(snapshot_name=None,memory_map=False):
     """
     Save a snapshot of the network's current state.
 
     The snapshot is saved as a gzip-compressed Python binary pickle.
 
+    If memory_map is True, the snapshot is instead saved uncompressed,
+    with the data of all but the smallest NumPy arrays (e.g. the CF
+    weights) stored together after the pickle of the rest of the
+    simulation.  Such snapshots are larger but much faster to save,
+    and load_snapshot() memory-maps the arrays rather than reading
+    them, so that loading is nearly instant and the arrays are read
+    from disk only as they are used.  The snapshot file must then not
+    be deleted or overwritten in place while the simulation is in use
+    (save_snapshot() itself replaces rather than overwrites an
+    existing file).
+
     As this function uses Python's 'pickle' module, it is subject to
     the same limitations (see the pickle module's documentation) -
     with the notable exception of class attributes. Python does not
@@ -309,6 +409,12 @@ def save_snapshot(snapshot_name=None):
 
     from topo.misc.commandline import global_params
 
+    # Projections distributed over MPI nodes save their CFs in
+    # separate files alongside the snapshot, one per node.
+    for p in topo.sim.connections():
+        if hasattr(p,'save_shards'):
+            p.save_shards("%s.%s.%s"%(normalize_path(snapshot_name),p.dest.name,p.name))
+
     topo.sim.RELEASE=topo.release
     topo.sim.VERSION=topo.version
 
@@ -318,6 +424,10 @@ def save_snapshot(snapshot_name=None):
                topoPOclassattrs,
                topo.sim)
 
+    if memory_map:
+        _dump_with_separate_arrays(to_save,normalize_path(snapshot_name))
+        return
+
     try:
         snapshot_file=gzip.open(normalize_path(snapshot_name),'wb',compresslevel=5)
     except NameError:
@@ -339,16 +449,25 @@ def load_snapshot(snapshot_name):
 
     snapshot_name = param.resolve_path(snapshot_name)
 
-    # If it's not gzipped, open as a normal file.
-    try:
-        snapshot = gzip.open(snapshot_name,'r')
-        snapshot.read(1)
-        snapshot.seek(0)
-    except (IOError,NameError):
-        snapshot = open(snapshot_name,'r')
+    # Snapshots saved with memory_map=True are recognized by their
+    # header. If it's not gzipped, open as a normal file.
+    snapshot = open(snapshot_name,'rb')
+    header = _ARRAY_SNAPSHOT_HEADER%0
+    separate_arrays = snapshot.read(len(header)).startswith(header.split(" at ")[0])
+    if not separate_arrays:
+        snapshot.close()
+        try:
+            snapshot = gzip.open(snapshot_name,'r')
+            snapshot.read(1)
+            snapshot.seek(0)
+        except (IOError,NameError):
+            snapshot = open(snapshot_name,'r')
 
     try:
-        pickle.load(snapshot)
+        if separate_arrays:
+            _load_with_separate_arrays(snapshot,snapshot_name)
+        else:
+            pickle.load(snapshot)
     except:
         import traceback
 
@@ -363,6 +482,11 @@ Loading error:
 
         param.Parameterized(name="load_snapshot").warning(m)
 
+    else:
+        # (topo.sim is only the loaded simulation if unpickling worked)
+        for p in topo.sim.connections():
+            if hasattr(p,'load_shards') and getattr(p,'_shard_manifest',None) is not None:
+                p.load_shards(os.path.dirname(snapshot_name))
 
     snapshot.close()
 
@@ -628,6 +752,10 @@ class run_batch(ParameterizedFunction):
 
     snapshot=param.Boolean(True)
 
+    snapshot_memory_map = param.Boolean(default=False,doc="""
+        Whether to save the snapshot in the uncompressed format whose
+        arrays can be memory-mapped when loaded (see save_snapshot).""")
+
     vc_info=param.Boolean(True)
 
     dirname_prefix = param.String(default="",doc="""
@@ -775,7 +903,7 @@ class run_batch(ParameterizedFunction):
                     "Elapsed real time %02d:%02d." % (int(elapsedtime/60),int(elapsedtime%60)))
     
             if p['snapshot']:
-               save_snapshot()
+               save_snapshot(memory_map=p['snapshot_memory_map'])
                 
         except:
             error_count+=1
@@ -31,9 +31,9 @@ class CFPLF_Hebbian_opt(CFPLearningFn):
     Implemented in C for speed.  Should be equivalent to
     CFPLF_Plugin(single_cf_fn=Hebbian), except faster.
 
-    As a side effect, sets the norm_total attribute on any cf whose
-    weights are updated during learning, to speed up later operations
-    that might depend on it.
+    As a side effect, stores the norm_total of any cf whose weights
+    are updated during learning in the projection's norm_totals, to
+    speed up later operations that might depend on it.
 
     May return without modifying anything if the learning rate turns
     out to be zero.
@@ -45,7 +45,14 @@ class CFPLF_Hebbian_opt(CFPLearningFn):
         if single_connection_learning_rate==0:
             return
 
+        if iterator.weight_store is not None:
+            self._packed_call(iterator, input_activity, output_activity,
+                              single_connection_learning_rate)
+            return
+
         cfs = iterator.flatcfs
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
         num_cfs = len(cfs)
         irows,icols = input_activity.shape
         cf_type = iterator.cf_type
@@ -104,20 +111,82 @@ class CFPLF_Hebbian_opt(CFPLearningFn):
                     }
 
                     // store the sum of the cf's weights
-                    PyObject *total_obj = PyFloat_FromDouble(total);  //(new ref)
-                    PyObject_SetAttrString(cf,"_norm_total",total_obj);
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_True);
-                    Py_DECREF(total_obj);
+                    norm_totals[r] = total;
+                    has_norm_totals[r] = 1;
                 }
             }
         """
 
         inline(code, ['input_activity', 'output_activity','sheet_mask','num_cfs',
-                      'icols', 'cfs', 'single_connection_learning_rate','cf_type'],
+                      'icols', 'cfs', 'single_connection_learning_rate','cf_type',
+                      'norm_totals','has_norm_totals'],
                local_dict=locals(),
                headers=['<structmember.h>'])               
 
 
+    def _packed_call(self, iterator, input_activity, output_activity, single_connection_learning_rate):
+        """
+        Same as __call__, but for CFs whose weights and masks are
+        packed into a CFWeightStore, so that the CF objects are not
+        accessed at all.
+        """
+        irows,icols = input_activity.shape
+        store = iterator.weight_store
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
+        weights = store.weights
+        masks = store.masks
+        offsets = store.offsets
+        slices = store.slices
+        num_cfs = len(offsets)
+        sheet_mask = iterator.get_sheet_mask()
+
+        code = c_header + """
+            npfloat *x = output_activity;
+            npfloat *m = sheet_mask;
+
+            for (int r=0; r<num_cfs; ++r) {
+                double load = *x++;
+                double msk = *m++;
+                if (load != 0 && msk != 0) {
+                    load *= single_connection_learning_rate;
+
+                    float *wi = weights + offsets[r];
+                    float *mi = masks + offsets[r];
+                    int *input_sheet_slice = slices + 4*r;
+
+                    UNPACK_FOUR_TUPLE(int,rr1,rr2,cc1,cc2,input_sheet_slice);
+
+                    double total = 0.0;
+
+                    // modify non-masked weights
+                    npfloat *inpj = input_activity+icols*rr1+cc1;
+                    for (int i=rr1; i<rr2; ++i) {
+                        npfloat *inpi = inpj;
+                        for (int j=cc1; j<cc2; ++j) {
+                            if (*(mi++) >= 0.000001) {
+                                *wi += load * *inpi;
+                                total += fabs(*wi);
+                            }
+                            ++wi;
+                            ++inpi;
+                        }
+                        inpj += icols;
+                    }
+
+                    // store the sum of the cf's weights
+                    norm_totals[r] = total;
+                    has_norm_totals[r] = 1;
+                }
+            }
+        """
+
+        inline(code, ['input_activity', 'output_activity','sheet_mask','num_cfs',
+                      'icols', 'weights', 'masks', 'offsets', 'slices',
+                      'single_connection_learning_rate','norm_totals','has_norm_totals'],
+               local_dict=locals())
+
+
 class CFPLF_Hebbian(CFPLF_Plugin):
     """Same as CFPLF_Plugin(single_cf_fn=Hebbian()); just for non-optimized fallback."""
     single_cf_fn = param.ClassSelector(LearningFn,default=Hebbian(),readonly=True)
@@ -134,9 +203,9 @@ class CFPLF_BCMFixed_opt(CFPLearningFn):
     Implemented in C for speed.  Should be equivalent to
     BCMFixed for CF sheets, except faster.  
 
-    As a side effect, sets the norm_total attribute on any cf whose
-    weights are updated during learning, to speed up later operations
-    that might depend on it.
+    As a side effect, stores the norm_total of any cf whose weights
+    are updated during learning in the projection's norm_totals, to
+    speed up later operations that might depend on it.
 
     May return without modifying anything if the learning rate turns
     out to be zero.
@@ -147,6 +216,8 @@ class CFPLF_BCMFixed_opt(CFPLearningFn):
     def __call__(self, iterator, input_activity, output_activity, learning_rate, **params):
         rows,cols = output_activity.shape
         cfs = iterator.flatcfs
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
         num_cfs = len(cfs)
         single_connection_learning_rate = self.constant_sum_connection_rate(iterator.proj_n_units,learning_rate)
         if single_connection_learning_rate==0:
@@ -220,17 +291,15 @@ class CFPLF_BCMFixed_opt(CFPLearningFn):
                     }
 
                     // store the sum of the cf's weights
-                    PyObject *total_obj = PyFloat_FromDouble(total);  //(new ref)
-                    PyObject_SetAttrString(cf,"_norm_total",total_obj);
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_True);
-                    Py_DECREF(total_obj);
+                    norm_totals[r] = total;
+                    has_norm_totals[r] = 1;
                 }
             }
         """
 
         inline(code, ['input_activity', 'output_activity','num_cfs',
                       'icols', 'cfs', 'single_connection_learning_rate',
-                      'unit_threshold','cf_type'],
+                      'unit_threshold','cf_type','norm_totals','has_norm_totals'],
                local_dict=locals(),
                headers=['<structmember.h>'])               
 
@@ -249,9 +318,9 @@ class CFPLF_Scaled_opt(CFPLF_PluginScaled):
     Implemented in C for speed.  Should be equivalent to
     CFPLF_PluginScaled(single_cf_fn=Hebbian), except faster.  
 
-    As a side effect, sets the norm_total attribute on any cf whose
-    weights are updated during learning, to speed up later operations
-    that might depend on it.
+    As a side effect, stores the norm_total of any cf whose weights
+    are updated during learning in the projection's norm_totals, to
+    speed up later operations that might depend on it.
     """
     single_cf_fn = param.ClassSelector(LearningFn,default=Hebbian(),readonly=True)
     
@@ -263,6 +332,8 @@ class CFPLF_Scaled_opt(CFPLF_PluginScaled):
         learning_rate_scaling_factor = self.learning_rate_scaling_factor
 
         cfs = iterator.flatcfs
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
         num_cfs = len(cfs)
         single_connection_learning_rate = self.constant_sum_connection_rate(iterator.proj_n_units,learning_rate)
         if single_connection_learning_rate==0:
@@ -319,16 +390,14 @@ class CFPLF_Scaled_opt(CFPLF_PluginScaled):
                     Py_DECREF(mask_obj);
 
                     // store the sum of the cf's weights
-                    PyObject *total_obj = PyFloat_FromDouble(total);  //(new ref)
-                    PyObject_SetAttrString(cf,"_norm_total",total_obj);
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_True);
-                    Py_DECREF(total_obj);
+                    norm_totals[r] = total;
+                    has_norm_totals[r] = 1;
                 }
             }
             
         """
 
-        inline(code, ['input_activity','learning_rate_scaling_factor', 'output_activity','num_cfs', 'icols', 'cfs', 'single_connection_learning_rate'], local_dict=locals())
+        inline(code, ['input_activity','learning_rate_scaling_factor', 'output_activity','num_cfs', 'icols', 'cfs', 'single_connection_learning_rate','norm_totals','has_norm_totals'], local_dict=locals())
 
 
 class CFPLF_Scaled(CFPLF_PluginScaled):
@@ -351,6 +420,8 @@ class CFPLF_Trace_opt(CFPLearningFn):
 
     def __call__(self, iterator, input_activity, output_activity, learning_rate, **params):
         cfs = iterator.flatcfs
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
         single_connection_learning_rate = self.constant_sum_connection_rate(iterator.proj_n_units,learning_rate)
         irows,icols = input_activity.shape
         
@@ -411,15 +482,13 @@ class CFPLF_Trace_opt(CFPLearningFn):
                     Py_DECREF(mask_obj);
 
                     // store the sum of the cf's weights
-                    PyObject *total_obj = PyFloat_FromDouble(total);  //(new ref)
-                    PyObject_SetAttrString(cf,"norm_total",total_obj);
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_True);
-                    Py_DECREF(total_obj);
+                    norm_totals[r] = total;
+                    has_norm_totals[r] = 1;
                 }
             }
         """
 
-        inline(code, ['input_activity', 'traces','num_cfs', 'icols', 'cfs', 'single_connection_learning_rate'], local_dict=locals())
+        inline(code, ['input_activity', 'traces','num_cfs', 'icols', 'cfs', 'single_connection_learning_rate','norm_totals','has_norm_totals'], local_dict=locals())
 
 
 provide_unoptimized_equivalent("CFPLF_Trace_opt","CFPLF_Trace",locals())
@@ -56,6 +56,39 @@ class CFPLF_EuclideanHebbian(CFPLearningFn):
 
 
 
+class CFPLF_Hebbian_sparse(CFPLearningFn):
+    """
+    Hebbian learning rule for all the CFs in a projection at once.
+
+    Equivalent to CFPLF_Plugin(single_cf_fn=Hebbian()), but updates all
+    the weights in the projection's CFWeightStore (see
+    CFProjection.pack_weights) with whole-array operations, treating
+    them as the data of a sparse matrix (see
+    CFWeightStore.csr_matrix()): each weight is increased in
+    proportion to the activity of its destination unit times the
+    activity of its input unit, and then multiplied by its mask.
+
+    Requires scipy.
+    """
+    single_cf_fn = param.ClassSelector(LearningFn,default=Hebbian(),readonly=True)
+
+    def __call__(self, iterator, input_activity, output_activity, learning_rate, **params):
+        store = iterator.weight_store
+        if store is None:
+            raise ValueError("%s requires a projection with pack_weights=True."%self.__class__.__name__)
+
+        single_connection_learning_rate = self.constant_sum_connection_rate(iterator.proj_n_units,learning_rate)
+        if single_connection_learning_rate==0:
+            return
+
+        W = store.csr_matrix(input_activity.shape)
+        # Units masked out do not learn
+        rates = single_connection_learning_rate*output_activity.ravel()*(iterator.mask.data.ravel()!=0)
+        store.weights += rates.repeat(store.sizes)*input_activity.ravel().take(W.indices)
+        store.weights *= store.masks
+
+
+
 #### JABHACKALERT: Untested
 ##class CFPLF_BCM(CFPLearningFn):
 ##    """
@@ -7,10 +7,143 @@ $Id$
 __version__='$Revision: 7629 $'
 
 
+import cPickle
+import random
+import traceback
+
 import param
 from topo.base.sheet import Sheet
 from topo.base.patterngenerator import PatternGenerator,Constant
-from topo.base.simulation import FunctionEvent, PeriodicEventSequence
+from topo.base.simulation import FunctionEvent, PeriodicEventSequence, Forever
+
+
+def _generation_times(start,period,stop):
+    """Yield start+period, start+2*period, ... up to and including stop."""
+    t = start+period
+    while stop==Forever or t<=stop:
+        yield t
+        t += period
+
+
+def _prefetch_patterns(simulation,generator,times,queue,stop):
+    """
+    Draw generator's pattern at each of the given simulation times
+    (until the stop Event is set), putting each one on the queue,
+    followed by the generator's resulting state.  Runs in a separate
+    (forked) process.
+    """
+    try:
+        for t in times:
+            if stop.is_set():
+                break
+            simulation._time = t
+            queue.put(('pattern',t,generator()))
+        queue.put(('state',None,cPickle.dumps(generator,2)))
+    except:
+        queue.put(('error',None,traceback.format_exc()))
+
+
+def _update_state(target,source,memo):
+    """
+    Make the state of target match that of source, an equivalent
+    object (e.g. an unpickled copy of target), in place.
+
+    Subobjects of the same type are updated recursively rather than
+    replaced, so that references to target or to any of its
+    subobjects remain valid.
+    """
+    if target is source or id(target) in memo:
+        return
+    memo.add(id(target))
+
+    if isinstance(target,random.Random):
+        target.setstate(source.getstate())
+        return
+    elif isinstance(target,list):
+        items = zip(range(len(source)),source)
+        if len(target)!=len(source):
+            target[:] = source
+            return
+    elif isinstance(target,dict):
+        items = source.items()
+    else:
+        target,items = target.__dict__,source.__dict__.items()
+
+    for key,value in items:
+        old = target.get(key) if isinstance(target,dict) else target[key]
+        if type(old) is type(value) and \
+               (isinstance(value,(list,dict,random.Random)) or hasattr(value,'__dict__')):
+            _update_state(old,value,memo)
+        else:
+            target[key] = value
+
+
+class PatternPrefetcher(object):
+    """
+    Draws the patterns of a PatternGenerator for a series of future
+    simulation times in a separate process, so that they are ready by
+    the time they are needed.
+
+    The process is forked from the current one, so it starts with an
+    identical copy of the generator (including the state of any random
+    number streams) and the same Simulation.  Each pattern is drawn
+    with the Simulation's time set to the time at which it will be
+    requested, so the patterns are exactly those the generator would
+    have produced in this process.
+
+    When prefetching finishes, the generator's state in the other
+    process is copied back (see finish()), so that once all the
+    patterns have been taken, the generator continues from where it
+    would have been without prefetching.
+    """
+
+    def __init__(self,simulation,generator,times,size):
+        import multiprocessing
+        self.generator = generator
+        self.queue = multiprocessing.Queue(size)
+        self._stop = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_prefetch_patterns,
+            args=(simulation,generator,times,self.queue,self._stop))
+        self.process.daemon = True
+        self.process.start()
+        self._next = self._get()
+
+
+    def _get(self):
+        kind,t,data = self.queue.get()
+        if kind=='error':
+            self.process.join()
+            raise RuntimeError("Error while prefetching patterns:\n"+data)
+        return kind,t,data
+
+
+    def next_time(self):
+        """Return the time of the next pattern, or None if there are no more."""
+        kind,t,data = self._next
+        return t if kind=='pattern' else None
+
+
+    def get(self):
+        """Return the next pattern."""
+        kind,t,pattern = self._next
+        self._next = self._get()
+        return pattern
+
+
+    def finish(self):
+        """
+        Stop drawing patterns, discarding any not yet taken, and copy
+        the generator's resulting state back into this process.
+
+        The state includes the effects of drawing any discarded
+        patterns.
+        """
+        self._stop.set()
+        while self.next_time() is not None:
+            self.get()
+        kind,t,state = self._next
+        _update_state(self.generator,cPickle.loads(state),set())
+        self.process.join()
 
 
 # JLALERT: This sheet should have override_plasticity_state/restore_plasticity_state
@@ -41,6 +174,24 @@ class GeneratorSheet(Sheet):
     input_generator = param.ClassSelector(PatternGenerator,default=Constant(),
         doc="""Specifies a particular PatternGenerator type to use when creating patterns.""")
 
+    prefetch = param.Integer(default=0,bounds=(0,None),doc="""
+        Number of input patterns to draw ahead of time in a separate
+        process, overlapping the work of drawing them with the rest of
+        the simulation.  0 disables prefetching.
+
+        Useful for expensive generators (e.g. FileImage or audio
+        patterns).  During each call to Simulation.run(), the patterns
+        for the times at which this sheet will generate input up to
+        the end of the run are drawn by a forked copy of this process,
+        and the input_generator's state is copied back once the last
+        of them has been used.  The patterns and random number
+        streams are therefore exactly the same as without
+        prefetching, as long as nothing else changes or uses the
+        input_generator (or any random numbers it shares with other
+        objects) during the run.  Not for use with MPI.""")
+
+    _prefetcher = None
+
     
     def __init__(self,**params):
         super(GeneratorSheet,self).__init__(**params)
@@ -60,6 +211,7 @@ class GeneratorSheet(Sheet):
         pop_input_generator.
         """
 
+        self.stop_prefetch()
         if push_existing:
             self.push_input_generator()
 
@@ -102,7 +254,7 @@ class GeneratorSheet(Sheet):
         # JABALERT: What does the [:] achieve here?  Copying the
         # values, instead of the pointer to the array?  Is that
         # guaranteed?
-        self.activity[:] = self.input_generator()
+        self.activity[:] = self._next_pattern()
 
         if self.apply_output_fns:
             for of in self.output_fns:
@@ -110,6 +262,56 @@ class GeneratorSheet(Sheet):
         self.send_output(src_port='Activity',data=self.activity)
                                                         
               
+    def _next_pattern(self):
+        """
+        Return the input_generator's pattern for the current time,
+        using the prefetched one if available.
+        """
+        now = self.simulation.time()
+        prefetcher = self._prefetcher
+        if prefetcher is not None:
+            if prefetcher.generator is self.input_generator and prefetcher.next_time()==now:
+                pattern = prefetcher.get()
+                if prefetcher.next_time() is None:
+                    prefetcher.finish()
+                    self._prefetcher = None
+                return pattern
+            self.stop_prefetch()
+
+        pattern = self.input_generator()
+
+        # Prefetch the patterns for the rest of the current run
+        period = self.simulation._convert_to_time_type(self.period)
+        stop = self.simulation._stop_time
+        if self.prefetch>0 and (stop==Forever or now+period<=stop):
+            self._prefetcher = PatternPrefetcher(self.simulation,self.input_generator,
+                                                 _generation_times(now,period,stop),
+                                                 self.prefetch)
+        return pattern
+
+
+    def stop_prefetch(self):
+        """
+        Stop any prefetching of patterns that is in progress,
+        discarding any prefetched patterns that have not been used.
+
+        Drawing the discarded patterns will still have advanced the
+        input_generator's random number streams.
+        """
+        if self._prefetcher is not None:
+            self.warning("Discarding prefetched input patterns; the input_generator "
+                         "has been advanced past them.")
+            self._prefetcher.finish()
+            self._prefetcher = None
+
+
+    def __getstate__(self):
+        self.stop_prefetch()
+        state = super(GeneratorSheet,self).__getstate__()
+        state['_prefetcher'] = None
+        return state
+
+
     def start(self):
         assert self.simulation
 
@@ -46,6 +46,19 @@ def topsize():
 
 
 
+def peaksize():
+    """
+    Return the peak RES size of this process so far, in bytes, as
+    reported by getrusage(2) (which is not available on all
+    platforms).
+    """
+    import resource,sys
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X reports bytes, Linux kilobytes
+    return maxrss if sys.platform=='darwin' else maxrss*1024
+
+
+
 def simsize():
     """
     Return the size of topo.sim reported by asizeof.asizeof().
@@ -71,6 +84,10 @@ def topsize_mb():
     """String-formatted version of the RES size of this process reported by top(1)."""
     return "topsize:%s" % topsize()
 
+def peaksize_mb():
+    """String-formatted version of the peak RES size of this process, from getrusage(2)."""
+    return "peaksize:%s" % (mb(peaksize()))
+
 def simsize_mb():
     """String-formatted version of the value reported by asizeof(topo.sim)."""
     return "simsize:%s" % (mb(simsize()))
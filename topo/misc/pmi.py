@@ -118,6 +118,8 @@ these commands is issued on a worker during the worker loop, a
   parallel and to import classes and functions into the global
   namespace of pmi.
 * `sync()` to make sure that all deleted PMI objects have been deleted.
+* `Plan` to record a sequence of calls that is sent to the workers
+  only once, and afterwards replayed by broadcasting a single number.
 * `finalizeWorkers()` to stop and exit all workers
 * `registerAtExit()` to make sure that finalizeWorkers() is called when
   python exits on the controller
@@ -165,7 +167,7 @@ __email__ = 'olaf at lenz dot name'
 __version__ = '1.0'
 __all__ = [
     'exec_', 'import_', 'execfile_',
-    'create', 'call', 'invoke', 'reduce', 'localcall',
+    'create', 'call', 'invoke', 'reduce', 'localcall', 'Plan',
     'sync', 'receive',
     'startWorkerLoop',
     'finalizeWorkers', 'stopWorkerLoop', 'registerAtExit',
@@ -474,6 +476,132 @@ def __workerInvoke_opt(function, *targs, **tkwds) :
     return _MPIGather_opt(value,None)
 
 
+##################################################
+## PLAN (RECORDED SEQUENCE OF CALLS)
+##################################################
+class Plan(object):
+    """Controller object that records a fixed sequence of call(),
+    invoke() and invoke_opt() commands, to be replayed on all workers.
+
+    Each of the usual commands has to pickle the function and its
+    arguments, broadcast them, and then translate them on every
+    worker.  For calls that are repeated over and over (e.g. once per
+    projection per simulation step), that overhead can be larger than
+    the cost of the data collectives themselves.  A Plan is instead
+    sent to the workers only once, when it is first called (or when
+    register() is called); afterwards calling the plan broadcasts
+    only the plan's number, and the workers run the stored steps,
+    including any gathers.
+
+    The arguments of the steps are fixed when they are recorded, so
+    data that changes from one call to the next has to reach the
+    workers some other way, e.g. through the state of the PMI objects
+    themselves.
+
+    Calling the plan returns a list containing the value of each step
+    on the controller (as call(), invoke() or invoke_opt() would).
+
+    Example:
+
+    >>> plan = pmi.Plan()
+    >>> plan.call(hw, 'hello')
+    >>> plan.invoke(hw, 'goodbye')
+    >>> hello, goodbyes = plan()
+    """
+    def __init__(self):
+        # (cmd, cfunction, cargs, ckwds, rbuf) for the controller
+        self.steps = []
+        # (cmd, tfunction, targs, tkwds) to be sent to the workers
+        self.tsteps = []
+        self.planid = None
+
+    def call(self, *args, **kwds):
+        """Record a call() of the given function."""
+        _recordPlanStep(self, _CALL, args, kwds)
+
+    def invoke(self, *args, **kwds):
+        """Record an invoke() of the given function."""
+        _recordPlanStep(self, _INVOKE, args, kwds)
+
+    def invoke_opt(self, pmiobj, fn_name, data, rbuf=None, **kwds):
+        """Record an invoke_opt() of the given method, gathering into rbuf."""
+        if rbuf is None:
+            raise ValueError("rbuf must me specified as [data,(counts,displs),MPI.Datatype]")
+        _recordPlanStep(self, _INVOKE_OPT, (pmiobj, fn_name, data), kwds, rbuf)
+
+    def register(self):
+        """Send the plan to the workers, if that has not yet been done."""
+        if self.planid is None:
+            _registerPlan(self)
+
+    def __call__(self):
+        return _runPlan(self)
+
+    def __del__(self):
+        if self.planid is not None:
+            DELETED_PLANS.append(self.planid)
+
+def _recordPlanStep(plan, cmd, args, kwds, rbuf=None):
+    if plan.planid is not None:
+        raise UserError('Cannot add to a plan that has already been registered!')
+    if len(args) == 0:
+        raise UserError('pmi.Plan expects at least 1 argument to record a step!')
+    cfunction, tfunction, args = __translateFunctionArgs(*args)
+    cargs, ckwds, targs, tkwds = __translateArgs(args, kwds)
+    plan.steps.append((cmd, cfunction, cargs, ckwds, rbuf))
+    plan.tsteps.append((cmd, tfunction, targs, tkwds))
+
+def _registerPlan(plan):
+    global PLAN_COUNT
+    if __checkController(_registerPlan):
+        PLAN_COUNT += 1
+        _broadcast(_PLAN, PLAN_COUNT, *plan.tsteps)
+        plan.planid = PLAN_COUNT
+        # the translated steps are not needed any more
+        plan.tsteps = None
+    else:
+        receive(_PLAN)
+
+def __workerPlan(planid, *tsteps):
+    """Stores the steps of a plan, ready to be run."""
+    log.info("Registering plan %d with %d steps", planid, len(tsteps))
+    steps = []
+    for cmd, tfunction, targs, tkwds in tsteps:
+        function = __backtranslateFunctionArg(tfunction)
+        args, kwds = __backtranslateOIDs(targs, tkwds)
+        steps.append((cmd, function, args, kwds))
+    PLANS[planid] = steps
+
+def _runPlan(plan):
+    if __checkController(_runPlan):
+        plan.register()
+        __delete()
+        log.debug("Broadcasting plan %d", plan.planid)
+        # the number alone identifies the plan (see receive())
+        _MPIBroadcast(plan.planid)
+        values = []
+        for cmd, cfunction, cargs, ckwds, rbuf in plan.steps:
+            value = cfunction(*cargs, **ckwds)
+            if cmd == _INVOKE:
+                value = _MPIGather(value)
+            elif cmd == _INVOKE_OPT:
+                _MPIGather_opt(value, rbuf)
+                value = rbuf
+            values.append(value)
+        return values
+    else:
+        return receive()
+
+def __workerRunPlan(planid):
+    log.debug("Running plan %d", planid)
+    for cmd, function, args, kwds in PLANS[planid]:
+        value = function(*args, **kwds)
+        if cmd == _INVOKE:
+            _MPIGather(value)
+        elif cmd == _INVOKE_OPT:
+            _MPIGather_opt(value, None)
+
+
 ##################################################
 ## REDUCE (INVOKE WITH REDUCED RESULT)
 ##################################################
@@ -567,14 +695,17 @@ def __workerDump() :
 ##################################################
 def __delete():
     """Internal implementation of sync()."""
-    global DELETED_OIDS
-    if len(DELETED_OIDS) > 0:
-        log.debug("Got %d objects in DELETED_OIDS.", len(DELETED_OIDS))
-        __broadcastCmd(_DELETE, *DELETED_OIDS)
+    global DELETED_OIDS, DELETED_PLANS
+    if len(DELETED_OIDS) > 0 or len(DELETED_PLANS) > 0:
+        log.debug("Got %d objects in DELETED_OIDS and %d plans in DELETED_PLANS.",
+                  len(DELETED_OIDS), len(DELETED_PLANS))
+        __broadcastCmd(_DELETE, *DELETED_OIDS, plans=DELETED_PLANS)
         DELETED_OIDS = []
+        DELETED_PLANS = []
 
-def __workerDelete(*args) :
-    """Deletes the OBJECT_CACHE reference to a PMI object."""
+def __workerDelete(*args, **kwds) :
+    """Deletes the OBJECT_CACHE reference to a PMI object, and the
+    stored steps of any plans."""
     if len(args) > 0:
         log.info("Deleting oids: %s", args)
         for oid in args:
@@ -582,6 +713,11 @@ def __workerDelete(*args) :
             log.debug("  %s [%s]" % (obj, oid))
             # Delete the entry from the cache
             del OBJECT_CACHE[oid]
+    plans = kwds.get('plans', ())
+    if len(plans) > 0:
+        log.info("Deleting plans: %s", plans)
+        for planid in plans:
+            del PLANS[planid]
 
 
 ##################################################
@@ -817,6 +953,11 @@ def receive(expected=None) :
         log.debug('Waiting for PMI command %s.', _CMD[expected][0])
     message = _MPIBroadcast()
     log.debug("Received message: %s", message)
+    if type(message) is int:
+        # a plan is run by broadcasting just its number (see Plan)
+        if expected is not None:
+            raise UserError("Received plan %d but expected PMI command %s" % (message, _CMD[expected][0]))
+        return __workerRunPlan(message)
     if type(message) is not __CMD:
         raise UserError("Received an MPI message that is not a PMI command: '%s'" % str(message))
     cmd = message.cmd
@@ -824,7 +965,7 @@ def receive(expected=None) :
     kwds = message.kwds
     if cmd == _DELETE:
         # if _DELETE is sent, delete the objects
-        __workerDelete(*args)
+        __workerDelete(*args, **kwds)
         # recursively call receive once more
         return receive(expected)
     elif expected is not None and cmd != expected :
@@ -1129,7 +1270,8 @@ _CMD = [
     ('DELETE', __workerDelete),
     ('SYNC', __workerSync),
     ('STOP', __workerStop),
-    ('DUMP', __workerDump) 
+    ('DUMP', __workerDump),
+    ('PLAN', __workerPlan)
     ]
 
 _MAXCMD = len(_CMD)
@@ -1143,6 +1285,12 @@ del i
 DELETED_OIDS = []
 # dict that stores the objects corresponding to an oid
 OBJECT_CACHE = {}
+# list of the numbers of plans that have been deleted
+DELETED_PLANS = []
+# dict that stores the steps of each plan, by number
+PLANS = {}
+# number of the most recently registered plan
+PLAN_COUNT = 0
 
 inWorkerLoop = False
 
@@ -15,7 +15,7 @@ import os
 import bisect
 from itertools import izip
 
-from numpy import asarray
+from numpy import asarray,zeros,empty,arange,memmap,float64
 import ImageDraw
 
 import param
@@ -38,7 +38,8 @@ class DataRecorder(EventProcessor):
     DataRecorder is an abstract class for which different
     implementations may exist for different means of storing recorded
     data.  For example, the subclass InMemoryRecorder stores all the
-    data in memory.
+    data in memory, RingBufferRecorder stores the most recent data in
+    preallocated arrays, and DiskRecorder stores all the data in files.
 
     A DataRecorder instance can operate either as an event processor, or in a
     stand-alone mode.  Both usage modes can be used on the same
@@ -223,6 +224,249 @@ class InMemoryRecorder(DataRecorder):
 
 
 
+class RingBufferRecorder(DataRecorder):
+    """
+    A data recorder that stores the most recently recorded data in
+    memory, using a fixed amount of memory per variable.
+
+    Each variable holds up to capacity data items, which must all be
+    arrays of the same shape (or numbers), in an array allocated when
+    the first item is recorded; once it is full, each new item
+    replaces the oldest one.  Recording therefore takes constant time
+    and memory, however long the simulation runs.
+    """
+
+    capacity = param.Integer(default=1000,bounds=(1,None),doc="""
+        The maximum number of data items to store for each variable;
+        older items are discarded to make room for new ones.""")
+
+
+    def __init__(self,**params):
+        super(RingBufferRecorder,self).__init__(**params)
+        self._vars = {}
+
+
+    def add_variable(self,name):
+        # start is the position of the oldest of the n stored items
+        self._vars[name] = Struct(time=None,data=None,start=0,n=0)
+
+
+    def _positions(self,var,start=0,end=None):
+        # positions in the buffer of the stored items start to end (oldest first)
+        start,end,step = slice(start,end).indices(var.n)
+        return (var.start+arange(start,end))%self.capacity
+
+
+    def record_data(self,varname,time,data):
+        var = self._vars[varname]
+        data = asarray(data)
+        if var.data is None:
+            var.data = zeros((self.capacity,)+data.shape,dtype=data.dtype)
+            var.time = empty(self.capacity,dtype=object)
+
+        if var.n == self.capacity:
+            if time < var.time[var.start]:
+                # older than anything stored
+                return
+            var.start = (var.start+1)%self.capacity
+            var.n -= 1
+
+        # add the data, maintaining it sorted by time
+        idx = var.n
+        if var.n > 0 and time < var.time[self._positions(var,-1)[0]]:
+            idx = bisect.bisect_right(self.get_times(varname),time)
+            moved = self._positions(var,idx)
+            var.time[(moved+1)%self.capacity] = var.time[moved]
+            var.data[(moved+1)%self.capacity] = var.data[moved]
+
+        pos = (var.start+idx)%self.capacity
+        var.time[pos] = time
+        var.data[pos] = data
+        var.n += 1
+
+
+    def get_datum(self,name,time):
+        var = self._vars[name]
+        idx,dummy = self.get_time_indices(name,time,time)
+        if idx >= var.n:
+            idx -= 1
+        return var.data[self._positions(var,idx)[0]].copy()
+
+
+    def get_data(self,name,times=(None,None),fill_range=False):
+        tstart,tend = times
+        start,end = self.get_time_indices(name,tstart,tend)
+        var = self._vars[name]
+
+        if start >= var.n:
+            # if the start index is out of bounds
+            if fill_range:
+                time = times
+                data = [var.data[self._positions(var,-1)[0]].copy()]*2
+            else:
+                time,data = [],[]
+        else:
+            positions = self._positions(var,start,end)
+            time,data = list(var.time[positions]),list(var.data[positions])
+            if fill_range:
+                if time[0] > tstart and start > 0:
+                    time.insert(0,tstart)
+                    data.insert(0,var.data[self._positions(var,start-1)[0]].copy())
+                if time[-1] < tend:
+                    time.append(tend)
+                    data.append(data[-1])
+
+        return time,data
+
+
+    def get_times(self,varname):
+        var = self._vars[varname]
+        if var.n == 0:
+            return []
+        return var.time[self._positions(var)]
+
+
+
+class DiskRecorder(DataRecorder):
+    """
+    A data recorder that appends all recorded data to files on disk,
+    keeping only the times in memory.
+
+    Each variable's data items must all be arrays of the same shape
+    (or numbers).  They are stored in the order recorded, one after
+    another, in a raw array file (see get_array()), and the time of
+    each item is stored in the same way in a second file, so that
+    the recording can also be read (e.g. using numpy.memmap) outside
+    Topographica.  Retrieved data are read from memory-mapped files,
+    so only the parts requested are read from disk.
+    """
+
+    filename_prefix = param.String(default='',doc="""
+        A prefix for the names of the files used to store the data,
+        which are named <prefix><recorder name>_<variable name>.dat
+        (and .time, for the times); can include directories.  Any
+        existing files with those names are replaced.""")
+
+
+    def __init__(self,**params):
+        super(DiskRecorder,self).__init__(**params)
+        self._vars = {}
+
+
+    def _filename(self,name,ext):
+        return normalize_path('%s%s_%s.%s'%(self.filename_prefix,self.name,
+                                            name.replace(os.sep,'_'),ext))
+
+
+    def add_variable(self,name):
+        # time is sorted; index gives the position of each item in the file
+        var = self._vars[name] = Struct(time=[],index=[],dtype=None,shape=None,
+                                        filename=self._filename(name,'dat'),
+                                        time_filename=self._filename(name,'time'),
+                                        array=None)
+        dirname = os.path.dirname(var.filename)
+        if dirname and not os.access(dirname,os.F_OK):
+            os.makedirs(dirname)
+        for filename in (var.filename,var.time_filename):
+            open(filename,'wb').close()
+
+
+    def record_data(self,varname,time,data):
+        var = self._vars[varname]
+        if var.dtype is None:
+            data = asarray(data)
+            var.dtype,var.shape = data.dtype,data.shape
+        else:
+            data = asarray(data,dtype=var.dtype)
+            if data.shape != var.shape:
+                raise ValueError("Data of shape %s cannot be recorded in variable %r of shape %s."
+                                 %(data.shape,varname,var.shape))
+
+        f = open(var.filename,'ab')
+        f.write(data.tostring())
+        f.close()
+        f = open(var.time_filename,'ab')
+        f.write(asarray(float(time),dtype=float64).tostring())
+        f.close()
+
+        # add the time, maintaining it sorted
+        idx = len(var.time)
+        if var.time and time < var.time[-1]:
+            idx = bisect.bisect_right(var.time,time)
+        var.time.insert(idx,time)
+        var.index.insert(idx,len(var.index))
+        var.array = None
+
+
+    def get_array(self,varname):
+        """
+        Return a read-only memory-mapped array of all the data
+        recorded for the given variable, in the order recorded.
+        """
+        var = self._vars[varname]
+        if var.array is None:
+            if not var.index:
+                return zeros((0,)+(var.shape or ()))
+            var.array = memmap(var.filename,dtype=var.dtype,mode='r',
+                               shape=(len(var.index),)+var.shape)
+        return var.array
+
+
+    def _items(self,name,start,end):
+        # the stored items start to end (in time order), as an array
+        array = self.get_array(name)
+        index = self._vars[name].index[start:end]
+        if index == range(index[0],index[-1]+1):
+            # (usually recorded in time order)
+            return array[index[0]:index[-1]+1]
+        return array[index]
+
+
+    def get_datum(self,name,time):
+        var = self._vars[name]
+        idx,dummy = self.get_time_indices(name,time,time)
+        if idx >= len(var.index):
+            idx -= 1
+        return self.get_array(name)[var.index[idx]].copy()
+
+
+    def get_data(self,name,times=(None,None),fill_range=False):
+        tstart,tend = times
+        start,end = self.get_time_indices(name,tstart,tend)
+        var = self._vars[name]
+
+        if start >= len(var.index):
+            # if the start index is out of bounds
+            if fill_range:
+                time = times
+                data = [self.get_array(name)[var.index[-1]]]*2
+            else:
+                time,data = [],[]
+        else:
+            time,data = var.time[start:end],list(self._items(name,start,end))
+            if fill_range:
+                if time[0] > tstart and start > 0:
+                    time.insert(0,tstart)
+                    data.insert(0,self.get_array(name)[var.index[start-1]])
+                if time[-1] < tend:
+                    time.append(tend)
+                    data.append(data[-1])
+
+        return time,data
+
+
+    def get_times(self,varname):
+        return self._vars[varname].time
+
+
+    def __getstate__(self):
+        # (the memory-mapped arrays are reopened when needed)
+        state = super(DiskRecorder,self).__getstate__()
+        state['_vars'] = dict([(name,Struct(**dict(var.__dict__,array=None)))
+                               for name,var in self._vars.items()])
+        return state
+
+
 
 class Trace(param.Parameterized):
     """
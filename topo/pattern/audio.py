@@ -12,8 +12,8 @@ import os
 from topo.pattern.basic import TimeSeries, Spectrogram, PowerSpectrum
 from topo import transferfn
 
-from numpy import arange, array, ceil, complex64, concatenate, cos, exp, fft, flipud, float64, floor, hanning, hstack, log, log2, log10, \
-    logspace, multiply, nonzero, ones, pi, repeat, reshape, shape, size, sqrt, sum, tile, where, zeros
+from numpy import arange, array, asarray, ceil, complex64, concatenate, convolve, cos, empty, exp, fft, flipud, float64, floor, hanning, \
+    hstack, log, log2, log10, logspace, multiply, newaxis, nonzero, ones, pi, repeat, reshape, shape, size, sqrt, sum, tile, where, zeros
     
 try:
     import scikits.audiolab as audiolab
@@ -154,28 +154,22 @@ class LogSpectrogram(Spectrogram):
         
         
     def _get_row_amplitudes(self):
-        signal_interval = self.signal()
-        sample_rate = self.signal.sample_rate        
-
-        # A signal window *must* span one sample rate
-        signal_window = tile(signal_interval, ceil(1.0/self.signal.interval_length))
-
-        if self.windowing_function:
-            smoothed_window = signal_window[0:sample_rate] * self.windowing_function(sample_rate)  
-        else:
-            smoothed_window = signal_window[0:sample_rate]
+        amplitudes = self._get_amplitudes()
         
-        amplitudes = (abs(fft.rfft(smoothed_window))[0:sample_rate/2] + self.offset) * self.scale
-        
-        for index in range(0, self._sheet_dimensions[0]-2):
-            start_frequency = self.frequency_spacing[index]
-            end_frequency = self.frequency_spacing[index+1]
-             
-            normalisation_factor = nonzero(amplitudes[start_frequency:end_frequency])[0].size            
-            if normalisation_factor == 0:
-                amplitudes[index] = 0
-            else:
-                amplitudes[index] = sum(amplitudes[start_frequency:end_frequency]) / normalisation_factor
+        if self._bands_in_place:
+            counts = self._band_sums((amplitudes != 0).astype(float64))
+            averages = self._band_sums(amplitudes) / where(counts == 0, 1, counts)
+            amplitudes[0:len(counts)] = where(counts == 0, 0, averages)
+        else:
+            for index in range(0, self._sheet_dimensions[0]-2):
+                start_frequency = self._band_starts[index]
+                end_frequency = self._band_ends[index]
+                 
+                normalisation_factor = nonzero(amplitudes[start_frequency:end_frequency])[0].size            
+                if normalisation_factor == 0:
+                    amplitudes[index] = 0
+                else:
+                    amplitudes[index] = sum(amplitudes[start_frequency:end_frequency]) / normalisation_factor
         
         return flipud(amplitudes[0:self._sheet_dimensions[0]].reshape(-1,1))
         
@@ -241,6 +235,93 @@ class ModulatedLogSpectrogram(LogSpectrogram):
         
 
 
+class CascadeFilterbank(object):
+    """
+    A cascade of IIR filters, one per channel, where the output of
+    each channel is the input to the next, for filtering a signal
+    that arrives in successive blocks of samples.
+
+    All the channels are advanced together, one sample at a time,
+    with channel i working on the sample that entered the cascade i
+    samples earlier; the whole cascade is therefore updated by one
+    vector operation per sample, rather than by filtering the block
+    with each channel in turn.  The output of channel i is thus
+    delayed by i samples (see aligned()).  The filter states
+    (including the samples still on their way through the cascade)
+    are kept from one block to the next, so that filtering a signal
+    in blocks gives the same result as filtering all of it at once.
+    """
+
+    def __init__(self, b, a):
+        """
+        b and a hold the numerator and denominator coefficients of
+        each channel's filter (one row per channel), in increasing
+        powers of 1/z (as for scipy.signal.lfilter).
+        """
+        b = asarray(b, dtype=float64)
+        a = asarray(a, dtype=float64)
+        self.channels = b.shape[0]
+        self.order = max(b.shape[1], a.shape[1], 2) - 1
+
+        self.b = zeros((self.channels, self.order+1))
+        self.a = zeros((self.channels, self.order+1))
+        self.b[:,:b.shape[1]] = b / a[:,0:1]
+        self.a[:,:a.shape[1]] = a / a[:,0:1]
+        self.reset()
+
+
+    def reset(self):
+        """Clear the filter states, as before the first sample."""
+        self.state = zeros((self.channels, self.order))
+        self.outputs = zeros(self.channels)
+        # (the last channels-1 outputs, for aligned())
+        self.lookback = zeros((self.channels, self.channels-1))
+
+
+    def __call__(self, samples):
+        """
+        Filter the given block of samples, returning the outputs of
+        all the channels (one row per channel) for each sample.
+        """
+        b0, b, a = self.b[:,0], self.b[:,1:], self.a[:,1:]
+        state, y = self.state, self.outputs
+        x = empty(self.channels)
+        responses = empty((len(samples), self.channels))
+
+        # (transposed direct form II)
+        for t, sample in enumerate(samples):
+            x[0] = sample
+            x[1:] = y[:-1]
+            y = b0*x + state[:,0]
+            next_state = b*x[:,newaxis] - a*y[:,newaxis]
+            next_state[:,:-1] += state[:,1:]
+            state = next_state
+            responses[t] = y
+
+        self.state, self.outputs = state, y
+        return responses.transpose()
+
+
+    def aligned(self, samples):
+        """
+        Filter the given block of samples as for __call__(), but
+        return the outputs of every channel for the same input
+        samples, by compensating for the delay of each channel.
+
+        Each block is filtered as usual, but the outputs returned are
+        those for the block delayed by channels-1 samples (i.e. all
+        the channels lag the input equally, rather than channel i
+        lagging by i samples), with zeros as the input before the
+        first block.
+        """
+        responses = hstack((self.lookback, self(samples)))
+        channel = arange(self.channels)[:,newaxis]
+        aligned = responses[channel, channel+arange(len(samples))]
+        self.lookback = responses[:,len(samples):]
+        return aligned
+
+
+
 class LyonsCochlearModel(PowerSpectrum):
     """
     Outputs a cochlear decomposition as a set of frequency responses of linear 
@@ -284,11 +365,26 @@ class LyonsCochlearModel(PowerSpectrum):
                 
     precision = param.Parameter(default=float64, doc="""
         The float precision to use when calculating ear stage filters.""")
+
+    streaming = param.Boolean(default=True, doc="""
+        Whether to pass the signal through the cascade of ear filters
+        in the time domain (see CascadeFilterbank), so that each call
+        processes only the samples not already processed by earlier
+        calls, with the filters' state carried over between calls.
+        The response of each channel is then its mean absolute
+        output over those samples.  Each channel of the cascade
+        delays the signal by one more sample than the previous one,
+        so, for every channel to respond to the same samples, the
+        response is for the samples delayed by one fewer than the
+        number of channels (e.g. 4.6 milliseconds for 93 channels at
+        20 kHz; see CascadeFilterbank.aligned()).
+
+        Otherwise, each call applies the filters in the frequency
+        domain to a one-second window formed by repeating the current
+        interval of the signal, independently of earlier calls.""")
     
     
-    def __init__(self, **params):
-        super(LyonsCochlearModel, self).__init__(**params)
-
+    def _set_model_constants(self):
         # Hardwired Parameters specific to model, which is to say changing
         # them without knowledge of the mathematics of the model is a bad idea.
         self.sample_rate = self.signal.sample_rate
@@ -304,9 +400,6 @@ class LyonsCochlearModel(PowerSpectrum):
         self.ear_preemph_corner_f = float(300.0)
         self.ear_zero_offset = float(1.5)
         self.ear_sharpness = float(5.0)
-        
-        self._num_of_channels = self._num_of_channels()
-        self._generateCochlearFilters()
     
     
     def _ear_bandwidth(self, cf):
@@ -318,7 +411,10 @@ class LyonsCochlearModel(PowerSpectrum):
         return self.half_sample_rate + bandwidth_step_max_f - bandwidth_step_max_f*self.ear_zero_offset
 
 
-    def _num_of_channels(self):
+    def _calc_num_of_channels(self):
+        max_f = self._max_frequency()
+        self.max_f_calc = max_f + sqrt(max_f*max_f + self.ear_break_squared)
+
         min_f = self.ear_break_f / sqrt(4.0*self.ear_q*self.ear_q - 1.0)
         channels = log(self.max_f_calc) - log(min_f + sqrt(min_f*min_f + self.ear_break_squared))
         
@@ -429,6 +525,54 @@ class LyonsCochlearModel(PowerSpectrum):
         return self._evaluate_filters_for_frequencies(stage_filters, self.frequencies)
 
 
+    def _real_filters(self, zeros, poles, f, desired_gains):
+        # As _make_filters(), but normalizing by the magnitude of the
+        # filters' gains, so that the coefficients remain real
+        desired_gains = reshape(desired_gains,[size(desired_gains),1])
+        
+        unit_gains = abs(self._evaluate_filters_for_frequencies([zeros,poles], f))
+        unit_gains = reshape(unit_gains,[size(unit_gains),1])
+        
+        return [zeros*desired_gains, poles*unit_gains]
+
+
+    def _cascade_coefficients(self):
+        """
+        Return the numerator and denominator coefficients of the ear
+        stages (one row per channel), for filtering in the time domain.
+
+        The polynomials in z evaluated by _ear_first_stage() and
+        _ear_all_other_stages() are taken as polynomials in 1/z
+        instead, which gives the complex conjugate of each filter's
+        frequency response, i.e. the same magnitude response.
+        """
+        first_stage = [self._real_filters(self._first_order_filter_from_corner(self.ear_preemph_corner_f), 
+                           self._specific_filter(1.0,0.0,0.0), array([0.0]), 1.0),
+                       self._real_filters(self._specific_filter(1.0,0.0,-1.0), self._specific_filter(0.0,0.0,1.0), 
+                           array([self.quart_sample_rate]), 1.0),
+                       self._real_filters(self._specific_filter(0.0,0.0,1.0), 
+                           self._second_order_filter_from_center_q(self.cascade_pole_cfs[0],self.cascade_pole_qs[0]), 
+                           array([self.quart_sample_rate]), 1.0)]
+
+        # combine the filters of the first stage, dropping the powers of z they have in common
+        b0 = reduce(convolve, [filters[0][0] for filters in first_stage])
+        a0 = reduce(convolve, [filters[1][0] for filters in first_stage])
+        lead = min(nonzero(b0)[0][0], nonzero(a0)[0][0])
+        end = max(nonzero(b0)[0][-1], nonzero(a0)[0][-1]) + 1
+        b0, a0 = b0[lead:end], a0[lead:end]
+
+        other_stages = self._real_filters(
+            self._second_order_filter_from_center_q(self.cascade_zero_cfs[1:], self.cascade_zero_qs[1:]),
+            self._second_order_filter_from_center_q(self.cascade_pole_cfs[1:], self.cascade_pole_qs[1:]),
+            array([0.0]), self.ear_filter_gains)
+
+        b = zeros((self._num_of_channels, max(b0.size,3)), dtype=self.precision)
+        a = zeros((self._num_of_channels, max(a0.size,3)), dtype=self.precision)
+        b[0,:b0.size], a[0,:a0.size] = b0, a0
+        b[1:,:3], a[1:,:3] = other_stages
+        return b, a
+
+
     def _generate_cascade_filters(self):
         cascade_filters = self.ear_stages
         
@@ -440,7 +584,6 @@ class LyonsCochlearModel(PowerSpectrum):
         
     def _generateCochlearFilters(self):
         max_f = self._max_frequency()
-        self.max_f_calc = max_f + sqrt(max_f*max_f + self.ear_break_squared)
 
         self.centre_frequencies = zeros(self._num_of_channels, dtype=self.precision)
         self.centre_frequencies[0] = max_f
@@ -460,9 +603,29 @@ class LyonsCochlearModel(PowerSpectrum):
         self.ear_stages = hstack((self._ear_first_stage(), self._ear_all_other_stages())).transpose() 
         
         self.cochlear_channels = self._generate_cascade_filters()
+
+        self._filterbank = CascadeFilterbank(*self._cascade_coefficients())
+        self._filterbank_started = False
         
         
     def _get_row_amplitudes(self):
+        if not self.streaming:
+            return self._get_row_amplitudes_fft()
+
+        signal_interval = self.signal()
+
+        # Successive intervals overlap, so only the samples after the
+        # end of the previous interval have not yet been filtered
+        if self._filterbank_started:
+            new_samples = int(floor(self.signal.seconds_per_iteration*self.signal.sample_rate))
+            signal_interval = signal_interval[max(signal_interval.size-new_samples,0):]
+        self._filterbank_started = True
+
+        sheet_responses = abs(self._filterbank.aligned(signal_interval)).mean(axis=1)
+        return sheet_responses.reshape(self._num_of_channels, 1)
+
+
+    def _get_row_amplitudes_fft(self):
         """
         Perform a real Discrete Fourier Transform (DFT; implemented
         using a Fast Fourier Transform algorithm, FFT) of the current
@@ -485,11 +648,8 @@ class LyonsCochlearModel(PowerSpectrum):
         row_amplitudes = row_amplitudes.reshape(1,sample_rate/2.0)
         
         filter_responses = multiply(self.cochlear_channels, row_amplitudes)
-        sheet_responses = zeros(self._num_of_channels)
-        
-        for channel in range(0,self._num_of_channels):
-            time_responses = abs(fft.ifft(filter_responses[channel]))
-            sheet_responses[channel] = sum(time_responses) / (sample_rate/2.0)
+        time_responses = abs(fft.ifft(filter_responses, axis=1))
+        sheet_responses = sum(time_responses, axis=1) / (sample_rate/2.0)
         
         return sheet_responses.reshape(self._num_of_channels, 1)
           
@@ -497,7 +657,9 @@ class LyonsCochlearModel(PowerSpectrum):
     def set_matrix_dimensions(self, bounds, xdensity, ydensity):
         super(LyonsCochlearModel, self).set_matrix_dimensions(bounds, xdensity, ydensity)
         
-        self._num_of_channels = self._num_of_channels()
+        # (called by PatternGenerator.__init__(), so the model is set up here)
+        self._set_model_constants()
+        self._num_of_channels = self._calc_num_of_channels()
         if self._sheet_dimensions[0] == self._num_of_channels:
             self._generateCochlearFilters()
         else:
@@ -518,7 +680,7 @@ class LyonsCochleogram(LyonsCochlearModel):
             
                     
     def set_matrix_dimensions(self, bounds, xdensity, ydensity):
-        super(Cochleogram, self).set_matrix_dimensions(bounds, xdensity, ydensity)
+        super(LyonsCochleogram, self).set_matrix_dimensions(bounds, xdensity, ydensity)
         self._cochleogram = zeros(self._sheet_dimensions)
 
 
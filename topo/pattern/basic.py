@@ -10,8 +10,8 @@ __version__='$Revision$'
 
 import numpy
 from numpy.oldnumeric import around, bitwise_and, bitwise_or
-from numpy import abs, add, alltrue, array, asarray, ceil, clip, cos, fft, flipud, floor, equal, exp, hstack, Infinity, linspace, multiply, \
-    nonzero, pi, repeat, round, sin, sqrt, subtract, tile, zeros, sum, max
+from numpy import abs, add, alltrue, arange, array, asarray, ceil, clip, cos, dot, fft, flipud, floor, equal, exp, hstack, Infinity, linspace, \
+    multiply, nonzero, pi, repeat, round, sin, sqrt, subtract, tile, where, zeros, sum, max, log, ndarray
 
 import param
 from param.parameterized import ParamOverrides
@@ -19,9 +19,10 @@ from param import ClassSelector
 
 import topo
 # Imported here so that all PatternGenerators will be in the same package
-from topo.base.patterngenerator import Constant, PatternGenerator
+from topo.base.patterngenerator import Constant, PatternGenerator, _coordinate_vectors
 
 from topo.base.arrayutil import wrap
+from topo.base.boundingregion import BoundingBox
 from topo.base.sheetcoords import SheetCoordinateSystem
 from topo.misc.patternfn import gaussian,exponential,gabor,line,disk,ring,\
     sigmoid,arc_by_radian,arc_by_center,smooth_rectangle,float_error_ignore, \
@@ -95,6 +96,13 @@ class Gaussian(PatternGenerator):
         
         return gaussian(self.pattern_x,self.pattern_y,xsigma,ysigma)
 
+    _support_parameters = ['aspect_ratio']
+
+    def _support_radius(self,p,cutoff):
+        ysigma = p.size/2.0
+        xsigma = p.aspect_ratio*ysigma
+        return max([xsigma,ysigma])*sqrt(-2.0*log(cutoff))
+
 
 class ExponentialDecay(PatternGenerator):
     """
@@ -213,6 +221,13 @@ class Disk(PatternGenerator):
         return disk(self.pattern_x/p.aspect_ratio,self.pattern_y,height,
                     p.smoothing)
 
+    _support_parameters = ['aspect_ratio','smoothing']
+
+    def _support_radius(self,p,cutoff):
+        # Distances along x are scaled by 1/aspect_ratio before the
+        # (circular) disk and its fall-off are computed
+        return (p.size/2.0+p.smoothing*sqrt(-2.0*log(cutoff)))*max([1.0,p.aspect_ratio])
+
 
 class Ring(PatternGenerator):
     """
@@ -240,6 +255,12 @@ class Ring(PatternGenerator):
 
         return ring(self.pattern_x/p.aspect_ratio,self.pattern_y,height,
                     p.thickness,p.smoothing)
+
+    _support_parameters = ['aspect_ratio','thickness','smoothing']
+
+    def _support_radius(self,p,cutoff):
+        # See Disk._support_radius()
+        return (p.size/2.0+p.thickness/2.0+p.smoothing*sqrt(-2.0*log(cutoff)))*max([1.0,p.aspect_ratio])
     
 
 class OrientationContrast(SineGrating):
@@ -321,6 +342,12 @@ class Rectangle(PatternGenerator):
         return smooth_rectangle(self.pattern_x, self.pattern_y, 
                                 width, height, p.smoothing, p.smoothing)
 
+    _support_parameters = ['aspect_ratio','smoothing']
+
+    def _support_radius(self,p,cutoff):
+        tail = p.smoothing*sqrt(-2.0*log(cutoff))
+        return sqrt((p.aspect_ratio*p.size/2.0+tail)**2+(p.size/2.0+tail)**2)
+
 
 
 class Arc(PatternGenerator):
@@ -572,7 +599,19 @@ class Composite(PatternGenerator):
 
     size  = param.Number(default=1.0,doc="Scaling factor applied to all sub-patterns.")
 
-    
+    tail_cutoff = param.Number(default=1e-12,bounds=(0.0,1.0),precedence=-1,doc="""
+        Value below which the tails of spatially localized generators
+        (e.g. Gaussian, Disk, Ring and Rectangle) may be treated as zero.
+
+        When the operator is add or maximum, each such generator is
+        evaluated only within the box where its pattern can exceed
+        this value, and the result is combined into the full array
+        in place.  This is much cheaper than evaluating every
+        generator over the full bounds when there are many small
+        patterns on a large input region.  Set to 0 to evaluate all
+        generators over the full bounds.""")
+
+
     def _advance_pattern_generators(self,p):
         """
         Subclasses can override this method to provide constraints on
@@ -581,10 +620,7 @@ class Composite(PatternGenerator):
         """
         return p.generators
 
-        
-    # JABALERT: To support large numbers of patterns on a large input region,
-    # should be changed to evaluate each pattern in a small box, and then
-    # combine them at the full Composite Bounding box size.
+
     def function(self,p):
         """Constructs combined pattern out of the individual ones."""
         generators = self._advance_pattern_generators(p)
@@ -594,17 +630,119 @@ class Composite(PatternGenerator):
         # CEBALERT: mask gets applied by all PGs including the Composite itself
         # (leads to redundant calculations in current lissom_oo_or usage, but
         # will lead to problems/limitations in the future).
-        patterns = [pg(xdensity=p.xdensity,ydensity=p.ydensity,
-                       bounds=p.bounds,mask=p.mask,
-                       x=p.x+p.size*(pg.x*cos(p.orientation)- pg.y*sin(p.orientation)),
-                       y=p.y+p.size*(pg.x*sin(p.orientation)+ pg.y*cos(p.orientation)),
-                       orientation=pg.orientation+p.orientation,
-                       size=pg.size*p.size)
-                    for pg in generators]
-        image_array = p.operator.reduce(patterns)
+        calls = [(pg,dict(xdensity=p.xdensity,ydensity=p.ydensity,
+                          bounds=p.bounds,mask=p.mask,
+                          x=p.x+p.size*(pg.x*cos(p.orientation)- pg.y*sin(p.orientation)),
+                          y=p.y+p.size*(pg.x*sin(p.orientation)+ pg.y*cos(p.orientation)),
+                          orientation=pg.orientation+p.orientation,
+                          size=pg.size*p.size))
+                 for pg in generators]
+
+        windows = self._local_windows(p,calls)
+        if windows is None:
+            patterns = [pg(**overrides) for pg,overrides in calls]
+            image_array = p.operator.reduce(patterns)
+            return image_array
+
+        # Generators are combined in order, so that e.g. the sum is
+        # accumulated the same way as by reduce.
+        scs = windows.pop()
+        image_array = zeros(scs.shape)
+        for (pg,overrides),window in zip(calls,windows):
+            if window is not None:
+                rows,cols = window
+                overrides['bounds'] = self._window_bounds(scs,rows,cols)
+                if isinstance(p.mask,ndarray):
+                    overrides['mask'] = p.mask[rows,cols]
+                pattern = pg(**overrides)
+                if pattern.shape==(rows.stop-rows.start,cols.stop-cols.start):
+                    region = image_array[rows,cols]
+                    p.operator(region,pattern,region)
+                    continue
+                # Rounding in the window's bounds changed its shape,
+                # so fall back to evaluating over the full bounds
+                overrides['bounds'],overrides['mask'] = p.bounds,p.mask
+            pattern = pg(**overrides)
+            p.operator(image_array,pattern,image_array)
         return image_array
 
 
+    def _local_windows(self,p,calls):
+        """
+        Return a list containing, for each (generator,overrides) pair
+        in calls, the (row,col) slices of the full array outside which
+        that generator's pattern is negligible, or None if it needs to
+        be evaluated over the full bounds, followed by the
+        SheetCoordinateSystem of the full array.
+
+        Returns None if no generator can be evaluated locally.  The
+        parameters used to find the windows are added to the
+        overrides, so that dynamic values are only generated once.
+        """
+        if p.tail_cutoff<=0 or not (p.operator is add or p.operator is numpy.maximum):
+            return None
+        if not (p.mask is None or isinstance(p.mask,ndarray)):
+            return None
+
+        scs = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity)
+        if p.mask is not None and p.mask.shape!=scs.shape:
+            return None
+
+        rows,cols = scs.shape
+        windows = []
+        for pg,overrides in calls:
+            window = None
+            if pg._support_parameters and self._support_describes_function(pg) and \
+                   not pg.output_fns and pg.mask_shape is None:
+                for name in ['scale','offset']+pg._support_parameters:
+                    overrides[name] = getattr(pg,name)
+                radius = None
+                # With maximum, the zeros outside the window must not
+                # exceed the pattern that would have been there
+                if overrides['offset']==0 and overrides['scale']>=0:
+                    radius = pg._support_radius(ParamOverrides(pg,overrides),p.tail_cutoff)
+                if radius is not None:
+                    x,y = overrides['x'],overrides['y']
+                    r0,c0 = scs.sheet2matrix(x-radius,y+radius)
+                    r1,c1 = scs.sheet2matrix(x+radius,y-radius)
+                    r0,c0 = max([0,int(floor(r0))]),max([0,int(floor(c0))])
+                    r1,c1 = min([rows,int(floor(r1))+1]),min([cols,int(floor(c1))+1])
+                    if r0<r1 and c0<c1:
+                        window = (slice(r0,r1),slice(c0,c1))
+            elif p.operator is numpy.maximum:
+                return None
+            windows.append(window)
+
+        if windows.count(None)==len(windows):
+            return None
+        if p.operator is numpy.maximum and None in windows:
+            return None
+        return windows+[scs]
+
+
+    def _support_describes_function(self,pg):
+        """
+        Return whether pg's _support_radius() applies to its
+        function(), i.e. whether function() has not been overridden
+        by a subclass of the class defining _support_radius() (as
+        TwoRectangles does, drawing its rectangles away from the
+        center of Rectangle's support).
+        """
+        for cls in type(pg).__mro__:
+            if '_support_radius' in cls.__dict__:
+                return True
+            if 'function' in cls.__dict__:
+                return False
+        return False
+
+
+    def _window_bounds(self,scs,rows,cols):
+        """Return the BoundingBox of the given slices of scs's matrix."""
+        l,t = scs.matrix2sheet(rows.start,cols.start)
+        r,b = scs.matrix2sheet(rows.stop,cols.stop)
+        return BoundingBox(points=((l,b),(r,t)))
+
+
 
 class SeparatedComposite(Composite):
     """
@@ -1027,7 +1165,7 @@ class LogGaussian(PatternGenerator):
         """
         self.debug(lambda:"bounds=%s, xdensity=%s, ydensity=%s, x=%s, y=%s, orientation=%s"%(p.bounds, p.xdensity, p.ydensity, p.x, p.y, p.orientation))
 
-        x_points,y_points = SheetCoordinateSystem(p.bounds, p.xdensity, p.ydensity).sheetcoordinates_of_matrixidx()
+        x_points,y_points = _coordinate_vectors(p.bounds, p.xdensity, p.ydensity)
 
         self.pattern_x, self.pattern_y = self._create_and_rotate_coordinate_arrays(x_points-p.x, y_points-p.y, p)
         
@@ -1278,6 +1416,7 @@ class PowerSpectrum(PatternGenerator):
         
         self._previous_min_frequency = self.min_frequency
         self._previous_max_frequency = self.max_frequency
+        self._window_key = None
         
             
     def _create_frequency_indices(self):
@@ -1295,6 +1434,7 @@ class PowerSpectrum(PatternGenerator):
         max_freq = nonzero(available_frequency_range <= self.max_frequency)[0][-1]
         
         self._set_frequency_spacing(min_freq, max_freq)
+        self._create_band_indices()
           
               
     def _set_frequency_spacing(self, min_freq, max_freq): 
@@ -1308,9 +1448,54 @@ class PowerSpectrum(PatternGenerator):
         """
         
         self.frequency_spacing = linspace(min_freq, max_freq, num=self._sheet_dimensions[0]+1, endpoint=True)
+
+
+    def _create_band_indices(self):
+        """
+        Tabulate the frequency_spacing as the integer start and end
+        indices of each band, so that the amplitudes of all bands can
+        be averaged at once.
+
+        The bands are averaged into the start of the amplitude array
+        itself, so this can only be done all at once if no band
+        starts below its own index (otherwise a band would read
+        averages already written for earlier bands); _bands_in_place
+        records whether that is the case.
+        """
+        # (as always, the last two rows are not averaged)
+        num_bands = max([self._sheet_dimensions[0]-2,0])
+        
+        self._band_starts = self.frequency_spacing[0:num_bands].astype(int)
+        self._band_ends = self.frequency_spacing[1:num_bands+1].astype(int)
+        self._band_widths = self.frequency_spacing[1:num_bands+1] - self.frequency_spacing[0:num_bands]
+        self._band_indices = array(zip(self._band_starts,self._band_ends)).ravel()
+        self._bands_in_place = alltrue(self._band_starts >= arange(num_bands))
+        
+
+    def _band_sums(self, values):
+        """
+        Return the sum of values[start:end] for each band.
+        """
+        if len(self._band_starts) == 0:
+            return zeros(0)
+        
+        # (reduceat returns values[start] rather than 0 for an empty band)
+        return where(self._band_starts < self._band_ends, add.reduceat(values, self._band_indices)[::2], 0)
+
+
+    def _smoothing_window(self, sample_rate):
+        """
+        Return windowing_function(sample_rate), which is only
+        recalculated when the function or the sample rate changes.
+        """
+        if self._window_key != (self.windowing_function, sample_rate):
+            self._window_key = (self.windowing_function, sample_rate)
+            self._window = self.windowing_function(sample_rate)
             
-            
-    def _get_row_amplitudes(self):
+        return self._window
+
+
+    def _get_amplitudes(self):
         """
         Perform a real Discrete Fourier Transform (DFT; implemented using a Fast Fourier Transform algorithm, FFT) 
         of the current sample from the signal multiplied by the smoothing window.
@@ -1325,21 +1510,34 @@ class PowerSpectrum(PatternGenerator):
         signal_window = tile(signal_interval, ceil(1.0/self.signal.interval_length))
 
         if self.windowing_function:
-            smoothed_window = signal_window[0:sample_rate] * self.windowing_function(sample_rate)  
+            smoothed_window = signal_window[0:sample_rate] * self._smoothing_window(sample_rate)  
         else:
             smoothed_window = signal_window[0:sample_rate]
         
-        amplitudes = (abs(fft.rfft(smoothed_window))[0:sample_rate/2] + self.offset) * self.scale
+        return (abs(fft.rfft(smoothed_window))[0:sample_rate/2] + self.offset) * self.scale
+            
+            
+    def _get_row_amplitudes(self):
+        """
+        Average the amplitudes of the current sample over each band of
+        frequency_spacing, one band per sheet row.
+        """
+        amplitudes = self._get_amplitudes()
         
-        for index in range(0, self._sheet_dimensions[0]-2):
-            start_frequency = self.frequency_spacing[index]
-            end_frequency = self.frequency_spacing[index+1]
-             
-            normalisation_factor =  end_frequency - start_frequency
-            if normalisation_factor == 0:
-                amplitudes[index] = amplitudes[start_frequency]
-            else:
-                amplitudes[index] = sum(amplitudes[start_frequency:end_frequency]) / normalisation_factor
+        if self._bands_in_place:
+            widths = self._band_widths
+            averages = self._band_sums(amplitudes) / where(widths == 0, 1, widths)
+            amplitudes[0:len(widths)] = where(widths == 0, amplitudes[self._band_starts], averages)
+        else:
+            for index in range(0, self._sheet_dimensions[0]-2):
+                start_frequency = self._band_starts[index]
+                end_frequency = self._band_ends[index]
+                 
+                normalisation_factor = self._band_widths[index]
+                if normalisation_factor == 0:
+                    amplitudes[index] = amplitudes[start_frequency]
+                else:
+                    amplitudes[index] = sum(amplitudes[start_frequency:end_frequency]) / normalisation_factor
         
         return flipud(amplitudes[0:self._sheet_dimensions[0]].reshape(-1,1))
 
@@ -1372,6 +1570,11 @@ class Spectrogram(PowerSpectrum):
     """
     Extends PowerSpectrum to provide a temporal buffer, yielding
     a 2D representation of a fixed-width spectrogram.
+
+    The columns of previous iterations are kept in a circular buffer,
+    so each call only computes and stores the newest column; the
+    buffer is stored twice over, so that the columns in order of
+    latency are always available as a view.
     """
     
     min_latency = param.Integer(default=0, precedence=1,
@@ -1391,29 +1594,30 @@ class Spectrogram(PowerSpectrum):
                         
     
     def _shape_response(self, new_column):
+        """
+        Store new_column as the newest column of the spectrogram, and
+        return the spectrogram averaged over the latency range of each
+        sheet column.
+
+        When each sheet column corresponds to exactly one iteration,
+        the result is a view of the buffer, which will be overwritten
+        by later calls.
+        """
+        num_columns = self._buffer.shape[1]/2
         
-        millisecs_per_iteration = self.signal.seconds_per_iteration * 1000
-    
-        if millisecs_per_iteration > self.max_latency:
-            self._spectrogram[0:,0:] = new_column
-        else:
-            # Slide old values along, add new data to left hand side.
-            self._spectrogram[0:, millisecs_per_iteration:] = self._spectrogram[0:, 0:self._spectrogram.shape[1]-millisecs_per_iteration]
-            self._spectrogram[0:, 0:millisecs_per_iteration] = new_column
-        
-        sheet_representation = zeros(self._sheet_dimensions)
+        self._buffer_start = (self._buffer_start-1) % num_columns
+        self._buffer[0:, self._buffer_start] = new_column[0:, 0]
+        self._buffer[0:, self._buffer_start+num_columns] = new_column[0:, 0]
         
-        for column in range(0,self._sheet_dimensions[1]):
-            start_latency = self._latency_spacing[column]
-            end_latency = self._latency_spacing[column+1]
-                        
-            normalisation_factor = end_latency - start_latency
-            if normalisation_factor > 1:
-                sheet_representation[0:, column] = sum(self._spectrogram[0:, start_latency:end_latency], axis=1) / normalisation_factor
-            else:
-                sheet_representation[0:, column] = self._spectrogram[0:, start_latency]
-                        
-        return sheet_representation
+        # columns in order of latency, newest first
+        spectrogram = self._buffer[0:, self._buffer_start:self._buffer_start+num_columns]
+
+        if self._column_weights is not None:
+            return dot(spectrogram, self._column_weights)
+        elif self._column_iterations is not None:
+            return spectrogram.take(self._column_iterations, axis=1)
+        else:
+            return spectrogram
     
                  
     def set_matrix_dimensions(self, bounds, xdensity, ydensity):
@@ -1422,15 +1626,47 @@ class Spectrogram(PowerSpectrum):
         
     
     def _create_latency_indices(self):
+        """
+        Tabulate which iterations (i.e. buffer columns) contribute to
+        each sheet column.
+
+        Each sheet column averages a range of latencies (in
+        milliseconds), and each latency shows the column from the
+        iteration that covered it; sheet columns whose range lies
+        within one iteration can simply be taken from the buffer.
+        """
         if self.min_latency >= self.max_latency:
             raise ValueError("Spectrogram: min latency must be lower than max latency.")     
 
+        self._previous_millisecs_per_iteration = self.signal.seconds_per_iteration * 1000
+        millisecs_per_iteration = max([int(self._previous_millisecs_per_iteration),1])
+        num_columns = (self.max_latency-1)/millisecs_per_iteration + 1
+        
         self._latency_spacing = floor(linspace(self.min_latency, self.max_latency, num=self._sheet_dimensions[1]+1, endpoint=True))
-        self._spectrogram = zeros([self._sheet_dimensions[0],self.max_latency])
+
+        # number of each column's latencies falling in each iteration
+        counts = zeros([num_columns,self._sheet_dimensions[1]])
+        for column in range(0,self._sheet_dimensions[1]):
+            start_latency = int(self._latency_spacing[column])
+            end_latency = max([int(self._latency_spacing[column+1]),start_latency+1])
+
+            for latency in range(start_latency,end_latency):
+                counts[latency/millisecs_per_iteration,column] += 1
+        weights = counts / counts.sum(axis=0)
+
+        self._column_weights = self._column_iterations = None
+        if not alltrue(weights.max(axis=0) == 1.0):
+            self._column_weights = weights
+        elif weights.shape[0] != weights.shape[1] or not alltrue(weights.argmax(axis=0) == arange(num_columns)):
+            self._column_iterations = weights.argmax(axis=0)
+
+        self._buffer = zeros([self._sheet_dimensions[0],2*num_columns])
+        self._buffer_start = 0
         
 
     def __call__(self):        
-        if self._previous_min_latency != self.min_latency or self._previous_max_latency != self.max_latency:
+        if self._previous_min_latency != self.min_latency or self._previous_max_latency != self.max_latency or \
+               self._previous_millisecs_per_iteration != self.signal.seconds_per_iteration * 1000:
             self._previous_min_latency = self.min_latency
             self._previous_max_latency = self.max_latency
             self._create_latency_indices()
@@ -95,6 +95,9 @@ class PatternSampler(ImageSampler):
         # representing the image
         if not isinstance(image,numpy.ndarray):
             image = array(image,Float)
+        elif self.whole_pattern_output_fns and not image.flags.writeable:
+            # The whole_pattern_output_fns modify the image in place
+            image = array(image,Float)
 
         rows,cols = image.shape
         self.scs = SheetCoordinateSystem(xdensity=1.0,ydensity=1.0,
@@ -381,3 +384,122 @@ class FileImage(GenericImage):
 
 
 
+
+
+
+class ImageDataset(param.Parameterized):
+    """
+    A collection of grayscale images stored in a single array file,
+    as created by create_image_dataset().
+
+    The file is memory mapped read-only, so that accessing an image
+    requires neither decoding it nor copying it, and so that several
+    processes (e.g. batch runs or MPI ranks) using the same file share
+    a single copy in the operating system's page cache.
+
+    The dataset's index, listing the position, shape, and original
+    filename of each image, is stored in a text file alongside the
+    array file, with '.index' appended to its name.
+    """
+
+    filename = param.Filename(default=None,doc="""
+        File path (can be relative to Topographica's base path) to the
+        array file created by create_image_dataset().""")
+
+    
+    def __init__(self,**params):
+        super(ImageDataset,self).__init__(**params)
+        self._data = None
+        self.offsets,self.shapes,self.image_filenames = [],[],[]
+        for line in open(self.filename+'.index'):
+            offset,rows,cols,image_filename = line.rstrip('\n').split(' ',3)
+            self.offsets.append(int(offset))
+            self.shapes.append((int(rows),int(cols)))
+            self.image_filenames.append(image_filename)
+
+
+    def __getitem__(self,i):
+        """
+        Return image i, as a read-only array of 8-bit grayscale
+        values that shares memory with the file.
+        """
+        if self._data is None:
+            # (a plain array view, because memmaps cannot be pickled)
+            self._data = numpy.asarray(numpy.load(self.filename,mmap_mode='r'))
+        rows,cols = self.shapes[i]
+        offset = self.offsets[i]
+        return self._data[offset:offset+rows*cols].reshape(rows,cols)
+
+
+    def __getstate__(self):
+        # The file is mapped again when an image is next requested
+        state = super(ImageDataset,self).__getstate__()
+        state['_data'] = None
+        return state
+
+
+
+def create_image_dataset(images,filename):
+    """
+    Convert the given images once into a single array file that can
+    be used by an ImageDataset, and return the ImageDataset.
+
+    images is a list of image file paths, or the path to a directory
+    whose image files should be used (in sorted order).  Each image
+    is converted to grayscale, as for FileImage.  The array file is
+    written to the given filename (relative to the output path, if
+    not absolute), with its index alongside.
+    """
+    import os
+    from numpy.lib.format import open_memmap
+
+    if isinstance(images,str):
+        directory = param.resolve_path(images,path_to_file=False)
+        images = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory,name)
+            try:
+                Image.open(path)
+            except IOError:
+                continue
+            images.append(path)
+    images = [os.path.abspath(param.resolve_path(path)) for path in images]
+
+    # Only the image headers need to be read to find the sizes
+    sizes = [Image.open(path).size for path in images]
+    filename = param.normalize_path(filename)
+    data = open_memmap(filename,mode='w+',dtype=numpy.uint8,
+                       shape=(int(numpy.sum([w*h for w,h in sizes])),))
+    index = open(filename+'.index','w')
+    offset = 0
+    for path,(cols,rows) in zip(images,sizes):
+        data[offset:offset+rows*cols] = numpy.asarray(ImageOps.grayscale(Image.open(path))).ravel()
+        index.write('%d %d %d %s\n'%(offset,rows,cols,path))
+        offset += rows*cols
+    index.close()
+    del data
+
+    return ImageDataset(filename=filename)
+
+
+
+class DatasetImage(GenericImage):
+    """
+    2D Image generator that takes the image from an ImageDataset.
+
+    Produces the same patterns as a FileImage for the corresponding
+    file, but without having to load and decode the file whenever a
+    different image is selected.
+    """
+
+    dataset = param.ClassSelector(ImageDataset,default=None,precedence=0.9,doc="""
+        The ImageDataset from which to take the image.""")
+
+    index = param.Integer(default=0,bounds=(0,None),precedence=0.91,doc="""
+        Index of the image in the dataset.  Can be set to a random
+        number generator (e.g. numbergen.UniformRandomInt) to select a
+        different image for each presentation.""")
+
+    
+    def _get_image(self,p):
+        return p.dataset[p.index]
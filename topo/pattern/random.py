@@ -10,9 +10,8 @@ import numpy
 import param
 from param.parameterized import ParamOverrides
 
-from topo.base.patterngenerator import PatternGenerator
+from topo.base.patterngenerator import PatternGenerator, _coordinate_vectors
 from topo.pattern import Composite, Gaussian
-from topo.base.sheetcoords import SheetCoordinateSystem
 
 
 def seed(seed=None):
@@ -54,7 +53,8 @@ class RandomGenerator(PatternGenerator):
     def __call__(self,**params_to_override):
         p = ParamOverrides(self,params_to_override)
 
-        shape = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape
+        x_points,y_points = _coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+        shape = (len(y_points),len(x_points))
 
         result = self._distrib(shape,p)
         self._apply_mask(p,result)
@@ -15,7 +15,7 @@ from topo.base.cf import CFPResponseFn, CFPRF_Plugin
 from topo.misc.inlinec import inline,provide_unoptimized_equivalent,\
      c_header,c_decorators
 from topo.misc.pyxhandler import provide_unoptimized_equivalent_cy
-from topo.responsefn.projfn import CFPRF_EuclideanDistance
+from topo.responsefn.projfn import CFPRF_EuclideanDistance,CFPRF_DotProduct_batched
 
 
 # CEBALERT: this function works for 1D arrays; the docstring below is
@@ -34,6 +34,9 @@ class CFPRF_DotProduct_opt(CFPResponseFn):
     single_cf_fn = param.ClassSelector(ResponseFn,DotProduct(),readonly=True)    
 
     def __call__(self, iterator, input_activity, activity, strength, **params):
+        if iterator.weight_store is not None:
+            self._packed_call(iterator, input_activity, activity, strength)
+            return
        
         temp_act = activity
         irows,icols = input_activity.shape
@@ -86,6 +89,53 @@ class CFPRF_DotProduct_opt(CFPResponseFn):
         inline(code, ['mask','X', 'strength', 'icols', 'temp_act','cfs','num_cfs','cf_type'], 
                local_dict=locals(), headers=['<structmember.h>'])
 
+
+    def _packed_call(self, iterator, input_activity, activity, strength):
+        """
+        Same as __call__, but for CFs whose weights are packed into
+        a CFWeightStore, so that no per-CF Python objects are accessed.
+        """
+        temp_act = activity
+        irows,icols = input_activity.shape
+        X = input_activity.ravel()
+        store = iterator.weight_store
+        weights = store.weights
+        offsets = store.offsets
+        slices = store.slices
+        num_cfs = len(offsets)
+        mask = iterator.mask.data
+
+        code = c_header + """
+            %(cfs_loop_pragma)s
+            for (int r=0; r<num_cfs; ++r) {
+                if(mask[r] == 0.0)
+                    temp_act[r] = 0;
+                else {
+                    float *wi = weights + offsets[r];
+                    int *input_sheet_slice = slices + 4*r;
+
+                    UNPACK_FOUR_TUPLE(int,rr1,rr2,cc1,cc2,input_sheet_slice);
+
+                    double tot = 0.0;
+                    npfloat *xj = X+icols*rr1+cc1;
+
+                    // computes the dot product
+                    for (int i=rr1; i<rr2; ++i) {
+                        npfloat *xi = xj;
+                        for (int j=cc1; j<cc2; ++j) {
+                            tot += *wi * *xi;
+                            ++wi;
+                            ++xi;
+                        }
+                        xj += icols;
+                    }  
+                    temp_act[r] = tot*strength;
+                }
+            }
+        """%c_decorators
+        inline(code, ['mask','X', 'strength', 'icols', 'temp_act','weights',
+                      'offsets','slices','num_cfs'], local_dict=locals())
+
 class CFPRF_DotProduct(CFPRF_Plugin):
     """
     Wrapper written to allow transparent non-optimized fallback; 
@@ -95,7 +145,9 @@ class CFPRF_DotProduct(CFPRF_Plugin):
     def __init__(self,**params):
         super(CFPRF_DotProduct,self).__init__(single_cf_fn=DotProduct(),**params)
 
-provide_unoptimized_equivalent("CFPRF_DotProduct_opt","CFPRF_DotProduct",locals())
+# Without a compiler, fall back to the numpy version, which is much
+# faster than CFPRF_DotProduct (though still slower than the C one).
+provide_unoptimized_equivalent("CFPRF_DotProduct_opt","CFPRF_DotProduct_batched",locals())
 
 
 try:
@@ -103,7 +155,7 @@ try:
 except:
     pass
 
-provide_unoptimized_equivalent_cy("CFPRF_DotProduct_cyopt","CFPRF_DotProduct",locals())
+provide_unoptimized_equivalent_cy("CFPRF_DotProduct_cyopt","CFPRF_DotProduct_batched",locals())
 
 
 
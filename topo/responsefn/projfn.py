@@ -8,7 +8,9 @@ $Id$
 """
 __version__='$Revision$'
 
-from numpy import sum,exp,zeros,ravel
+from numpy import sum,exp,zeros,ravel,flatnonzero,einsum,int32,\
+     concatenate,array_equal,ascontiguousarray,ndarray,array,arange,\
+     logical_and,minimum,clip,dot
 from numpy.oldnumeric import Float
 
 import param
@@ -21,6 +23,233 @@ from topo.base.arrayutil import L2norm
 from topo.base.cf import CFPRF_Plugin
 
 
+class CFPRF_DotProduct_batched(CFPResponseFn):
+    """
+    Dot-product response function computed with whole-array numpy operations.
+
+    Equivalent to CFPRF_Plugin(single_cf_fn=DotProduct()), but
+    usually much faster, and (unlike CFPRF_DotProduct_opt) does not
+    require a C compiler.
+
+    Most CFs fall into runs of units with identically shaped CFs that
+    are evenly spaced both on the input sheet and in the weight
+    buffer: typically, a row of units in the interior of the sheet,
+    or a column of units along its left or right edge (where the CFs
+    are cropped).  The inputs under all the CFs in a run are then a
+    strided view of the input activity, their weights a strided view
+    of the weight buffer, and all their dot products are computed in
+    a single operation without copying either.  The runs are worked
+    out once, and again only if the CF slices change.
+
+    The remaining CFs (e.g. in the corners of the sheet, or all of
+    them if the ratio of the source and destination densities is
+    not simple) are processed in batches, gathering their inputs and
+    weights (zero-padded to the largest CF shape) using arrays of
+    flat indices, or one at a time if they are large.
+
+    Works best when the projection has a CFWeightStore (see
+    CFProjection.pack_weights).  Otherwise, the weights of all the CFs
+    have to be copied into a temporary buffer on each call.
+    """
+
+    single_cf_fn = param.ClassSelector(ResponseFn,DotProduct(),readonly=True)
+
+    min_run_length = param.Integer(default=8,bounds=(2,None),doc="""
+        Minimum number of units in a run; CFs in shorter runs are
+        processed in batches instead.""")
+
+    max_gather_size = param.Integer(default=200,bounds=(0,None),doc="""
+        Maximum size of CF (in number of weights) for which CFs not
+        in runs are processed in batches; larger CFs are processed
+        one at a time.""")
+
+    max_batch_size = param.Integer(default=1024,bounds=(1,None),doc="""
+        Maximum number of CFs to process in one batch, limiting the
+        size of the temporary arrays used.""")
+
+    def __init__(self,**params):
+        super(CFPRF_DotProduct_batched,self).__init__(**params)
+        self._plan_slices = None
+        self._runs = None
+        self._others = None
+
+
+    def _unpacked_store(self,cfs):
+        """
+        Return the slices, sizes, offsets, and weights of the given
+        CFs, laid out as in a CFWeightStore (but without modifying
+        the CFs).
+        """
+        slices = zeros((len(cfs),4),dtype=int32)
+        sizes = zeros(len(cfs),dtype=int32)
+        for i,cf in enumerate(cfs):
+            if cf is not None:
+                slices[i] = cf.input_sheet_slice
+                sizes[i] = cf.weights.size
+        offsets = zeros(len(cfs),dtype=int32)
+        offsets[1:] = sizes.cumsum()[:-1]
+        weights = concatenate([cf.weights.ravel() for cf in cfs if cf is not None])
+        return slices,sizes,offsets,weights
+
+
+    def _find_runs(self,slices,offsets,units):
+        """
+        Return each maximal sequence of at least min_run_length of
+        the given units (taken in order) that have CFs of the same
+        shape, with constant, non-negative steps between successive
+        units' indexes, CF positions, and weight offsets.
+        """
+        def step(u,v):
+            return (v-u,slices[v,0]-slices[u,0],slices[v,2]-slices[u,2],offsets[v]-offsets[u])
+        def shape(u):
+            return (slices[u,1]-slices[u,0],slices[u,3]-slices[u,2])
+
+        runs = []
+        i = 0
+        while i < len(units)-1:
+            j = i+1
+            s = step(units[i],units[j])
+            if min(s)>=0 and s[0]>0:
+                while (j < len(units) and step(units[j-1],units[j])==s and
+                       shape(units[j])==shape(units[i])):
+                    j += 1
+            if j-i >= self.min_run_length:
+                u = units[i]
+                runs.append((u,slices[u,0],slices[u,2],offsets[u],j-i,s,shape(u)))
+                i = j
+            else:
+                i += 1
+        return runs
+
+
+    def _plan(self,slices,sizes,offsets,shape):
+        """
+        Find runs of units along each row, and then down each column
+        for the units left over (including runs of every second,
+        third, etc. unit, as found when the destination density is a
+        multiple of the source density); return the runs and the
+        units in none of them.
+        """
+        rows,cols = shape
+        remaining = set(flatnonzero(sizes))
+        runs = []
+        for lines in ([range(r*cols,(r+1)*cols) for r in range(rows)],
+                      [range(c,rows*cols,cols) for c in range(cols)]):
+            for k in range(1,5):
+                for line in lines:
+                    line = [u for u in line if u in remaining]
+                    for m in range(k):
+                        for run in self._find_runs(slices,offsets,line[m::k]):
+                            runs.append(run)
+                            u,n,du = run[0],run[4],run[5][0]
+                            remaining.difference_update(range(u,u+n*du,du))
+        return runs,array(sorted(remaining),dtype=int)
+
+
+    def __call__(self, iterator, input_activity, activity, strength, **params):
+        store = iterator.weight_store
+        if store is not None:
+            slices,sizes,offsets,weights = store.slices,store.sizes,store.offsets,store.weights
+        else:
+            slices,sizes,offsets,weights = self._unpacked_store(iterator.flatcfs)
+
+        if self._plan_slices is None or not array_equal(slices,self._plan_slices):
+            self._runs,self._others = self._plan(slices,sizes,offsets,activity.shape)
+            self._plan_slices = slices.copy()
+
+        activity *= 0.0
+        X = ascontiguousarray(input_activity)
+        self._sum_runs(X,activity,weights)
+        self._sum_others(X,activity,weights,slices[self._others],offsets[self._others])
+
+        # Masked-out units are not active
+        activity *= iterator.mask.data!=0
+        activity *= strength
+
+
+    def _sum_runs(self,X,activity,weights):
+        s0,s1 = X.strides
+        ws = weights.itemsize
+        for u,r,c,o,n,(du,dr,dc,do),(h,w) in self._runs:
+            inputs = ndarray((n,h,w),X.dtype,X,r*s0+c*s1,(dr*s0+dc*s1,s0,s1))
+            cfweights = ndarray((n,h,w),weights.dtype,weights,o*ws,(do*ws,w*ws,ws))
+            activity.flat[u:u+(n-1)*du+1:du] = einsum('ijk,ijk->i',inputs,cfweights)
+
+
+    def _sum_others(self,X,activity,weights,slices,offsets):
+        if len(slices)==0:
+            return
+        H,W = (slices[:,1]-slices[:,0]).max(),(slices[:,3]-slices[:,2]).max()
+        if H*W > self.max_gather_size:
+            # Large CFs: the overhead of computing each dot product
+            # separately is small compared to that of gathering
+            for u,(r1,r2,c1,c2),o in zip(self._others,slices,offsets):
+                activity.flat[u] = dot(X[r1:r2,c1:c2].ravel(),weights[o:o+(r2-r1)*(c2-c1)])
+            return
+
+        flatX = X.ravel()
+        icols = X.shape[1]
+        # flat offsets of the inputs in an HxW block relative to its top left corner
+        window = (arange(H)[:,None]*icols + arange(W)).ravel()
+
+        for start in xrange(0,len(slices),self.max_batch_size):
+            batch = slice(start,start+self.max_batch_size)
+            r1,r2,c1,c2 = slices[batch].T
+            n = len(r1)
+
+            # Position each CF in an HxW box that covers it, with zero
+            # weights where the box extends beyond the CF.  The inputs
+            # under those zero weights are irrelevant, so their
+            # indices need only be in range.
+            box_r1,box_c1 = minimum(r1,r2-H),minimum(c1,c2-W)
+            inputs = flatX.take(clip((box_r1*icols+box_c1)[:,None] + window,0,flatX.size-1))
+
+            rows = arange(H)[None,:] - (r1-box_r1)[:,None]
+            cols = arange(W)[None,:] - (c1-box_c1)[:,None]
+            cf_cols = (c2-c1)[:,None]
+            inside = logical_and(logical_and(rows>=0,rows<(r2-r1)[:,None])[:,:,None],
+                                 logical_and(cols>=0,cols<cf_cols)[:,None,:])
+            idx = offsets[batch][:,None,None] + rows[:,:,None]*cf_cols[:,:,None] + cols[:,None,:]
+            cfweights = (weights.take(idx*inside)*inside).reshape(n,H*W)
+
+            activity.flat[self._others[batch]] = einsum('ij,ij->i',inputs,cfweights)
+
+
+
+class CFPRF_DotProduct_sparse(CFPResponseFn):
+    """
+    Dot-product response function computed as a sparse matrix-vector product.
+
+    Equivalent to CFPRF_Plugin(single_cf_fn=DotProduct()), but treats
+    the whole projection as one scipy.sparse CSR matrix (see
+    CFWeightStore.csr_matrix()), so that the response is computed in a
+    single call to scipy's compiled sparse kernels.  Useful mainly for
+    projections with very many small CFs, where looping over the CFs
+    dominates.
+
+    Requires scipy, and a projection with a CFWeightStore (see
+    CFProjection.pack_weights).
+    """
+
+    single_cf_fn = param.ClassSelector(ResponseFn,DotProduct(),readonly=True)
+
+    def __call__(self, iterator, input_activity, activity, strength, **params):
+        store = iterator.weight_store
+        if store is None:
+            raise ValueError("%s requires a projection with pack_weights=True."%self.__class__.__name__)
+
+        W = store.csr_matrix(input_activity.shape)
+        # Converting the input to the weights' type (rather than
+        # letting scipy convert all the weights to the input's type
+        # on every call) is much faster, at the cost of accumulating
+        # the sums in single precision.
+        activity.flat[:] = W*input_activity.ravel().astype(W.dtype)
+        # Masked-out units are not active
+        activity *= iterator.mask.data!=0
+        activity *= strength
+
+
+
 # CEBERRORALERT: doesn't use iterator, so ignores
 # sheet mask!
 class CFPRF_EuclideanDistance(CFPResponseFn):
@@ -112,29 +112,13 @@ def compute_joint_norm_totals(projlist,active_units_mask=True):
     # Assumes that all Projections in the list have the same r,c size
     # AND that all have the same mask
     assert len(projlist)>=1
-    
-
-    norm_totals_data = []
-    norm_totals = []
-
-    
-    for p in projlist:
-        norm_totals_data.append(p.get_masked_norm_totals(active_units_mask=active_units_mask))
-    
-    for i in range(0,len(norm_totals_data[0])):
-        norm_totals.append([n[i] for n in norm_totals_data])
-    
-    new_norm_totals = []
-    
-    
-    
-    for n in norm_totals:
-        joint_sum = numpy.add.reduce(n)
-        new_norm_totals.append(joint_sum)
 
+    norm_totals = [p.get_masked_norm_totals(active_units_mask=active_units_mask)
+                   for p in projlist]
+    joint_sums = numpy.add.reduce(norm_totals)
 
     for p in projlist:
-        p.set_masked_norm_totals(new_norm_totals)
+        p.set_masked_norm_totals(joint_sums)
 
 
 class JointNormalizingCFSheet(CFSheet):
@@ -149,11 +133,11 @@ class JointNormalizingCFSheet(CFSheet):
     This class provides a mechanism for grouping Projections (see
     _port_match and _grouped_in_projections) and a learn() function
     that computes the joint sums.  Joint normalization also requires
-    having ConnectionField store and return a norm_total for each
-    neuron, and having an TransferFn that will respect this norm_total
-    rather than the strict total of the ConnectionField's weights.  At
-    present, CFPOF_DivisiveNormalizeL1 and
-    CFPOF_DivisiveNormalizeL1_opt do use norm_total; others can be
+    having each CFProjection store a norm_total for each neuron (in
+    its norm_totals array), and having an TransferFn that will respect
+    this norm_total rather than the strict total of the
+    ConnectionField's weights.  At present, CFPOF_DivisiveNormalizeL1
+    and CFPOF_DivisiveNormalizeL1_opt do use norm_total; others can be
     extended to do something similar if necessary.
 
     To enable joint normalization, you can declare that all the
@@ -189,12 +173,13 @@ class JointNormalizingCFSheet(CFSheet):
                 normtype='Individually'
             else:
                 normtype='Jointly'
-                self.joint_norm_fn(projlist,active_units_mask)
+                self._profiled(key,'joint_norm_fn',self.joint_norm_fn,projlist,active_units_mask)
 
             self.debug(normtype + " normalizing:")
 
             for p in projlist:
-                p.apply_learn_output_fns(active_units_mask=active_units_mask)
+                self._profiled(p.name,'learn_output_fns',p.apply_learn_output_fns,
+                               active_units_mask=active_units_mask)
                 self.debug('  ',p.name)
 
 
@@ -208,7 +193,7 @@ class JointNormalizingCFSheet(CFSheet):
             if not isinstance(proj,Projection):
                 self.debug("Skipping non-Projection "+proj.name)
             else:
-                proj.learn()
+                self._profiled(proj.name,'learn',proj.learn)
 
         # Apply output function in groups determined by dest_port
         self._normalize_weights()
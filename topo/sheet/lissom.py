@@ -12,7 +12,8 @@ import param
 
 import topo
 
-from topo.base.projection import Projection
+from topo.base.projection import Projection, SheetMask
+from topo.base.cf import MPI_Settling
 from topo.base.sheet import activity_type
 from topo.base.simulation import EPConnectionEvent
 from topo.transferfn.basic import PiecewiseLinear
@@ -54,6 +55,30 @@ class LISSOM(JointNormalizingCFSheet):
         Whether to modify the weights after every settling step.
         If false, waits until settling is completed before doing learning.""")
 
+    mpi_settle = param.Boolean(default=False,doc="""
+        Whether to run all the settling steps on the MPI nodes, when
+        all the projections to this sheet are MPI_CFProjections.
+
+        Otherwise, every settling step goes through the controller:
+        the activity of each lateral projection is gathered onto the
+        controller, summed and passed through the output_fns there,
+        and the result sent back out to the nodes for the next step.
+        With mpi_settle, once the afferent activity has arrived, the
+        nodes instead do all tsettle steps themselves, exchanging
+        only the parts of the activity read by each other's lateral
+        CFs, and only the settled activity is sent to the controller
+        (see topo.base.cf.MPI_Settling).  Other sheets then receive
+        only the settled activity, rather than that of every step.
+
+        Must be set before the projections are connected, so that
+        they all divide the units among the nodes in the same way.
+        Not supported with continuous_learning.  The intermediate
+        settling steps never reach the controller, so a mask that is
+        calculated from the activity (i.e. one overriding
+        SheetMask.calculate()) can only be used if mask_init_time is
+        0 or tsettle; the output_fns must process each unit on its
+        own, without state (see topo.base.cf.MPI_Settling).""")
+
     output_fns = param.HookList(default=[PiecewiseLinear(lower_bound=0.1,upper_bound=0.65)])
     
     precedence = param.Number(0.6)
@@ -74,6 +99,7 @@ class LISSOM(JointNormalizingCFSheet):
         self.__counter_stack=[]
         self.activation_count = 0
         self.new_iteration = True
+        self._mpi_settling = None
 
 
     def start(self):
@@ -116,6 +142,9 @@ class LISSOM(JointNormalizingCFSheet):
             
             if self.activation_count == self.mask_init_time:
                 self.mask.calculate()
+
+            if self.mpi_settle and self.tsettle > 0 and self.activation_count == 0:
+                self._settle_on_nodes()
             
             if self.tsettle == 0:
                 # Special case: behave just like a CFSheet
@@ -140,6 +169,27 @@ class LISSOM(JointNormalizingCFSheet):
                    self.learn()
                    
 
+    def _settle_on_nodes(self):
+        """
+        Do all the settling steps on the MPI nodes (see mpi_settle),
+        leaving the sheet as after the last one.
+        """
+        if self.continuous_learning:
+            raise ValueError("mpi_settle is not supported with continuous_learning.")
+        mask_calculated = type(self.mask).calculate.im_func is not SheetMask.calculate.im_func
+        if mask_calculated and 0 < self.mask_init_time < self.tsettle:
+            raise ValueError("mpi_settle does not support calculating the mask of %s during settling (mask_init_time must be 0 or tsettle)."%self.name)
+
+        if getattr(self,'_mpi_settling',None) is None or self._mpi_settling.projections != self.in_connections:
+            self._mpi_settling = MPI_Settling(self)
+        self._mpi_settling(self.tsettle)
+
+        if self.mask_init_time == self.tsettle:
+            self.mask.calculate()
+        self.activation_count = self.tsettle
+        self.send_output(src_port='Activity',data=self.activity)
+
+
     # print the weights of a unit
     def printwts(self,x,y):
         for proj in self.in_connections:
@@ -156,6 +206,13 @@ class LISSOM(JointNormalizingCFSheet):
         super(LISSOM,self).state_pop(**args)
         self.activation_count,self.new_iteration=self.__counter_stack.pop()
 
+
+    def __getstate__(self):
+        # (the nodes' part of settling is recreated when next needed)
+        state = super(LISSOM,self).__getstate__()
+        state['_mpi_settling'] = None
+        return state
+
     def send_output(self,src_port=None,data=None):
         """Send some data out to all connections on the given src_port."""
         
@@ -163,6 +220,9 @@ class LISSOM(JointNormalizingCFSheet):
                                  if self._port_match(conn.src_port,[src_port])]
 
         for conn in out_conns_on_src_port:
+            if self.mpi_settle and conn.dest is self:
+                # (the lateral projections are activated on the nodes)
+                continue
             if self.strict_tsettle != None:
                if self.activation_count < self.strict_tsettle:
                    if len(conn.dest_port)>2 and conn.dest_port[2] == 'Afferent':
@@ -253,6 +313,7 @@ class JointScaling(LISSOM):
             if key is not None:
                 if key =='Afferent':
                     for proj in projlist:
+                        proj.wait_for_activity()
                         joint_total += proj.activity
                     self.calculate_joint_sf(joint_total)
                     if self.apply_scaling:   
@@ -295,6 +356,7 @@ class JointScaling(LISSOM):
             self.do_joint_scaling()   
 
         for proj in self.in_connections:
+            proj.wait_for_activity()
             self.activity += proj.activity
         
         if self.apply_output_fns:
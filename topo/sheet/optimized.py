@@ -5,19 +5,23 @@ $Id$
 """
 __version__='$Revision$'
 
+from numpy import add
+
 import param
 
 from topo.base.cf import MaskedCFIter
 from topo.base.projection import NeighborhoodMask
 from topo.misc.inlinec import inline,provide_unoptimized_equivalent,c_header
 from topo.sheet.lissom import LISSOM
-from topo.sheet.basic import compute_joint_norm_totals
 
 def compute_joint_norm_totals_opt(projlist,active_units_mask):
     """
     Compute norm_total for each CF in each projections from a
     group to be normalized jointly.  The same assumptions are
     made as in the original function.
+
+    Operates directly on the norm_totals arrays of the projections,
+    so that the joint sums are a single array addition.
     """
     # Assumes that all Projections in the list have the same r,c size
     length = len(projlist)
@@ -25,48 +29,14 @@ def compute_joint_norm_totals_opt(projlist,active_units_mask):
 
     proj = projlist[0]
     iterator = MaskedCFIter(proj,active_units_mask=active_units_mask)
-    num_cfs = len(proj.flatcfs)
-    active_units_mask = iterator.get_active_units_mask()
-    sheet_mask = iterator.get_sheet_mask()
-
-    code = c_header + """
-        npfloat *x = active_units_mask;
-        npfloat *m = sheet_mask;
-        for (int r=0; r<num_cfs; ++r) {
-            double load = *x++;
-            double msk = *m++;
-            if (msk!=0 && load != 0) {
-                double nt = 0;
-
-                for(int p=0; p<length; p++) {
-                    PyObject *proj = PyList_GetItem(projlist,p);
-                    PyObject *cfs = PyObject_GetAttrString(proj,"flatcfs");
-                    PyObject *cf = PyList_GetItem(cfs,r);
-                    PyObject *o = PyObject_GetAttrString(cf,"norm_total");
-                    nt += PyFloat_AsDouble(o);
-                    Py_DECREF(cfs);
-                    Py_DECREF(o);
-                }
+    units = iterator.get_overall_mask().ravel().nonzero()[0]
 
-                for(int p=0; p<length; p++) {
-                    PyObject *proj = PyList_GetItem(projlist,p);
-                    PyObject *cfs = PyObject_GetAttrString(proj,"flatcfs");
-                    PyObject *cf = PyList_GetItem(cfs,r);
-                    PyObject *total_obj = PyFloat_FromDouble(nt);  //(new ref)
-                    PyObject_SetAttrString(cf,"_norm_total",total_obj);
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_True);
-                    Py_DECREF(cfs);
-                    Py_DECREF(total_obj);
-                }
-            }
+    joint_sums = add.reduce([p.get_norm_totals(units) for p in projlist])
 
-        }
-    """    
-    inline(code, ['projlist','active_units_mask','sheet_mask','num_cfs','length'], 
-           local_dict=locals())
+    for p in projlist:
+        p.norm_totals[units] = joint_sums
+        p.has_norm_totals[units] = True
 
-provide_unoptimized_equivalent("compute_joint_norm_totals_opt",
-                               "compute_joint_norm_totals",locals())
 
 # CEBALERT: not tested
 class LISSOM_Opt(LISSOM):
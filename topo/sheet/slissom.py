@@ -95,6 +95,7 @@ class SLISSOM(LISSOM):
         self.activity *= 0.0
 
         for proj in self.in_connections:
+            proj.wait_for_activity()
             self.activity += proj.activity
 
         if self.apply_output_fns:
@@ -9,7 +9,7 @@ $Id$
 __version__='$Revision$'
 
 
-import pickle, copy, __main__, timeit, os, os.path, socket, cPickle, inspect, traceback, tempfile, shutil
+import pickle, copy, __main__, timeit, os, os.path, socket, cPickle, inspect, traceback, tempfile, shutil, sys
 
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
@@ -74,6 +74,38 @@ def _run_in_forked_process(func, *args, **kwds):
         os._exit(0)
 
 
+def _call_in_forked_process(func, *args, **kwds):
+    """
+    As _run_in_forked_process(), but return func's result (which must
+    be picklable), or None if func raised an exception.
+    """
+    sys.stdout.flush()
+    r,w = os.pipe()
+    pid = os.fork()
+    if pid > 0:
+        os.close(w)
+        f = os.fdopen(r,'rb')
+        try:
+            result = cPickle.load(f)
+        except EOFError:
+            result = None
+        f.close()
+        os.waitpid(pid, 0)
+        return result
+    else:
+        os.close(r)
+        try:
+            result = func(*args, **kwds)
+        except:
+            traceback.print_exc()
+            result = None
+        f = os.fdopen(w,'wb')
+        cPickle.dump(result,f,2)
+        f.close()
+        sys.stdout.flush()
+        os._exit(0)
+
+
 def _instantiate_everything(
     classes_to_exclude=("topo.base.simulation.Simulation","topo.base.simulation.Simulation"),
     modules_to_exclude=('plotting','tests','tkgui','command','util')):
@@ -446,6 +478,235 @@ def compare_startup_speed_data(script):
 ###########################################################################
 
 
+###########################################################################
+### benchmarks
+
+# Unlike the speed-tests, which time only training, the benchmarks time
+# each stage of using a model, at several densities, and save the
+# results as JSON so that they can be compared across versions and
+# machines.
+
+BENCHMARKSCRIPTS = ["tiny.ty","lissom_or.ty","lissom_oo_or.ty","gcal.ty"]
+BENCHMARK_DENSITIES = [24,48]
+BENCHMARK_ITERATIONS = 100
+# percentage slowdown (or increase in memory) reported as a regression
+BENCHMARK_THRESHOLD = 10.0
+
+# (measured quantity, True if larger is better)
+_benchmark_measures = [('startup',False),('connect',False),
+                       ('iterations_per_second',True),('measure_or_pref',False),
+                       ('save_snapshot',False),('load_snapshot',False),
+                       ('peak_memory_mb',False)]
+
+
+def _json():
+    try:
+        import json
+    except ImportError: # Python 2.5
+        import simplejson as json
+    return json
+
+
+def _benchmark_script(script,cortex_density,iterations):
+    """
+    Time each stage of using the given script with the given
+    cortex_density, returning a dictionary of the times (in seconds)
+    and the peak memory usage.  Should be run in a fresh process.
+    """
+    from topo.base.simulation import Profiler
+    from topo.misc.memuse import peaksize
+    from topo.command.basic import save_snapshot, load_snapshot
+    from topo.command.analysis import measure_or_pref
+    timer = timeit.default_timer
+
+    print "Benchmarking %s with cortex_density=%s"%(script,cortex_density)
+    _setargs(dict(cortex_density=cortex_density))
+
+    results = dict(script=os.path.basename(script),cortex_density=cortex_density,
+                   iterations=iterations)
+
+    # connect is the part of startup spent creating connections
+    # (i.e. mostly creating CFs)
+    topo.sim.profiler = Profiler()
+    start = timer()
+    execfile(script,__main__.__dict__)
+    results['startup'] = timer()-start
+    results['connect'] = sum([r['total'] for r in topo.sim.profiler.results()
+                              if r['operation']=='connect'])
+    topo.sim.profiler = None
+
+    topo.sim.run(1) # ensure compilations etc happen outside timing
+    start = timer()
+    topo.sim.run(iterations)
+    results['run'] = timer()-start
+    results['iterations_per_second'] = iterations/results['run']
+
+    start = timer()
+    measure_or_pref()
+    results['measure_or_pref'] = timer()-start
+
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(snapshot_dir,'benchmark.typ')
+        start = timer()
+        save_snapshot(snapshot)
+        results['save_snapshot'] = timer()-start
+        start = timer()
+        load_snapshot(snapshot)
+        results['load_snapshot'] = timer()-start
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+    results['peak_memory_mb'] = peaksize()/1024.0/1024.0
+    return results
+
+
+def compare_benchmarks(results,reference,threshold=BENCHMARK_THRESHOLD,min_time=0.05):
+    """
+    Compare two sets of results from run_benchmarks(), printing the
+    percentage change in each measurement, and returning a list of
+    descriptions of those that got worse by more than threshold
+    percent.
+
+    Times shorter than min_time seconds in both sets of results are
+    too noisy to compare, and are ignored.
+    """
+    reference_benchmarks = dict([((b['script'],b['cortex_density']),b)
+                                 for b in reference['benchmarks']])
+    print "Comparing with results from version=%s, release=%s"%tuple(reference['versions'])
+    regressions = []
+    for new in results['benchmarks']:
+        old = reference_benchmarks.get((new['script'],new['cortex_density']))
+        if old is None:
+            continue
+        for measure,larger_is_better in _benchmark_measures:
+            if old.get(measure) is None or new.get(measure) is None:
+                continue
+            timed = {'iterations_per_second':'run','peak_memory_mb':None}.get(measure,measure)
+            if timed is not None and max(old[timed],new[timed])<min_time:
+                continue
+            change = 100.0*(new[measure]-old[measure])/old[measure]
+            worse = -change if larger_is_better else change
+            label = "[%s cortex_density=%s] %s"%(new['script'],new['cortex_density'],measure)
+            summary = "%s  Before: %.3f  Now: %.3f  (%+.1f percent)"%(label,old[measure],new[measure],change)
+            print summary
+            if worse > threshold:
+                regressions.append(summary)
+    return regressions
+
+
+def run_benchmarks(scripts=BENCHMARKSCRIPTS,densities=BENCHMARK_DENSITIES,
+                   iterations=BENCHMARK_ITERATIONS,data_filename=None,
+                   reference_filename=None,threshold=BENCHMARK_THRESHOLD):
+    """
+    Benchmark each of the scripts (from the examples directory) at
+    each of the cortex densities, save the results as JSON, and
+    compare them with the reference results, returning the number of
+    regressions (see compare_benchmarks()).
+
+    For each script and density, the time taken to load the script
+    (startup, which includes creating the connections, connect),
+    iterations/second for the specified number of training
+    iterations, the time for measure_or_pref(), the time to save and
+    load a snapshot, and the peak memory usage are recorded.
+
+    By default, the results are saved to
+    MACHINETESTSDATADIR/benchmarks_<version>.json and compared with
+    MACHINETESTSDATADIR/benchmarks_reference.json.  If no reference
+    results exist, the results are also saved as the reference
+    (i.e. to set a new reference, delete the existing one).
+    """
+    json = _json()
+    if data_filename is None:
+        data_filename = os.path.join(MACHINETESTSDATADIR,"benchmarks_%s.json"%topo.version)
+    if reference_filename is None:
+        reference_filename = os.path.join(MACHINETESTSDATADIR,"benchmarks_reference.json")
+
+    results = {'versions':(topo.version,topo.release),
+               'host':socket.gethostname(),
+               'benchmarks':[]}
+    failures = 0
+    for script in scripts:
+        script_path = resolve_path(os.path.join("examples",script))
+        for density in densities:
+            r = _call_in_forked_process(_benchmark_script,script_path,density,iterations)
+            if r is None:
+                print "[%s cortex_density=%s] FAILED"%(script,density)
+                failures+=1
+            else:
+                results['benchmarks'].append(r)
+
+    print "Saving results to %s"%data_filename
+    json.dump(results,open(data_filename,'w'),indent=1)
+
+    if not os.path.exists(reference_filename):
+        print "No existing reference results; saving to %s"%reference_filename
+        json.dump(results,open(reference_filename,'w'),indent=1)
+        return failures
+
+    regressions = compare_benchmarks(results,json.load(open(reference_filename)),threshold)
+    if regressions:
+        print "\n%s regression(s) of more than %s percent:"%(len(regressions),threshold)
+        print "\n".join(regressions)
+    return failures+len(regressions)
+
+### end benchmarks
+###########################################################################
+
+
+###########################################################################
+### event queue timing
+
+class _SortedListEventQueue(list):
+    """
+    The sorted list Simulation used for its events before EventQueue,
+    for comparison.
+    """
+    def push(self,event):
+        import bisect
+        bisect.insort_right(self,event)
+
+    def pop(self):
+        return list.pop(self,0)
+
+
+def time_event_queue(depths=[10,100,1000,10000],iterations=20000):
+    """
+    Time Simulation's event queue against a sorted list, for
+    queues holding each of the specified numbers of events.
+
+    For each depth, the queue is filled with events at random times,
+    and then the time is measured for each of iterations steps of
+    popping the earliest event and pushing a new one at a later
+    random time (as a simulation with that many pending events
+    does).  Returns a list of (depth,list_time,queue_time) in
+    seconds per iteration.
+    """
+    import random
+    from topo.base.simulation import Event, EventQueue
+
+    results = []
+    print "%8s %14s %14s %8s"%("depth","sorted list","EventQueue","speedup")
+    for depth in depths:
+        times = []
+        for queue_type in (_SortedListEventQueue,EventQueue):
+            rng = random.Random(depth)
+            queue = queue_type()
+            for i in range(depth):
+                queue.push(Event(rng.random()))
+            def step():
+                for i in xrange(iterations):
+                    event = queue.pop()
+                    queue.push(Event(event.time+rng.random()))
+            times.append(min(timeit.Timer(step).repeat(repeat=3,number=1))/iterations)
+        results.append((depth,times[0],times[1]))
+        print "%8d %12.2fus %12.2fus %7.1fx"%(depth,1e6*times[0],1e6*times[1],times[0]/times[1])
+    return results
+
+### end event queue timing
+###########################################################################
+
+
 ###########################################################################
 ### Snapshot tests
 
@@ -7,10 +7,13 @@ __version__='$Revision$'
 # CEBALERT: incomplete!
 
 import unittest
+import numpy
 from numpy.testing import assert_array_almost_equal
 
 from topo import pattern 
 import topo.pattern.audio
+from topo.pattern.basic import TimeSeries, generate_sine_wave
+from topo.base.boundingregion import BoundingBox
 
 class TestAudio(unittest.TestCase):
 
@@ -21,5 +24,49 @@ class TestAudio(unittest.TestCase):
         result = self.audio()
 
 
+class TestLyonsCochlearModel(unittest.TestCase):
+
+    def setUp(self):
+        signal = TimeSeries(time_series=generate_sine_wave(1.0,1000,20000), sample_rate=20000,
+                            interval_length=0.01, seconds_per_iteration=0.005)
+        # (93 channels for this sample rate)
+        self.model = pattern.audio.LyonsCochlearModel(signal=signal, bounds=BoundingBox(radius=0.5),
+                                                      xdensity=1, ydensity=93)
+
+    def test_filterbank_response(self):
+        """The time-domain cascade should have the magnitude response of the frequency-domain one."""
+        filterbank = self.model._filterbank
+        impulse = numpy.zeros(20000)
+        impulse[0] = 1.0
+        amplitudes = abs(numpy.fft.rfft(filterbank(impulse), axis=1)[:,0:10000])
+        # (channels are zero where the response underflows)
+        amplitudes[amplitudes<1e-12] = 1.0
+        assert_array_almost_equal(20.0*numpy.log10(amplitudes), self.model.cochlear_channels, decimal=1)
+
+    def test_filterbank_blocks(self):
+        """Filtering a signal in blocks should give the same result as filtering it all at once."""
+        filterbank = self.model._filterbank
+        samples = numpy.random.RandomState(7).rand(500)
+        filterbank.reset()
+        whole = filterbank(samples)
+        filterbank.reset()
+        blocks = numpy.hstack([filterbank(samples[:200]), filterbank(samples[200:201]), filterbank(samples[201:])])
+        assert_array_almost_equal(whole, blocks, decimal=12)
+
+    def test_filterbank_aligned(self):
+        """Aligned outputs of every channel should be for the same input samples."""
+        filterbank = self.model._filterbank
+        channels = filterbank.channels
+        samples = numpy.random.RandomState(7).rand(500)
+        filterbank.reset()
+        whole = filterbank(numpy.hstack([samples, numpy.zeros(channels-1)]))
+        filterbank.reset()
+        blocks = numpy.hstack([filterbank.aligned(samples[:100]), filterbank.aligned(samples[100:]),
+                               filterbank.aligned(numpy.zeros(channels-1))])
+        for i in range(channels):
+            assert_array_almost_equal(blocks[i,channels-1:], whole[i,i:i+500], decimal=12)
+
+
 suite = unittest.TestSuite()
 suite.addTest(unittest.makeSuite(TestAudio))
+suite.addTest(unittest.makeSuite(TestLyonsCochlearModel))
@@ -3,7 +3,36 @@ import numpy
 
 from topo.base.simulation import Simulation
 from topo.base.boundingregion import BoundingBox
-from topo.base.cf import CFIter,MaskedCFIter,ResizableCFProjection,CFSheet
+from topo.base.cf import CFIter,MaskedCFIter,ResizableCFProjection,CFSheet,CFProjection
+
+
+def connected_sim(src_density,bounds_template,projections,**params):
+    """
+    Return a Simulation in which a Src CFSheet of the given density is
+    connected to a density-10 Dest CFSheet by one CFProjection (with
+    UniformRandom weights and the given nominal_bounds_template) for
+    each (name,pack_weights) pair in projections.
+
+    The remaining params (e.g. response, learning and output
+    functions) are copied for each projection, so that no two
+    projections share a function object.
+    """
+    from copy import deepcopy
+    from topo.pattern.random import UniformRandom
+
+    sim = Simulation()
+    sim['Src'] = CFSheet(nominal_density=src_density,nominal_bounds=BoundingBox(radius=0.5))
+    sim['Dest'] = CFSheet(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5))
+
+    for name,packed in projections:
+        sim.connect('Src','Dest',name=name,
+                    connection_type=CFProjection,
+                    nominal_bounds_template=bounds_template,
+                    weights_generator=UniformRandom(),
+                    pack_weights=packed,
+                    **deepcopy(params))
+    return sim
+
 
 class TestCFIter(unittest.TestCase):
 
@@ -69,8 +98,216 @@ class TestCFIter(unittest.TestCase):
         
 
 
+class TestCFWeightStore(unittest.TestCase):
+
+    def setUp(self):
+        from topo.pattern.random import UniformRandom
+        from topo.pattern.basic import Disk
+        from topo.responsefn.optimized import CFPRF_DotProduct_opt
+        from topo.learningfn.optimized import CFPLF_Hebbian_opt
+        from topo.transferfn.optimized import CFPOF_DivisiveNormalizeL1_opt
+
+        self.sim = connected_sim(10,BoundingBox(radius=0.2),(('Unpacked',False),('Packed',True)),
+                                 cf_shape=Disk(smoothing=0.0),
+                                 response_fn=CFPRF_DotProduct_opt(),
+                                 learning_fn=CFPLF_Hebbian_opt(),
+                                 weights_output_fns=[CFPOF_DivisiveNormalizeL1_opt()],
+                                 learning_rate=1.0)
+
+        dest = self.sim['Dest']
+        self.unpacked = dest.projections()['Unpacked']
+        self.packed = dest.projections()['Packed']
+        for cf_u,cf_p in zip(self.unpacked.flatcfs,self.packed.flatcfs):
+            cf_p.weights[...] = cf_u.weights
+        self.input_activity = UniformRandom()(xdensity=10,ydensity=10,
+                                              bounds=BoundingBox(radius=0.5))
+
+
+    def test_cfs_are_views(self):
+        store = self.packed.weight_store
+        self.failUnless(self.unpacked.weight_store is None)
+        for i,cf in enumerate(self.packed.flatcfs):
+            start = store.offsets[i]
+            self.failUnlessEqual(cf.weights.shape,store.shape(i))
+            self.failUnless(numpy.may_share_memory(cf.weights,store.weights))
+            self.failUnless(numpy.may_share_memory(cf.mask,store.masks))
+            cf.weights.flat[0] = 42.0
+            self.failUnlessEqual(store.weights[start],42.0)
+
+
+    def test_same_as_unpacked(self):
+        for p in (self.unpacked,self.packed):
+            p.activate(self.input_activity)
+        numpy.testing.assert_array_almost_equal(self.unpacked.activity,self.packed.activity)
+
+        self.sim['Dest'].activity[:] = self.packed.activity
+        for p in (self.unpacked,self.packed):
+            p.learn()
+            p.apply_learn_output_fns()
+
+        for cf_u,cf_p in zip(self.unpacked.flatcfs,self.packed.flatcfs):
+            numpy.testing.assert_array_almost_equal(cf_u.weights,cf_p.weights)
+
+
+    def test_pickle_shares_buffers(self):
+        import pickle
+        packed = pickle.loads(pickle.dumps(self.packed,2))
+        store = packed.weight_store
+        for cf_orig,cf in zip(self.packed.flatcfs,packed.flatcfs):
+            numpy.testing.assert_array_equal(cf_orig.weights,cf.weights)
+            self.failUnless(numpy.may_share_memory(cf.weights,store.weights))
+        # (the pickled CFs are copies without their arrays)
+        self.failUnless(self.packed.flatcfs[0].weights is not None)
+
+
+
+class TestDotProductBatched(unittest.TestCase):
+
+    def setUp(self):
+        from topo.pattern.random import UniformRandom
+        from topo.pattern.basic import Disk
+
+        self.sim = connected_sim(20,BoundingBox(radius=0.25),(('Unpacked',False),('Packed',True)),
+                                 cf_shape=Disk(smoothing=0.0),
+                                 strength=0.5)
+
+        self.input_activity = UniformRandom()(xdensity=20,ydensity=20,
+                                              bounds=BoundingBox(radius=0.5))
+
+
+    def _check_against_plugin(self):
+        from topo.base.cf import CFPRF_Plugin
+        from topo.responsefn.projfn import CFPRF_DotProduct_batched
+
+        for proj in self.sim['Dest'].in_connections:
+            proj.response_fn = CFPRF_Plugin()
+            proj.activate(self.input_activity)
+            expected = proj.activity.copy()
+
+            # (small runs and batches, so that the test exercises
+            # runs, batches, and CFs processed one at a time)
+            for max_gather_size in (200,0):
+                proj.response_fn = CFPRF_DotProduct_batched(min_run_length=3,max_batch_size=7,
+                                                            max_gather_size=max_gather_size)
+                proj.activate(self.input_activity)
+                numpy.testing.assert_array_almost_equal(proj.activity,expected)
+
+
+    def test_same_as_plugin(self):
+        self._check_against_plugin()
+
+
+    def test_same_as_plugin_masked(self):
+        dest = self.sim['Dest']
+        dest.mask.data = numpy.zeros(dest.activity.shape)
+        dest.mask.data[2:5,1:7] = 1
+        self._check_against_plugin()
+
+
+
+class TestSparse(unittest.TestCase):
+
+    def setUp(self):
+        from topo.pattern.random import UniformRandom
+        from topo.pattern.basic import Disk
+        from topo.responsefn.projfn import CFPRF_DotProduct_sparse
+        from topo.learningfn.projfn import CFPLF_Hebbian_sparse
+
+        self.sim = connected_sim(12,BoundingBox(radius=0.2),(('Plugin',False),('Sparse',True)),
+                                 cf_shape=Disk(smoothing=0.0),
+                                 learning_rate=1.0)
+
+        dest = self.sim['Dest']
+        self.plugin = dest.projections()['Plugin']
+        self.sparse = dest.projections()['Sparse']
+        self.sparse.response_fn = CFPRF_DotProduct_sparse()
+        self.sparse.learning_fn = CFPLF_Hebbian_sparse()
+        for cf_p,cf_s in zip(self.plugin.flatcfs,self.sparse.flatcfs):
+            cf_s.weights[...] = cf_p.weights
+        self.input_activity = UniformRandom()(xdensity=12,ydensity=12,
+                                              bounds=BoundingBox(radius=0.5))
+
+
+    def test_matrix_shares_weights(self):
+        W = self.sparse.weight_store.csr_matrix(self.input_activity.shape)
+        self.failUnlessEqual(W.shape,(100,144))
+        cf = self.sparse.flatcfs[55]
+        r1,r2,c1,c2 = cf.input_sheet_slice
+        numpy.testing.assert_array_equal(W.getrow(55).toarray().reshape(12,12)[r1:r2,c1:c2],
+                                         cf.weights)
+        cf.weights[...] = 0.0
+        self.failUnlessEqual(W.getrow(55).sum(),0.0)
+
+
+    def test_same_as_plugin(self):
+        dest = self.sim['Dest']
+        dest.mask.data = numpy.zeros(dest.activity.shape)
+        dest.mask.data[2:8,1:5] = 1
+
+        for p in (self.plugin,self.sparse):
+            p.activate(self.input_activity)
+        # (sparse sums are single precision)
+        numpy.testing.assert_array_almost_equal(self.plugin.activity,self.sparse.activity,5)
+
+        dest.activity[:] = self.plugin.activity
+        for p in (self.plugin,self.sparse):
+            p.learn()
+        for cf_p,cf_s in zip(self.plugin.flatcfs,self.sparse.flatcfs):
+            numpy.testing.assert_array_almost_equal(cf_p.weights,cf_s.weights)
+
+
+
+class TestNormTotals(unittest.TestCase):
+
+    def setUp(self):
+        from topo.pattern.random import UniformRandom
+        from topo.learningfn.optimized import CFPLF_Hebbian_opt
+
+        self.sim = connected_sim(10,BoundingBox(radius=0.2),(('A',False),('B',False)),
+                                 learning_fn=CFPLF_Hebbian_opt(),learning_rate=1.0)
+        self.projs = [self.sim['Dest'].projections()[name] for name in ('A','B')]
+
+        dest = self.sim['Dest']
+        dest.activity[:] = 0.0
+        dest.activity[2:6,3:7] = 0.5
+        self.input_activity = UniformRandom()(xdensity=10,ydensity=10,
+                                              bounds=BoundingBox(radius=0.5))
+
+
+    def test_learning_stores_norm_totals(self):
+        proj = self.projs[0]
+        proj.input_buffer = self.input_activity
+        proj.learn()
+        learned = self.sim['Dest'].activity.ravel()!=0
+        numpy.testing.assert_array_equal(proj.has_norm_totals,learned)
+        for i in learned.nonzero()[0]:
+            self.assertAlmostEqual(proj.norm_totals[i],abs(proj.flatcfs[i].weights).sum(),4)
+
+
+    def test_joint_norm_totals(self):
+        from topo.sheet.basic import compute_joint_norm_totals
+        from topo.sheet.optimized import compute_joint_norm_totals_opt
+
+        for p in self.projs:
+            p.input_buffer = self.input_activity
+            p.learn()
+        units = (self.sim['Dest'].activity.ravel()!=0).nonzero()[0]
+        expected = self.projs[0].get_norm_totals(units)+self.projs[1].get_norm_totals(units)
+
+        saved = [(p.norm_totals.copy(),p.has_norm_totals.copy()) for p in self.projs]
+        for joint_norm_fn in (compute_joint_norm_totals,compute_joint_norm_totals_opt):
+            for p,(norm_totals,has_norm_totals) in zip(self.projs,saved):
+                p.norm_totals[:] = norm_totals
+                p.has_norm_totals[:] = has_norm_totals
+            joint_norm_fn(self.projs,active_units_mask=True)
+            for p in self.projs:
+                numpy.testing.assert_array_almost_equal(p.norm_totals[units],expected)
+                numpy.testing.assert_array_equal(p.get_norm_totals(units),p.norm_totals[units])
+
+
+
 ####
-cases = [TestCFIter]
+cases = [TestCFIter,TestCFWeightStore,TestDotProductBatched,TestSparse,TestNormTotals]
 
 suite = unittest.TestSuite()
 suite.addTests([unittest.makeSuite(case) for case in cases])
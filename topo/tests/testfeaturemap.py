@@ -16,6 +16,7 @@ import unittest
 from topo.base.arrayutil import arg, wrap
 from math import pi
 from numpy.oldnumeric import array, exp
+from numpy.testing import assert_array_almost_equal
 from topo.base.sheet import Sheet
 from topo.base.boundingregion import BoundingBox
 
@@ -26,7 +27,7 @@ from topo.base.simulation import Simulation
 from topo.learningfn.optimized import CFPLF_Hebbian
 
 from topo.pattern import basic
-from topo.analysis.featureresponses import DistributionMatrix, FeatureMaps
+from topo.analysis.featureresponses import DistributionMatrix, FeatureMaps, PatternPresenter
 from topo.command.analysis import Feature
 
 class TestDistributionMatrix(unittest.TestCase):
@@ -180,6 +181,21 @@ class TestDistributionMatrix(unittest.TestCase):
             self.assertAlmostEqual(self.fm2.selectivity()[i,0],vect_sum)
             vect_sum = abs(3*exp(0.7*2*pi*1j)+exp(0.5*2*pi*1j)+exp(0.9*2*pi*1j))/5.0
             self.assertAlmostEqual(self.fm2.selectivity()[i,1],vect_sum)
+
+
+    def test_max_value_bin(self):
+
+        self.fm1.update(self.a2,0.7)
+        self.fm1.update(self.a3*4,0.9)
+
+        for i in range(3):
+            self.assertAlmostEqual(self.fm1.max_value_bin()[i,0], 0.7)
+            self.assertAlmostEqual(self.fm1.max_value_bin()[i,1], 0.9)
+
+        self.assertEqual(self.fm1.bins,[0.5,0.7,0.9])
+        self.assertEqual(self.fm1.get_value(0.7).tolist(),self.a2.tolist())
+        self.assertEqual(self.fm1.get_value(0.3),None)
+        self.assertRaises(ValueError,self.fm1.update,self.a1,1.5)
              
 
 
@@ -216,6 +232,38 @@ class TestFeatureMaps(unittest.TestCase):
         #print self.V1.activity
         #### test has to be written!!!
 
+
+    def test_parallel_measurement(self):
+        """Maps measured using several processes should match those from one process."""
+        features = [Feature(name="phase",range=(0.0,2*pi),step=2*pi/4,cyclic=True),
+                    Feature(name="orientation",range=(0.0,pi),step=pi/3,cyclic=True)]
+        presenter = PatternPresenter(pattern_generator=basic.SineGrating(),duration=1.0)
+
+        maps = {}
+        for processes in [1,3]:
+            FeatureMaps(features,processes=processes).collect_feature_responses(presenter,{},False)
+            for name in ['OrientationPreference','OrientationSelectivity','PhasePreference']:
+                maps[processes,name] = self.s['V1'].sheet_views[name].view()[0]
+
+        for name in ['OrientationPreference','OrientationSelectivity','PhasePreference']:
+            self.assertEqual(maps[1,name].tolist(),maps[3,name].tolist())
+
+
+    def test_batched_measurement(self):
+        """Maps computed from batches of linear responses should match those from presenting each pattern."""
+        features = [Feature(name="phase",range=(0.0,2*pi),step=2*pi/4,cyclic=True),
+                    Feature(name="orientation",range=(0.0,pi),step=pi/3,cyclic=True)]
+        presenter = PatternPresenter(pattern_generator=basic.SineGrating(),apply_output_fns=False)
+
+        maps = {}
+        for batch_size in [0,5]:
+            FeatureMaps(features,batch_size=batch_size).collect_feature_responses(presenter,{},False)
+            for name in ['OrientationPreference','OrientationSelectivity','PhasePreference']:
+                maps[batch_size,name] = self.s['V2'].sheet_views[name].view()[0]
+
+        for name in ['OrientationPreference','OrientationSelectivity','PhasePreference']:
+            assert_array_almost_equal(maps[0,name],maps[5,name],decimal=10)
+
         
 cases = [TestDistributionMatrix,
          TestFeatureMaps]
@@ -0,0 +1,57 @@
+"""
+Unit tests for GeneratorSheet.
+
+$Id$
+"""
+__version__='$Revision$'
+
+import unittest
+
+from numpy.testing import assert_array_equal
+
+from topo.base.simulation import Simulation, FunctionEvent, PeriodicEventSequence
+from topo.base.boundingregion import BoundingBox
+from topo.sheet import GeneratorSheet
+from topo.pattern.basic import Gaussian
+from topo import numbergen
+
+
+class TestGeneratorSheet(unittest.TestCase):
+
+    def _run(self,prefetch,durations):
+        """
+        Run a simulation with a randomly positioned Gaussian for each
+        of the given durations, returning every pattern generated and
+        the generator.
+        """
+        sim = Simulation(register=True,name="test_generatorsheet")
+        g = Gaussian(x=numbergen.UniformRandom(lbound=-0.4,ubound=0.4,seed=12),
+                     y=numbergen.UniformRandom(lbound=-0.4,ubound=0.4,seed=34),
+                     size=0.2)
+        sim['GS'] = GeneratorSheet(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5),
+                                   input_generator=g,period=1.0,phase=0.05,prefetch=prefetch)
+        patterns = []
+        record = FunctionEvent(0,lambda: patterns.append(sim['GS'].activity.copy()))
+        sim.enqueue_event(PeriodicEventSequence(sim._convert_to_time_type(0.06),
+                                                sim._convert_to_time_type(1.0),[record]))
+        for duration in durations:
+            sim.run(duration)
+        return patterns,g
+
+
+    def test_prefetch(self):
+        """Prefetched patterns and the generator's state should match those without prefetching."""
+        durations = [4,1,6]
+        patterns,g = self._run(0,durations)
+        prefetched,g_prefetched = self._run(3,durations)
+
+        self.assertEqual(len(patterns),11)
+        self.assertEqual(len(prefetched),len(patterns))
+        for p1,p2 in zip(patterns,prefetched):
+            assert_array_equal(p1,p2)
+        self.assertEqual(g.x,g_prefetched.x)
+        self.assertEqual(g.y,g_prefetched.y)
+
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.makeSuite(TestGeneratorSheet))
@@ -18,7 +18,8 @@ __version__='$Revision$'
 ### visualize matrices during debugging.
 
 import unittest
-from numpy.testing import assert_array_almost_equal
+import os, shutil, tempfile
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 
 from numpy.oldnumeric import array,Float,pi
 ## from numpy.oldnumeric.mlab import rot90
@@ -26,7 +27,7 @@ from numpy.oldnumeric import array,Float,pi
 from param import resolve_path
 
 from topo.base.boundingregion import BoundingBox
-from topo.pattern.image import FileImage
+from topo.pattern.image import FileImage, DatasetImage, PatternSampler, create_image_dataset
 from topo.transferfn.basic import IdentityTF
 
 
@@ -341,6 +342,29 @@ class TestImage(unittest.TestCase):
 
 
 
+    def test_dataset_image(self):
+        """
+        Test that a DatasetImage gives the same patterns as a
+        FileImage for each file in the ImageDataset.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = [resolve_path('tests/testimage.pgm'),
+                         resolve_path('images/ellen_arthur.pgm')]
+            dataset = create_image_dataset(filenames,os.path.join(directory,'images.npy'))
+            self.assertEqual(dataset.image_filenames,map(os.path.abspath,filenames))
+
+            for i,filename in enumerate(filenames):
+                f = FileImage(filename=filename,xdensity=12,ydensity=12,orientation=0.4)
+                d = DatasetImage(dataset=dataset,index=i,xdensity=12,ydensity=12,orientation=0.4)
+                assert_array_equal(f(),d())
+                assert_array_equal(f(pattern_sampler=PatternSampler()),
+                                   d(pattern_sampler=PatternSampler()))
+        finally:
+            shutil.rmtree(directory)
+
+
+
     # CB: test rotation for PatternGenerators.
 ##     def test_rotation(self):
 ##         image_array = array(
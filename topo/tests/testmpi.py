@@ -0,0 +1,353 @@
+"""
+Unit tests for MPI_CFProjection, and for the functions it uses to
+divide the units of a sheet among the MPI nodes.
+
+The tests run on however many MPI processes there are; within the
+test suite that is normally only one (i.e. the controller does all
+the work).
+
+$Id$
+"""
+__version__='$Revision$'
+
+import unittest, shutil, tempfile, cPickle
+import numpy
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from param import normalize_path
+
+import topo
+from topo.misc import pmi
+from topo.base import mpi_cf
+from topo.base.simulation import Simulation
+from topo.base.boundingregion import BoundingBox
+from topo.base.cf import CFSheet, CFProjection, MPI_CFProjection
+from topo.base.projection import NeighborhoodMask
+from topo.sheet import GeneratorSheet
+from topo.sheet.lissom import LISSOM
+from topo.pattern.basic import Gaussian
+from topo.pattern.random import UniformRandom
+from topo.transferfn.basic import PiecewiseLinear, DivisiveNormalizeL1
+from topo.transferfn.misc import HomeostaticResponse
+from topo.command.basic import save_snapshot, load_snapshot
+
+# (the node classes have to be defined on all the nodes)
+if not MPI_CFProjection.pmi_initialised:
+    pmi.execfile_(mpi_cf.__file__.replace('.pyc','.py'))
+    MPI_CFProjection.pmi_initialised = True
+
+
+def mpi_sim(name=None,projections=(('Serial',CFProjection),('MPI',MPI_CFProjection)),**params):
+    """
+    Return a Simulation in which a Src CFSheet is connected to a Dest
+    CFSheet by one projection of each of the given (name,type) pairs,
+    all with the same initial weights.
+    """
+    sim = Simulation(register=name is not None,name=name)
+    sim['Src'] = CFSheet(nominal_density=12,nominal_bounds=BoundingBox(radius=0.5))
+    sim['Dest'] = CFSheet(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5))
+    for name,connection_type in projections:
+        sim.connect('Src','Dest',name=name,connection_type=connection_type,
+                    nominal_bounds_template=BoundingBox(radius=0.2),
+                    weights_generator=UniformRandom(random_generator=numpy.random.RandomState(7)),
+                    learning_rate=1.0,**params)
+    return sim
+
+
+def lissom_sim(mpi_settle,**params):
+    """
+    Return a Simulation with a LISSOM sheet V1 receiving an afferent
+    projection from a Retina and two lateral projections, which are
+    MPI_CFProjections settled on the nodes if mpi_settle is True and
+    CFProjections otherwise.
+    """
+    sim = Simulation(register=False)
+    sim['Retina'] = GeneratorSheet(nominal_density=12,nominal_bounds=BoundingBox(radius=0.5),
+                                   input_generator=Gaussian(size=0.3,aspect_ratio=1.0),
+                                   period=1.0,phase=0.05)
+    params.setdefault('output_fns',[PiecewiseLinear(lower_bound=0.0,upper_bound=10.0)])
+    sim['V1'] = LISSOM(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5),
+                       mpi_settle=mpi_settle,tsettle=4,**params)
+    for name,src,radius,strength in (('Afferent','Retina',0.2,1.0),
+                                     ('LateralExcitatory','V1',0.1,0.9),
+                                     ('LateralInhibitory','V1',0.3,-0.9)):
+        sim.connect(src,'V1',name=name,delay=0.05,strength=strength,
+                    connection_type=MPI_CFProjection if mpi_settle else CFProjection,
+                    nominal_bounds_template=BoundingBox(radius=radius),
+                    weights_generator=UniformRandom(random_generator=numpy.random.RandomState(7)))
+    return sim
+
+
+def input_activity(seed=1):
+    return numpy.random.RandomState(seed).uniform(size=(12,12))
+
+
+
+class TestActivation(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = mpi_sim()
+        projections = self.sim['Dest'].projections()
+        self.serial,self.mpi = projections['Serial'],projections['MPI']
+
+    def _assert_weights_equal(self):
+        for serial_cf,mpi_cf in zip(self.serial.flatcfs,self.mpi.flatcfs):
+            assert_array_almost_equal(mpi_cf.weights,serial_cf.weights)
+
+    def test_activate(self):
+        """The activity gathered from the nodes should be that of a serial projection, for each new input."""
+        for seed in (1,2):
+            for proj in (self.serial,self.mpi):
+                proj.activate(input_activity(seed))
+            self.assertNotEqual(self.serial.activity.sum(),0)
+            assert_array_almost_equal(self.mpi.activity,self.serial.activity)
+
+    def test_activate_nonblocking(self):
+        """Activity computed without blocking should be that of a serial projection once it has arrived."""
+        self.mpi.nonblocking = True
+        for seed in (1,2):
+            for proj in (self.serial,self.mpi):
+                proj.activate(input_activity(seed))
+            self.mpi.wait_for_activity()
+            assert_array_almost_equal(self.mpi.activity,self.serial.activity)
+
+    def test_learn(self):
+        """Learning and normalizing on the nodes should change the weights as for a serial projection."""
+        self.sim['Src'].activity[:] = input_activity()
+        for proj in (self.serial,self.mpi):
+            proj.activate(self.sim['Src'].activity)
+        self.sim['Dest'].activity[:] = self.serial.activity
+        for proj in (self.serial,self.mpi):
+            proj.learn()
+        self._assert_weights_equal()
+        for proj in (self.serial,self.mpi):
+            proj.apply_learn_output_fns()
+        self._assert_weights_equal()
+
+
+
+class TestPartition(unittest.TestCase):
+
+    def _assert_contiguous(self,counts,displs,n):
+        self.assertEqual(displs[0],0)
+        assert_array_equal(displs[1:],numpy.cumsum(counts)[:-1])
+        self.assertEqual(counts.sum(),n)
+
+    def test_balanced_partition(self):
+        """Each node should get a contiguous range of items whose cost is close to the average."""
+        random = numpy.random.RandomState(5)
+        for costs in (random.randint(0,20,size=100),
+                      numpy.concatenate((numpy.zeros(50),random.randint(50,100,size=50))),
+                      numpy.arange(100)**2):
+            for size in (1,3,7,100):
+                counts,displs = mpi_cf._balanced_partition(costs,size)
+                self._assert_contiguous(counts,displs,len(costs))
+                self.assert_((counts>=1).all())
+                node_costs = [costs[start:start+count].sum() for start,count in zip(displs,counts)]
+                self.assert_(max(node_costs) <= costs.sum()/float(size)+costs.max())
+
+    def test_balanced_partition_degenerate(self):
+        """Items without costs, or fewer items than nodes, should still all be divided up."""
+        for costs,size in ((numpy.zeros(10),3),(numpy.ones(2),4),(numpy.zeros(0),2)):
+            counts,displs = mpi_cf._balanced_partition(costs,size)
+            self.assertEqual(len(counts),size)
+            self._assert_contiguous(counts,displs,len(costs))
+            self.assert_((counts>=0).all())
+
+    def test_projection_partition(self):
+        """A projection's partition should cover its units and count each of their connections."""
+        sim = mpi_sim()
+        serial = sim['Dest'].projections()['Serial']
+        partition = sim['Dest'].projections()['MPI'].partition()
+        connections = sum([cf.mask.nonzero()[0].size for cf in serial.flatcfs])
+        self.assertEqual(sum([count for first,count,cost in partition]),100)
+        self.assertEqual(sum([cost for first,count,cost in partition]),connections)
+
+
+
+class TestTiles(unittest.TestCase):
+
+    def test_tile_partition(self):
+        """Each node should get one rectangular tile, and every unit should be in exactly one tile."""
+        random = numpy.random.RandomState(5)
+        for shape in ((10,10),(7,13)):
+            costs = random.randint(0,20,size=shape[0]*shape[1])
+            for size in (1,2,3,4,6):
+                order,counts,displs = mpi_cf._tile_partition(costs,shape,size)
+                self.assertEqual(len(counts),size)
+                assert_array_equal(numpy.sort(order),numpy.arange(len(costs)))
+                self.assertEqual(displs[0],0)
+                assert_array_equal(displs[1:],numpy.cumsum(counts)[:-1])
+                for start,count in zip(displs,counts):
+                    rows,cols = numpy.unravel_index(order[start:start+count],shape)
+                    rows,cols = numpy.unique(rows),numpy.unique(cols)
+                    self.assertEqual(count,len(rows)*len(cols))
+                    self.assertEqual(rows[-1]-rows[0]+1,len(rows))
+                    self.assertEqual(cols[-1]-cols[0]+1,len(cols))
+
+    def test_input_window(self):
+        """Each node's input window should be the bounds of the input read by the CFs of its tile."""
+        serial = mpi_sim(projections=(('Serial',CFProjection),))['Dest'].projections()['Serial']
+        tiled = mpi_sim(projections=(('MPI',MPI_CFProjection),),decomposition='tiles')['Dest'].projections()['MPI']
+        counts = [count for first,count,cost in tiled.partition()]
+        displs = numpy.concatenate(([0],numpy.cumsum(counts)[:-1]))
+        windows = pmi.invoke('getattr',tiled.pmiobj,'input_window')
+        for start,count,window in zip(displs,counts,windows):
+            slices = numpy.array([serial.flatcfs[u].input_sheet_slice for u in tiled._unit_order[start:start+count]])
+            self.assertEqual(tuple(window),(slices[:,0].min(),slices[:,1].max(),slices[:,2].min(),slices[:,3].max()))
+
+    def test_activate_tiles(self):
+        """The activity of a tiled projection should be that of a serial projection."""
+        serial = mpi_sim(projections=(('Serial',CFProjection),))['Dest'].projections()['Serial']
+        tiled = mpi_sim(projections=(('MPI',MPI_CFProjection),),decomposition='tiles')['Dest'].projections()['MPI']
+        for seed in (1,2):
+            for proj in (serial,tiled):
+                proj.activate(input_activity(seed))
+            assert_array_almost_equal(tiled.activity,serial.activity)
+
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        pmi.exec_("""
+class PlanTestCounter(object):
+    def __init__(self):
+        self.total = 0
+    def add(self,n):
+        self.total += n
+        return self.total
+    def get_total(self):
+        return self.total
+""")
+        self.counter = pmi.create('PlanTestCounter')
+
+    def test_replay(self):
+        """Each call of a plan should run all its recorded steps again, on every node."""
+        plan = pmi.Plan()
+        plan.call(self.counter,'add',2)
+        plan.invoke(self.counter,'get_total')
+        for total in (2,4,6):
+            self.assertEqual(plan(),[total,[total]*pmi.size])
+        self.assertEqual(pmi.invoke(self.counter,'get_total'),[6]*pmi.size)
+
+    def test_registered_plan_fixed(self):
+        """Steps cannot be added to a plan once it has been sent to the nodes."""
+        plan = pmi.Plan()
+        plan.call(self.counter,'add',1)
+        plan.register()
+        self.assertRaises(pmi.UserError,plan.call,self.counter,'add',1)
+        self.assertEqual(plan(),[1])
+
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.original_output_path = normalize_path.prefix
+        normalize_path.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(normalize_path.prefix)
+        normalize_path.prefix=self.original_output_path
+
+
+    def _save_shards(self,units,order,counts,displs):
+        """Save shards of the units divided as given, returning their files."""
+        filenames = []
+        for i,(start,count) in enumerate(zip(displs,counts)):
+            filenames.append(normalize_path("shards.%d"%i))
+            shard_units = numpy.arange(start,start+count) if order is None else order[start:start+count]
+            cPickle.dump((shard_units,[units[u] for u in shard_units]),open(filenames[-1],'wb'),2)
+        return filenames
+
+
+    def test_reshard(self):
+        """CFs saved by any number of nodes should be read back correctly by any other number."""
+        costs = numpy.random.RandomState(3).randint(0,20,size=100)
+        units = ['cf%d'%i for i in range(100)]
+        for saved in (1,3,4):
+            for counts,displs,order in (mpi_cf._balanced_partition(costs,saved)+(None,),
+                                        mpi_cf._tile_partition(costs,(10,10),saved)[1:]+
+                                        (mpi_cf._tile_partition(costs,(10,10),saved)[0],)):
+                filenames = self._save_shards(units,order,counts,displs)
+                for loaded in (1,2,5):
+                    new_order,new_counts,new_displs = mpi_cf._tile_partition(costs,(10,10),loaded)
+                    for start,count in zip(new_displs,new_counts):
+                        wanted = new_order[start:start+count]
+                        self.assertEqual(mpi_cf._read_shards(filenames,counts,displs,order,wanted),
+                                         [units[u] for u in wanted])
+
+
+    def test_save_load_snapshot(self):
+        """An MPI_CFProjection should be the same after saving and loading a snapshot."""
+        sim = mpi_sim("testmpi")
+        proj = sim['Dest'].projections()['MPI']
+        proj.activate(input_activity())
+        weights = [cf.weights.copy() for cf in proj.flatcfs]
+        activity = proj.activity.copy()
+
+        save_snapshot("testmpi.typ")
+        load_snapshot(normalize_path("testmpi.typ"))
+        proj = topo.sim['Dest'].projections()['MPI']
+
+        self.assertEqual(proj.cfs.shape,(10,10))
+        for cf,w in zip(proj.flatcfs,weights):
+            assert_array_equal(cf.weights,w)
+        assert_array_equal(proj.cfs[2,3].weights,weights[23])
+        assert_array_equal(proj.activity,activity)
+        proj.activate(input_activity())
+        assert_array_almost_equal(proj.activity,activity)
+
+
+    def test_load_snapshot_failed(self):
+        """A snapshot that cannot be unpickled should leave the current simulation's projections alone."""
+        sim = mpi_sim("testmpi")
+        proj = sim['Dest'].projections()['MPI']
+        save_snapshot("testmpi.typ")
+        proj.activate(input_activity())
+        activity = proj.activity.copy()
+
+        open(normalize_path("broken.typ"),'w').write("not a snapshot")
+        load_snapshot(normalize_path("broken.typ"))
+        self.assert_(topo.sim['Dest'].projections()['MPI'] is proj)
+        proj.activate(input_activity())
+        assert_array_equal(proj.activity,activity)
+
+
+
+
+class TestSettling(unittest.TestCase):
+
+    def _assert_settles_as_serial(self,**params):
+        serial,mpi = lissom_sim(False,**params),lissom_sim(True,**params)
+        for i in range(2):
+            serial.run(1); mpi.run(1)
+            self.assertNotEqual(serial['V1'].activity.sum(),0)
+            assert_array_almost_equal(mpi['V1'].activity,serial['V1'].activity)
+
+    def test_settle(self):
+        """Settling on the nodes should give the same activity as settling on the controller."""
+        self._assert_settles_as_serial()
+
+    def test_settle_calculated_mask(self):
+        """A mask calculated at the end of settling should be calculated the same way."""
+        self._assert_settles_as_serial(mask=NeighborhoodMask(None,threshold=0.1,radius=0.1),mask_init_time=4)
+
+    def test_mask_calculated_during_settling(self):
+        """A mask calculated from the activity of an intermediate step cannot be supported."""
+        sim = lissom_sim(True,mask=NeighborhoodMask(None),mask_init_time=2)
+        self.assertRaises(ValueError,sim.run,1)
+
+    def test_unsupported_output_fns(self):
+        """Output functions that are not pointwise and stateless should be refused."""
+        for output_fn in (DivisiveNormalizeL1(),HomeostaticResponse()):
+            sim = lissom_sim(True,output_fns=[output_fn])
+            self.assertRaises(ValueError,sim.run,1)
+
+
+
+cases = [TestActivation,TestPartition,TestTiles,TestPlan,TestShards,TestSettling]
+
+suite = unittest.TestSuite()
+suite.addTests([unittest.makeSuite(case) for case in cases])
@@ -10,12 +10,14 @@ import unittest
 
 from numpy.oldnumeric import array, pi
 from numpy.oldnumeric.mlab import rot90
-from numpy.testing import assert_array_equal
+import numpy
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from topo.base.patterngenerator import Constant,PatternGenerator
 from topo.base.boundingregion import BoundingBox
 
-from topo.pattern.basic import Rectangle,Gaussian,Composite,Selector
+from topo.pattern.basic import Rectangle,TwoRectangles,Gaussian,Composite,Selector
+from topo.pattern.basic import TimeSeries,PowerSpectrum,Spectrogram,generate_sine_wave
 from topo import numbergen
 
 
@@ -202,6 +204,52 @@ class TestPatternGenerator(unittest.TestCase):
     # Should also test rotating, resizing...
 
 
+    def test_composite_local_evaluation(self):
+        """
+        Test that evaluating localized patterns only within their
+        support gives the same result as evaluating them everywhere,
+        including for patterns partly or entirely off the edge.
+        """
+        bbox=BoundingBox(radius=0.5)
+        gs = [Gaussian(size=0.1,aspect_ratio=2.0,orientation=pi/5,x=-0.2,y=0.1),
+              Gaussian(size=0.05,x=0.48,y=-0.45),
+              Rectangle(size=0.1,aspect_ratio=1.5,x=0.1,y=0.2,smoothing=0.02),
+              Gaussian(size=0.05,x=2.0,y=0.0)]
+        for operator in [numpy.add,numpy.maximum]:
+            c = Composite(generators=gs,operator=operator,bounds=bbox,
+                          xdensity=30,ydensity=30,x=0.05,orientation=pi/7)
+            assert_array_almost_equal(c(),c(tail_cutoff=0),decimal=10)
+
+        # (TwoRectangles draws outside the support of the Rectangle it extends)
+        c = Composite(generators=[TwoRectangles(size=0.2,x1=-0.3,y1=-0.3,x2=0.3,y2=0.3,smoothing=0)],
+                      bounds=BoundingBox(radius=1.0),xdensity=10,ydensity=10)
+        assert_array_equal(c(),c(tail_cutoff=0))
+        self.assertNotEqual(c().sum(),0.0)
+
+        gs.append(Gaussian(size=0.1,scale=-1.0))
+        c = Composite(generators=gs,operator=numpy.maximum,bounds=bbox,
+                      xdensity=30,ydensity=30,mask=numpy.ones((30,30)))
+        assert_array_almost_equal(c(),c(tail_cutoff=0),decimal=10)
+
+
+    def test_repeated_calls(self):
+        """Check patterns don't depend on earlier calls (the coordinates are cached and reused)."""
+        big = BoundingBox(radius=0.5)
+        small = BoundingBox(points=((0.3,0.2),(0.5,0.5)))
+        g = Gaussian(size=0.2,aspect_ratio=0.5,orientation=pi/3)
+
+        a1 = g(bounds=big,xdensity=8,ydensity=8)
+        b1 = g(bounds=small,xdensity=10,ydensity=10,x=0.4,y=0.3)
+        a2 = g(bounds=big,xdensity=8,ydensity=8)
+        c = g(bounds=big,xdensity=8,ydensity=8,orientation=0)
+        b2 = g(bounds=small,xdensity=10,ydensity=10,x=0.4,y=0.3)
+
+        assert_array_equal(a1,a2)
+        assert_array_equal(b1,b2)
+        assert_array_equal(c,Gaussian(size=0.2,aspect_ratio=0.5)(bounds=big,xdensity=8,ydensity=8))
+        self.assertEqual(b1.shape,(3,2))
+
+
     def test_bug__dynamic_param_advanced_by_repr(self):
         """Check for bug where repr of a PatternGenerator causes a DynamicNumber to change."""
         # CEB: can probably remove this test now we have time-controlled dynamic parameters
@@ -240,7 +288,39 @@ class TestSelector(unittest.TestCase):
 
 
 
+class TestSpectrogram(unittest.TestCase):
+
+    def _signal(self,seconds_per_iteration):
+        return TimeSeries(time_series=generate_sine_wave(1.0,1000,20000)+generate_sine_wave(1.0,4500,20000),
+                          sample_rate=20000,interval_length=0.01,seconds_per_iteration=seconds_per_iteration)
+
+    def _check_spectrogram(self,seconds_per_iteration,**params):
+        bounds = BoundingBox(radius=0.5)
+        spectrogram = Spectrogram(signal=self._signal(seconds_per_iteration),bounds=bounds,ydensity=20,**params)
+        spectrum = PowerSpectrum(signal=self._signal(seconds_per_iteration),bounds=bounds,xdensity=1,ydensity=20)
+
+        # shift a buffer with one column per millisecond along, and average it over each sheet column
+        millisecs = int(seconds_per_iteration*1000)
+        history = numpy.zeros((20,spectrogram.max_latency))
+        spacing = spectrogram._latency_spacing.astype(int)
+        for i in range(12):
+            history[:,millisecs:] = history[:,0:history.shape[1]-millisecs].copy()
+            history[:,0:millisecs] = spectrum()
+            target = numpy.array([history[:,s:e].mean(axis=1) if e-s>1 else history[:,s]
+                                  for s,e in zip(spacing[:-1],spacing[1:])]).T
+            assert_array_almost_equal(spectrogram(),target,decimal=12)
+
+    def test_one_iteration_per_column(self):
+        self._check_spectrogram(0.1,xdensity=5)
+
+    def test_several_columns_per_iteration(self):
+        self._check_spectrogram(0.1,xdensity=10)
+
+    def test_several_iterations_per_column(self):
+        self._check_spectrogram(0.03,xdensity=7,min_latency=20,max_latency=300)
+
+
 
 suite = unittest.TestSuite()
-cases = [TestPatternGenerator,TestSelector]
+cases = [TestPatternGenerator,TestSelector,TestSpectrogram]
 suite.addTests([unittest.makeSuite(case) for case in cases])
@@ -9,7 +9,7 @@ import copy
 import pickle
 
 from numpy.oldnumeric import array
-from topo.base.simulation import Simulation,EPConnection,EPConnectionEvent,Event
+from topo.base.simulation import Simulation,EPConnection,EPConnectionEvent,Event,Profiler
 from topo.ep.basic import *
 
 from topo.base.cf import CFSheet, CFProjection
@@ -146,6 +146,54 @@ class TestSimulation(unittest.TestCase):
         assert s.events[3] == e2
         assert s.events[4] == e2a
 
+
+    def test_event_order(self):
+        s = Simulation(register=False)
+
+        events = [Event(t) for t in (3,1,2,1,3,0,2,1)]
+        for e in events:
+            s.enqueue_event(e)
+
+        # simultaneous events come out in the order they were enqueued
+        expected = sorted(events,key=lambda e: e.time)
+        for e in expected:
+            assert s.events[0] is e
+            assert s.events.pop() is e
+        assert len(s.events) == 0
+
+
+    def test_event_clear(self):
+        s = Simulation(register=False)
+
+        e1 = Event(1)
+        e2 = EPConnectionEvent(2,EPConnection())
+        e3 = Event(3)
+        for e in (e3,e2,e1):
+            s.enqueue_event(e)
+
+        s.event_clear(EPConnectionEvent)
+        assert list(s.events) == [e1,e3]
+        assert s.events[0] is e1 and s.events[1] is e3
+
+
+    def test_profiler(self):
+        s = Simulation(register=False)
+        s['pulse'] = PulseGenerator(period=1)
+        s['sum_unit'] = SumUnit()
+        s.connect('pulse','sum_unit',name='P',delay=1)
+        s.run(0)
+
+        s.profiler = Profiler()
+        s.run(5)
+        results = dict([((r['owner'],r['item'],r['operation']),r) for r in s.profiler.results()])
+        assert results[('Simulation','','run')]['calls'] == 1
+        assert results[('sum_unit','P','input_event')]['calls'] == 5
+        assert results[('sum_unit','','process_current_time')]['calls'] >= 5
+        assert len(s.profiler.table().splitlines()) == len(results)+1
+
+        s.profiler = None
+        s.run(1)
+
         
     def test_get_objects(self):
         s = Simulation()
@@ -5,6 +5,7 @@ $Id$
 __version__='$Revision$'
 
 import unittest, copy, shutil, tempfile
+import numpy
 from numpy.testing import assert_array_equal
 
 from param import normalize_path,resolve_path
@@ -14,6 +15,7 @@ import __main__
 from topo.base.sheet import Sheet
 from topo.sheet import GeneratorSheet
 from topo.command.basic import save_snapshot,load_snapshot
+from topo.command.basic import _dump_with_separate_arrays,_load_with_separate_arrays
 from topo.pattern.basic import Gaussian, Line
 from topo.base.simulation import Simulation,SomeTimer
 
@@ -78,6 +80,67 @@ class TestSnapshots(unittest.TestCase):
 
 
 
+    def test_separate_arrays(self):
+        """
+        Check that arrays saved separately from the pickle come back
+        equal, memory-mapped, writable, and still shared.
+        """
+        w = numpy.arange(100,dtype=numpy.float32).reshape(10,10)
+        a = numpy.arange(30.0)[::3]
+        obj = {'w':w,'w_again':w,'a':a,'small':numpy.ones(3),'objects':numpy.array([None]*20),
+               'list':[w[2:4],'x']}
+        filename = normalize_path("arrays.typ")
+        _dump_with_separate_arrays(obj,filename)
+        # Saving again replaces the file, without affecting arrays already loaded from it
+        loaded = _load_with_separate_arrays(open(filename,'rb'),filename)
+        _dump_with_separate_arrays({'w':w*0},filename)
+
+        self.assertEqual(sorted(loaded.keys()),sorted(obj.keys()))
+        for k in ['w','a','small']:
+            assert_array_equal(loaded[k],obj[k])
+            self.assertEqual(loaded[k].dtype,obj[k].dtype)
+        assert_array_equal(loaded['list'][0],w[2:4])
+        self.assert_(loaded['w_again'] is loaded['w'])
+        base = loaded['w']
+        while base is not None and not isinstance(base,numpy.memmap):
+            base = base.base
+        self.assert_(isinstance(base,numpy.memmap))
+        loaded['w'][0,0] = -1
+        self.assertEqual(loaded['w'][0,0],-1)
+        self.assertEqual(_load_with_separate_arrays(open(filename,'rb'),filename)['w'].sum(),0)
+
+
+    def test_packed_weights_memory_mapped(self):
+        """
+        Check that the CFs of a projection with packed weights come
+        back as views of the memory-mapped store, not as copies.
+        """
+        from topo.base.cf import CFSheet,CFProjection
+        from topo.base.boundingregion import BoundingBox
+        from topo.pattern.random import UniformRandom
+        topo.sim['Src'] = CFSheet(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5))
+        topo.sim['Dest'] = CFSheet(nominal_density=10,nominal_bounds=BoundingBox(radius=0.5))
+        topo.sim.connect('Src','Dest',name='P',connection_type=CFProjection,
+                         nominal_bounds_template=BoundingBox(radius=0.2),
+                         weights_generator=UniformRandom(),pack_weights=True)
+        proj = topo.sim['Dest'].projections()['P']
+
+        filename = normalize_path("packed.typ")
+        _dump_with_separate_arrays(proj,filename)
+        loaded = _load_with_separate_arrays(open(filename,'rb'),filename)
+
+        base = loaded.weight_store.weights
+        while base is not None and not isinstance(base,numpy.memmap):
+            base = base.base
+        self.assert_(isinstance(base,numpy.memmap))
+        for cf,cf_loaded in zip(proj.flatcfs,loaded.flatcfs):
+            assert_array_equal(cf.weights,cf_loaded.weights)
+            assert_array_equal(cf.mask,cf_loaded.mask)
+            self.assert_(numpy.may_share_memory(cf_loaded.weights,loaded.weight_store.weights))
+            self.assert_(numpy.may_share_memory(cf_loaded.mask,loaded.weight_store.masks))
+        self.assert_(loaded.cfs[3,4] is loaded.flatcfs[34])
+
+
     def test_new_simulation_still_works(self):
 
         #  Test to make sure the above tests haven't screwed up
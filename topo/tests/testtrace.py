@@ -0,0 +1,76 @@
+"""
+Unit tests for the DataRecorders in topo.misc.trace.
+
+$Id$
+"""
+__version__='$Revision$'
+
+import unittest, shutil, tempfile, cPickle
+import numpy
+from numpy.testing import assert_array_equal
+
+from param import normalize_path
+from topo.misc.trace import InMemoryRecorder, RingBufferRecorder, DiskRecorder
+
+
+# (recorded out of order at times 2.5 and 0.5)
+TIMES = [1.0,2.0,3.0,2.5,4.0,5.0,0.5,6.0]
+
+
+class TestRecorders(unittest.TestCase):
+
+    def setUp(self):
+        self.original_output_path = normalize_path.prefix
+        normalize_path.prefix = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(normalize_path.prefix)
+        normalize_path.prefix=self.original_output_path
+
+
+    def _record(self,recorder,times=TIMES):
+        recorder.add_variable('V1')
+        for t in times:
+            recorder.record_data('V1',t,numpy.ones((2,3))*t)
+        return recorder
+
+
+    def _assert_same_data(self,r1,r2,times):
+        t1,d1 = r1.get_data('V1',times=times,fill_range=True)
+        t2,d2 = r2.get_data('V1',times=times,fill_range=True)
+        self.assertEqual(list(t1),list(t2))
+        self.assertEqual(len(d1),len(d2))
+        for x,y in zip(d1,d2):
+            assert_array_equal(x,y)
+
+
+    def test_disk_recorder(self):
+        """DiskRecorder should return the same data as InMemoryRecorder."""
+        memory = self._record(InMemoryRecorder())
+        disk = self._record(DiskRecorder(name='disk'))
+
+        self.assertEqual(list(disk.get_times('V1')),sorted(TIMES))
+        for times in [(None,None),(2.0,4.0),(1.2,5.5),(0.5,10.0)]:
+            self._assert_same_data(memory,disk,times)
+        assert_array_equal(disk.get_datum('V1',2.7),memory.get_datum('V1',2.7))
+        assert_array_equal(disk.get_array('V1')[:,0,0],TIMES)
+
+        disk = cPickle.loads(cPickle.dumps(disk,2))
+        self._assert_same_data(memory,disk,(2.0,4.0))
+
+
+    def test_ring_buffer_recorder(self):
+        """RingBufferRecorder should return the same data as InMemoryRecorder for the most recent items."""
+        ring = self._record(RingBufferRecorder(capacity=5))
+        # the items that fit, recorded in time order
+        memory = self._record(InMemoryRecorder(),sorted(TIMES)[-5:])
+
+        self.assertEqual(list(ring.get_times('V1')),sorted(TIMES)[-5:])
+        for times in [(None,None),(2.7,4.0),(3.2,5.5),(3.0,10.0)]:
+            self._assert_same_data(memory,ring,times)
+        assert_array_equal(ring.get_datum('V1',4.5),memory.get_datum('V1',4.5))
+
+
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.makeSuite(TestRecorders))
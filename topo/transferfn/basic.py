@@ -44,6 +44,8 @@ class PiecewiseLinear(TransferFn):
     lower_bound = param.Number(default=0.0,softbounds=(0.0,1.0))
     upper_bound = param.Number(default=1.0,softbounds=(0.0,1.0))
     
+    _pointwise = True
+
     def __call__(self,x):
         fact = 1.0/(self.upper_bound-self.lower_bound)        
         x -= self.lower_bound
@@ -70,6 +72,8 @@ class Sigmoid(TransferFn):
     r = param.Number(default=1,doc="Parameter controlling the growth rate")
     k = param.Number(default=0,doc="Parameter controlling the x-postion")
     
+    _pointwise = True
+
     def __call__(self,x):
         x_orig = copy.copy(x)
         x *= 0.0
@@ -101,6 +105,8 @@ class NakaRushton(TransferFn):
 
     e = param.Number(default=1.0,doc="""The exponent of the input x.""")
 
+    _pointwise = True
+
     #JABALERT: (pow(x_orig,self.e) should presumably be done only once, using a temporary
     def __call__(self,x):
         #print 'A:', x
@@ -141,6 +147,8 @@ class GeneralizedLogistic(TransferFn):
     r = param.Number(default=1,doc="Parameter controlling the growth rate.")
     b = param.Number(default=1,doc="Parameter which affects near which asymptote maximum growth occurs.")
     
+    _pointwise = True
+
     def __call__(self,x):
         x_orig = copy.copy(x)
         x *= 0.0
@@ -238,6 +246,8 @@ class HalfRectifyAndSquare(TransferFn):
     t = param.Number(default=0.0,doc="""
         The threshold at which output becomes non-zero.""")
     
+    _pointwise = True
+
     def __call__(self,x):
         x -= self.t
         clip_lower(x,0)
@@ -256,6 +266,8 @@ class HalfRectifyAndPower(TransferFn):
     t = param.Number(default=0.0,doc="""
         The threshold level subtracted from x.""")
     
+    _pointwise = True
+
     def __call__(self,x):
         x -= self.t
         clip_lower(x,0)
@@ -277,6 +289,8 @@ class ExpLinear(TransferFn):
     a = param.Number(default=1.0,doc="""
         The overall scaling of the function""")
     
+    _pointwise = True
+
     def __call__(self,x):
         x-=self.t1
         clip_lower(x,0)
@@ -289,6 +303,8 @@ class ExpLinear(TransferFn):
 class Square(TransferFn):
     """Transfer function that applies a squaring nonlinearity."""
 
+    _pointwise = True
+
     def __call__(self,x):
         x *= x     
         
@@ -300,6 +316,8 @@ class BinaryThreshold(TransferFn):
     """
     threshold = param.Number(default=0.25, doc="Decision point for determining binary value.")
 
+    _pointwise = True
+
     def __call__(self,x):
         above_threshold = x>=self.threshold
         x *= 0.0
@@ -312,6 +330,8 @@ class Threshold(TransferFn):
     """
     threshold = param.Number(default=0.25, doc="Decision point for determining values to clip.")
 
+    _pointwise = True
+
     def __call__(self,x):
         clip_upper(x,self.threshold)
         
@@ -31,9 +31,15 @@ class CFPOF_DivisiveNormalizeL1_opt(CFPOutputFn):
         TransferFn,DivisiveNormalizeL1(norm_value=1.0),readonly=True)
     
     def __call__(self, iterator, **params):
+        if iterator.weight_store is not None:
+            self._packed_call(iterator)
+            return
+
         cf_type=iterator.cf_type
         cfs = iterator.flatcfs
         num_cfs = len(iterator.flatcfs)
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
         
         # CB: for performance, it is better to process the masks in
         # the C code (rather than combining them before).
@@ -45,9 +51,6 @@ class CFPOF_DivisiveNormalizeL1_opt(CFPOutputFn):
             DECLARE_SLOT_OFFSET(weights,cf_type);
             DECLARE_SLOT_OFFSET(input_sheet_slice,cf_type);
 
-            // CB: I doubt norm_total can be a property and a slot, but maybe
-            // it could be, or maybe we could use the actual attribute...
-            
             for (int r=0; r<num_cfs; ++r) {
                 if (active_units_mask[r] != 0 && sheet_mask[r] != 0) {
                     PyObject *cf = PyList_GetItem(cfs,r);
@@ -55,44 +58,98 @@ class CFPOF_DivisiveNormalizeL1_opt(CFPOutputFn):
                     LOOKUP_FROM_SLOT_OFFSET(float,weights,cf);
                     LOOKUP_FROM_SLOT_OFFSET(int,input_sheet_slice,cf);
 
-                    PyObject *sum_obj     = PyObject_GetAttrString(cf,"norm_total");
+                    UNPACK_FOUR_TUPLE(int,rr1,rr2,cc1,cc2,input_sheet_slice);
+                    int rc = (rr2-rr1)*(cc2-cc1);
 
-                    double total = PyFloat_AsDouble(sum_obj); // sum of the cf's weights
+                    // sum of the cf's weights, unless already known
+                    double total = 0.0;
+                    if (has_norm_totals[r]) {
+                        total = norm_totals[r];
+                    } else {
+                        for (int i=0; i<rc; ++i) {
+                            total += fabs(weights[i]);
+                        }
+                    }
 
                     if( total > 0.0000000000001 ) {
-
-                        UNPACK_FOUR_TUPLE(int,rr1,rr2,cc1,cc2,input_sheet_slice);
-    
                         // normalize the weights
                         double factor = 1.0/total;
-                        int rc = (rr2-rr1)*(cc2-cc1);
                         for (int i=0; i<rc; ++i) {
                             *(weights++) *= factor;
                         }
 
                     }
 
-                    // Anything obtained with PyObject_GetAttrString must be explicitly freed
-                    Py_DECREF(sum_obj);
-
                     // Indicate that norm_total is stale
-                    PyObject_SetAttrString(cf,"_has_norm_total",Py_False);
+                    has_norm_totals[r] = 0;
                 }
                 
             }
         """    
-        inline(code, ['sheet_mask','active_units_mask','cfs','cf_type','num_cfs'], 
+        inline(code, ['sheet_mask','active_units_mask','cfs','cf_type','num_cfs',
+                      'norm_totals','has_norm_totals'], 
                local_dict=locals(),
                headers=['<structmember.h>'])
 
 
+    def _packed_call(self, iterator):
+        """
+        Same as __call__, but for CFs whose weights are packed into a
+        CFWeightStore, so that the CF objects are not accessed at
+        all.
+        """
+        store = iterator.weight_store
+        weights = store.weights
+        offsets = store.offsets
+        sizes = store.sizes
+        num_cfs = len(offsets)
+        norm_totals = iterator.norm_totals
+        has_norm_totals = iterator.has_norm_totals
+
+        active_units_mask = iterator.get_active_units_mask()
+        sheet_mask = iterator.get_sheet_mask()
+
+        code = c_header + """
+            for (int r=0; r<num_cfs; ++r) {
+                if (active_units_mask[r] != 0 && sheet_mask[r] != 0) {
+                    float *wi = weights + offsets[r];
+                    int rc = sizes[r];
+
+                    // sum of the cf's weights, unless already known
+                    double total = 0.0;
+                    if (has_norm_totals[r]) {
+                        total = norm_totals[r];
+                    } else {
+                        for (int i=0; i<rc; ++i) {
+                            total += fabs(wi[i]);
+                        }
+                    }
+
+                    if( total > 0.0000000000001 ) {
+                        // normalize the weights
+                        double factor = 1.0/total;
+                        for (int i=0; i<rc; ++i) {
+                            *(wi++) *= factor;
+                        }
+                    }
+
+                    // Indicate that norm_total is stale
+                    has_norm_totals[r] = 0;
+                }
+            }
+        """
+        inline(code, ['sheet_mask','active_units_mask','weights','offsets',
+                      'sizes','num_cfs','norm_totals','has_norm_totals'],
+               local_dict=locals())
+
+
 class CFPOF_DivisiveNormalizeL1(CFPOutputFn):
     """
     Non-optimized version of CFPOF_DivisiveNormalizeL1_opt.
 
     Same as CFPOF_Plugin(single_cf_fn=DivisiveNormalizeL1()), except
-    that it supports joint normalization using the norm_total
-    property of ConnectionField.
+    that it supports joint normalization using the norm_totals of
+    the projection.
     """
 
     single_cf_fn = param.ClassSelector(
@@ -100,21 +157,26 @@ class CFPOF_DivisiveNormalizeL1(CFPOutputFn):
 
     def __call__(self, iterator, **params):
         """
-        Uses the cf.norm_total attribute to allow optimization
+        Uses the projection's norm_totals to allow optimization
         by computing the sum separately, and to allow joint
-        normalization.  After use, cf.norm_total is deleted because
-        the value it would have has been changed.
+        normalization.  After use, each norm_total is marked as
+        unset because the value it would have has been changed.
         """
         # CEBALERT: fix this here and elsewhere
         if type(self.single_cf_fn) is not IdentityTF:
             single_cf_fn = self.single_cf_fn
             norm_value = self.single_cf_fn.norm_value                
+            norm_totals = iterator.norm_totals
+            has_norm_totals = iterator.has_norm_totals
             for cf,i in iterator():
-                current_sum=cf.norm_total
+                if has_norm_totals[i]:
+                    current_sum = norm_totals[i]
+                else:
+                    current_sum = abs(cf.weights).sum()
 		if current_sum > 0.0000000000001:
                     factor = norm_value/current_sum
                     cf.weights *= factor
-                del cf.norm_total
+                has_norm_totals[i] = False
 
 
 provide_unoptimized_equivalent("CFPOF_DivisiveNormalizeL1_opt","CFPOF_DivisiveNormalizeL1",locals())